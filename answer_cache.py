@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+answer_cache.py
+---------------
+Cache a due livelli per le risposte LLM:
+- L1: LRU in memoria (per worker) con TTL,
+- L2: SQLite su disco, condiviso da tutti i worker gunicorn della stessa macchina.
+  Dal codice async si usano aget/aset: L1 sull'event loop, L2 in un thread.
+
+La chiave comprende una "versione" (hash di KB + prompt): quando KB o prompt
+cambiano la versione cambia, le vecchie voci non vengono più lette e quelle su
+disco vengono eliminate al primo avvio con la nuova versione.
+
+Dipendenze: solo libreria standard.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+def fingerprint(parts: Iterable[Any]) -> str:
+    """Hash stabile (sha1) di stringhe/bytes, usato per versione KB e prompt."""
+    h = hashlib.sha1()
+    for p in parts:
+        if p is None:
+            p = b""
+        if isinstance(p, str):
+            p = p.encode("utf-8")
+        h.update(p)
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def file_fingerprint(path: str) -> str:
+    """Hash del contenuto di un file ("" se non esiste)."""
+    if not os.path.exists(path):
+        return ""
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        db_path: Optional[str],
+        version: str = "",
+        max_items: int = 1024,
+        ttl: float = 86400.0,
+    ) -> None:
+        self.db_path = db_path
+        self.version = version
+        self.max_items = max_items
+        self.ttl = ttl
+
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # _lock protegge solo L1 (mai tenuto durante l'I/O), _db_lock la connessione SQLite
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        # la connessione SQLite non sopravvive al fork: una per processo
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.stores = 0
+
+    # ---------------------------
+    # Chiave
+    # ---------------------------
+    def make_key(
+        self,
+        question_norm: str,
+        route: str,
+        system_prompt: str,
+        model: str,
+        temperature: float,
+    ) -> str:
+        return fingerprint([
+            self.version,
+            route,
+            model,
+            f"{temperature:.3f}",
+            fingerprint([system_prompt]),
+            question_norm,
+        ])
+
+    # ---------------------------
+    # L2 SQLite
+    # ---------------------------
+    def _db(self) -> Optional[sqlite3.Connection]:
+        if not self.db_path:
+            return None
+        pid = os.getpid()
+        if self._conn is not None and self._conn_pid == pid:
+            return self._conn
+        try:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=5.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                " key TEXT PRIMARY KEY,"
+                " version TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " answer TEXT NOT NULL)"
+            )
+            conn.execute("DELETE FROM answers WHERE version != ?", (self.version,))
+            conn.commit()
+        except Exception as e:
+            print(f"[CACHE][WARN] SQLite non disponibile ({self.db_path}): {e}")
+            self.db_path = None
+            return None
+        self._conn = conn
+        self._conn_pid = pid
+        return conn
+
+    # ---------------------------
+    # API
+    # ---------------------------
+    def get(self, key: str) -> Optional[str]:
+        answer = self.get_memory(key)
+        if answer is None:
+            answer = self.get_disk(key)
+        return answer
+
+    def set(self, key: str, answer: str) -> None:
+        if not answer:
+            return
+        now = self.set_memory(key, answer)
+        self.set_disk(key, answer, now)
+
+    # Varianti per l'event loop: L1 subito, L2 in un thread (SQLite può
+    # attendere fino a 5 s un lock tenuto da un altro worker)
+    async def aget(self, key: str) -> Optional[str]:
+        answer = self.get_memory(key)
+        if answer is None:
+            if self.db_path:
+                answer = await asyncio.to_thread(self.get_disk, key)
+            else:
+                answer = self.get_disk(key)  # senza L2: conta solo il miss
+        return answer
+
+    async def aset(self, key: str, answer: str) -> None:
+        if not answer:
+            return
+        now = self.set_memory(key, answer)
+        if self.db_path:
+            # scrittura L2 senza attesa: la risposta non aspetta il disco
+            asyncio.get_running_loop().run_in_executor(None, self.set_disk, key, answer, now)
+
+    def get_memory(self, key: str) -> Optional[str]:
+        """Solo L1 (nessun I/O); un mancato hit non viene contato qui."""
+        now = time.time()
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                created, answer = hit
+                if now - created <= self.ttl:
+                    self._mem.move_to_end(key)
+                    self.hits_memory += 1
+                    return answer
+                del self._mem[key]
+        return None
+
+    def get_disk(self, key: str) -> Optional[str]:
+        """L2 (bloccante): un hit viene copiato in L1."""
+        now = time.time()
+        row = None
+        with self._db_lock:
+            conn = self._db()
+            if conn is not None:
+                try:
+                    row = conn.execute(
+                        "SELECT created, answer FROM answers WHERE key = ? AND version = ?",
+                        (key, self.version),
+                    ).fetchone()
+                except Exception as e:
+                    print(f"[CACHE][WARN] lettura SQLite: {e}")
+        with self._lock:
+            if row is not None and now - row[0] <= self.ttl:
+                self._remember(key, row[0], row[1])
+                self.hits_disk += 1
+                return row[1]
+            self.misses += 1
+            return None
+
+    def set_memory(self, key: str, answer: str) -> float:
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, answer)
+            self.stores += 1
+        return now
+
+    def set_disk(self, key: str, answer: str, created: float) -> None:
+        with self._db_lock:
+            conn = self._db()
+            if conn is not None:
+                try:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO answers (key, version, created, answer) VALUES (?, ?, ?, ?)",
+                        (key, self.version, created, answer),
+                    )
+                    conn.commit()
+                except Exception as e:
+                    print(f"[CACHE][WARN] scrittura SQLite: {e}")
+
+    def _remember(self, key: str, created: float, answer: str) -> None:
+        self._mem[key] = (created, answer)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def set_version(self, version: str) -> None:
+        """Cambia versione (KB o prompt modificati): svuota L1 e le voci L2 obsolete."""
+        with self._lock:
+            if version == self.version:
+                return
+            self.version = version
+            self._mem.clear()
+        with self._db_lock:
+            conn = self._db()
+            if conn is not None:
+                try:
+                    conn.execute("DELETE FROM answers WHERE version != ?", (version,))
+                    conn.commit()
+                except Exception as e:
+                    print(f"[CACHE][WARN] pulizia SQLite: {e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+        with self._db_lock:
+            conn = self._db()
+            if conn is not None:
+                try:
+                    conn.execute("DELETE FROM answers")
+                    conn.commit()
+                except Exception as e:
+                    print(f"[CACHE][WARN] svuotamento SQLite: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "version": self.version[:12],
+            "memory_items": len(self._mem),
+            "disk": bool(self.db_path),
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": round((self.hits_memory + self.hits_disk) / lookups, 3) if lookups else 0.0,
+        }
@@ -1,15 +1,26 @@
 import os
 import json
 import re
-from typing import List, Dict, Any, Optional
+import time
+import asyncio
+import inspect
+from typing import List, Dict, Any, Optional, AsyncIterator, Set, Tuple
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
+
+from answer_cache import AnswerCache, fingerprint
+from kb_snapshot import SnapshotStore
+from kb_watcher import FileWatcher, paths_fingerprint
+from proc_memory import process_memory
+from keyword_automaton import KeywordAutomaton
+from sinapsi_overrides import OverrideDispatcher, OverrideRule, apply_extras, read_rule_files
 
 # ============================================================
 # CONFIG BASE
@@ -22,12 +33,66 @@ DATA_DIR = os.path.join(STATIC_DIR, "data")
 MASTER_PATH = os.path.join(DATA_DIR, "ctf_system_COMPLETE_GOLD_master.json")
 COMM_PATH = os.path.join(DATA_DIR, "COMM.json")
 
+# Regole Sinapsi critiche (regex → risposta curata, override/augment/postscript),
+# valutate prima del routing. A parità di id vale il primo file.
+CRITICI_DIR = os.path.join(STATIC_DIR, "static", "data", "critici")
+SINAPSI_OVERRIDE_ENABLE = os.getenv("SINAPSI_OVERRIDE_ENABLE", "1") == "1"
+SINAPSI_RULES_PATHS = [
+    p.strip() for p in os.getenv(
+        "SINAPSI_RULES_PATHS",
+        ",".join([
+            os.path.join(CRITICI_DIR, "sinapsi_rules.json"),
+            os.path.join(CRITICI_DIR, "sinapsi_brain.json"),
+        ]),
+    ).split(",") if p.strip()
+]
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_MODEL_ENV = (os.getenv("OPENAI_MODEL", "gpt-4o") or "gpt-4o").strip()
-
-client: Optional[OpenAI] = None
+OPENAI_MODEL_EFFECTIVE = "gpt-5.1"
+# endpoint OpenAI-compatibile alternativo (es. llm_standin.py per i test di carico)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "").strip() or None
+
+# Cache risposte LLM (L1 memoria per worker + L2 SQLite condiviso tra worker)
+ANSWER_CACHE_ENABLE = os.getenv("ANSWER_CACHE_ENABLE", "1") == "1"
+ANSWER_CACHE_DB = os.getenv("ANSWER_CACHE_DB", os.path.join(BASE_DIR, ".cache", "answer_cache.sqlite3"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_ITEMS = int(os.getenv("ANSWER_CACHE_MAX_ITEMS", "1024"))
+
+# Fast path GOLD: se la domanda corrisponde a un blocco KB con confidenza
+# >= KB_GOLD_THRESHOLD si restituisce direttamente answer_it, senza LLM.
+KB_FAST_PATH_ENABLE = os.getenv("KB_FAST_PATH_ENABLE", "1") == "1"
+KB_GOLD_THRESHOLD = float(os.getenv("KB_GOLD_THRESHOLD", "0.85"))
+
+# Ricaricamento a caldo di KB e COMM: file controllati ogni KB_WATCH_INTERVAL secondi
+KB_WATCH_ENABLE = os.getenv("KB_WATCH_ENABLE", "1") == "1"
+KB_WATCH_INTERVAL = float(os.getenv("KB_WATCH_INTERVAL", "2"))
+
+# Artefatto KB precompilato (kb_snapshot.py): avvio senza parsing JSON né indicizzazione.
+# La firma del formato (KB_INDEX_FORMAT, più sotto) deriva dal codice che costruisce l'indice.
+KB_SNAPSHOT_ENABLE = os.getenv("KB_SNAPSHOT_ENABLE", "1") == "1"
+KB_SNAPSHOT_PATH = os.getenv("KB_SNAPSHOT_PATH", os.path.join(BASE_DIR, ".cache", "kb_snapshot.bin"))
+KB_SNAPSHOT_REBUILD = os.getenv("KB_SNAPSHOT_REBUILD", "0") == "1"
+
+# Pipeline LLM asincrona: un solo client per worker con pool HTTP condiviso,
+# semaforo sulle chiamate in volo e timeout per singola chiamata.
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "90"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+
+http_client: Optional[httpx.AsyncClient] = None
+client: Optional[AsyncOpenAI] = None
 if OPENAI_API_KEY:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_CONCURRENCY,
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+    )
+    client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, http_client=http_client)
+
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
 
 # ============================================================
 # FASTAPI APP
@@ -48,6 +113,23 @@ if not os.path.isdir(STATIC_DIR):
 
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
+
+@app.on_event("shutdown")
+async def close_http_client() -> None:
+    if http_client is not None:
+        await http_client.aclose()
+
+
+@app.on_event("startup")
+async def start_kb_watcher() -> None:
+    if KB_WATCH_ENABLE:
+        KB_WATCHER.start()
+
+
+@app.on_event("shutdown")
+async def stop_kb_watcher() -> None:
+    KB_WATCHER.stop()
+
 # ============================================================
 # MODELLI Pydantic
 # ============================================================
@@ -75,126 +157,313 @@ def normalize(text: str) -> str:
 # CARICAMENTO KB TECNICA (per meta / debug)
 # ============================================================
 
-KB_BLOCKS: List[Dict[str, Any]] = []
-
-
-def load_kb() -> None:
-    global KB_BLOCKS
+def build_kb_index(
+    blocks: List[Dict[str, Any]]
+) -> Tuple[List[frozenset], List[frozenset], Dict[str, List[int]]]:
+    """
+    Indice invertito della KB:
+    - block_tokens[i] = token normalizzati (triggers + question_it) del blocco i
+    - question_tokens[i] = token normalizzati della sola question_it (confidenza fast path)
+    - postings[token] = indici dei blocchi che contengono il token (ordine crescente)
+    """
+    block_tokens: List[frozenset] = []
+    question_tokens: List[frozenset] = []
+    postings: Dict[str, List[int]] = {}
+    for i, b in enumerate(blocks):
+        text = normalize(" ".join(b.get("triggers", [])) + " " + b.get("question_it", ""))
+        tokens = frozenset(text.split())
+        block_tokens.append(tokens)
+        question_tokens.append(frozenset(normalize(b.get("question_it", "")).split()))
+        for t in tokens:
+            postings.setdefault(t, []).append(i)
+    return block_tokens, question_tokens, postings
+
+
+def read_kb_blocks() -> List[Dict[str, Any]]:
     if not os.path.exists(MASTER_PATH):
         print(f"[WARN] MASTER_PATH non trovato: {MASTER_PATH}")
-        KB_BLOCKS = []
-        return
-
-    try:
-        with open(MASTER_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        if isinstance(data, dict) and "blocks" in data:
-            KB_BLOCKS = data["blocks"]
-        elif isinstance(data, list):
-            KB_BLOCKS = data
-        else:
-            KB_BLOCKS = []
+        return []
 
-        print(f"[INFO] KB caricata: {len(KB_BLOCKS)} blocchi")
-    except Exception as e:
-        print(f"[ERROR] caricando KB: {e}")
-        KB_BLOCKS = []
+    with open(MASTER_PATH, "r", encoding="utf-8") as f:
+        data = json.load(f)
 
+    if isinstance(data, dict) and "blocks" in data:
+        blocks = data["blocks"]
+    elif isinstance(data, list):
+        blocks = data
+    else:
+        blocks = []
 
-def score_block(question_norm: str, block: Dict[str, Any]) -> float:
-    triggers = " ".join(block.get("triggers", []))
-    q_it = block.get("question_it", "")
-    text = normalize(triggers + " " + q_it)
-    if not text:
-        return 0.0
+    print(f"[INFO] KB caricata: {len(blocks)} blocchi")
+    return blocks
 
-    q_words = set(question_norm.split())
-    b_words = set(text.split())
-    if not q_words or not b_words:
-        return 0.0
 
-    common = q_words & b_words
+def match_from_kb_scored(
+    question: str, threshold: float = 0.18, kb: Optional["KBSnapshot"] = None
+) -> Tuple[Optional[Dict[str, Any]], float, float]:
+    """
+    Punteggio di un blocco = token della domanda presenti nei suoi triggers o
+    nella question_it (normalizzati) / token distinti della domanda. Calcolato
+    solo sui blocchi che condividono almeno un token con la domanda, tramite le
+    posting list dello snapshot KB; a parità vince il primo blocco della KB.
+
+    Ritorna (blocco, punteggio, confidenza). La confidenza è la media armonica
+    tra copertura della domanda e copertura della question_it del blocco:
+    vale 1.0 solo se la domanda coincide (a meno di punteggiatura) con quella curata.
+    """
+    kb = kb or KB
+    if not kb.blocks:
+        return None, 0.0, 0.0
+    q_words = set(normalize(question).split())
+    if not q_words:
+        return None, 0.0, 0.0
+
+    common: Dict[int, int] = {}
+    for t in q_words:
+        for i in kb.postings.get(t, ()):
+            common[i] = common.get(i, 0) + 1
     if not common:
-        return 0.0
+        return None, 0.0, 0.0
 
-    return len(common) / max(len(q_words), 1)
+    # a parità di punteggio vince il primo blocco della KB (come la scansione lineare)
+    best_idx = min(common, key=lambda i: (-common[i], i))
+    best_score = common[best_idx] / len(q_words)
+    if best_score < threshold:
+        return None, best_score, 0.0
+
+    q_it_tokens = kb.question_tokens[best_idx]
+    recall = len(q_words & q_it_tokens) / len(q_it_tokens) if q_it_tokens else 0.0
+    confidence = (
+        2 * best_score * recall / (best_score + recall) if best_score + recall else 0.0
+    )
+    return kb.blocks[best_idx], best_score, confidence
 
 
 def match_from_kb(question: str, threshold: float = 0.18) -> Optional[Dict[str, Any]]:
-    if not KB_BLOCKS:
-        return None
-    qn = normalize(question)
-    best_block: Optional[Dict[str, Any]] = None
-    best_score = 0.0
-    for b in KB_BLOCKS:
-        s = score_block(qn, b)
-        if s > best_score:
-            best_score = s
-            best_block = b
-    if best_score < threshold:
-        return None
-    return best_block
+    return match_from_kb_scored(question, threshold)[0]
 
 
-load_kb()
+def kb_fast_answer(
+    question: str, kb: Optional["KBSnapshot"] = None
+) -> Tuple[Optional[Dict[str, Any]], float, Optional[str]]:
+    """
+    Ritorna (blocco, confidenza, risposta curata). La risposta è valorizzata
+    solo se il fast path è attivo e la confidenza supera KB_GOLD_THRESHOLD.
+    """
+    block, _, confidence = match_from_kb_scored(question, kb=kb)
+    if block is None or not KB_FAST_PATH_ENABLE or confidence < KB_GOLD_THRESHOLD:
+        return block, confidence, None
+    return block, confidence, (block.get("answer_it") or "").strip() or None
+
 
 # ============================================================
 # CARICAMENTO COMM (dati aziendali/commerciali)
 # ============================================================
 
-COMM_ITEMS: List[Dict[str, Any]] = []
-
-
-def load_comm() -> None:
-    global COMM_ITEMS
+def read_comm_items() -> List[Dict[str, Any]]:
     if not os.path.exists(COMM_PATH):
         print(f"[WARN] COMM_PATH non trovato: {COMM_PATH}")
-        COMM_ITEMS = []
-        return
+        return []
 
-    try:
-        with open(COMM_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    with open(COMM_PATH, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    if isinstance(data, dict) and "items" in data:
+        items = data["items"]
+    elif isinstance(data, list):
+        items = data
+    else:
+        items = []
+
+    print(f"[INFO] COMM caricata: {len(items)} blocchi COMM")
+    return items
+
+
+# ============================================================
+# SNAPSHOT KB + COMM (ricaricamento a caldo senza lock sui lettori)
+# ============================================================
+
+class KBSnapshot:
+    """
+    KB tecnica + COMM + indice, costruiti insieme e mai modificati dopo.
+    Un ricaricamento costruisce un nuovo snapshot e lo pubblica riassegnando KB:
+    ogni richiesta legge KB una volta e lavora su una sola versione coerente.
+    """
 
-        if isinstance(data, dict) and "items" in data:
-            COMM_ITEMS = data["items"]
-        elif isinstance(data, list):
-            COMM_ITEMS = data
-        else:
-            COMM_ITEMS = []
+    def __init__(
+        self,
+        blocks: List[Dict[str, Any]],
+        comm_items: List[Dict[str, Any]],
+        version: str,
+        sinapsi_rules: Optional[List[Tuple[str, List[Dict[str, Any]]]]] = None,
+    ) -> None:
+        self.blocks = blocks
+        self.comm_items = comm_items
+        self.block_tokens, self.question_tokens, self.postings = build_kb_index(blocks)
+        self.sinapsi_rules = sinapsi_rules or []
+        self.overrides = OverrideDispatcher(self.sinapsi_rules)
+        self.version = version
+        self.loaded_at = time.time()
+        self.loaded_pid = os.getpid()
+
+    @classmethod
+    def from_compiled(cls, payload: Dict[str, Any], version: str) -> "KBSnapshot":
+        """Snapshot dall'artefatto precompilato: nessuna normalizzazione né indicizzazione."""
+        snap = cls.__new__(cls)
+        snap.blocks = payload["blocks"]
+        snap.comm_items = payload["comm_items"]
+        snap.block_tokens = [frozenset(t) for t in payload["block_tokens"]]
+        snap.question_tokens = [frozenset(t) for t in payload["question_tokens"]]
+        snap.postings = payload["postings"]
+        # le regex non si serializzano: si ricompilano (pochi ms)
+        snap.sinapsi_rules = [tuple(rs) for rs in payload.get("sinapsi_rules", [])]
+        snap.overrides = OverrideDispatcher(snap.sinapsi_rules)
+        snap.version = version
+        snap.loaded_at = time.time()
+        snap.loaded_pid = os.getpid()
+        return snap
+
+    def to_compiled(self) -> Dict[str, Any]:
+        return {
+            "blocks": self.blocks,
+            "comm_items": self.comm_items,
+            "block_tokens": [sorted(t) for t in self.block_tokens],
+            "question_tokens": [sorted(t) for t in self.question_tokens],
+            "postings": self.postings,
+            "sinapsi_rules": self.sinapsi_rules,
+        }
+
+
+KB_STORE = SnapshotStore(KB_SNAPSHOT_PATH if KB_SNAPSHOT_ENABLE else None)
+
+
+def code_fingerprint(*objs: Any) -> str:
+    """Hash del sorgente di funzioni/classi (solo il nome se il sorgente non è disponibile)."""
+    parts = []
+    for obj in objs:
+        try:
+            parts.append(inspect.getsource(obj))
+        except (OSError, TypeError):
+            parts.append(obj.__qualname__)
+    return fingerprint(parts)
+
+
+# firma del codice che compila lo snapshot: un artefatto salvato da un'altra
+# versione di normalize/indice/serializzazione viene ignorato e ricostruito
+KB_INDEX_FORMAT = fingerprint([
+    "app-index-2",
+    code_fingerprint(
+        normalize, build_kb_index, read_kb_blocks, read_comm_items,
+        read_rule_files, KBSnapshot,
+    ),
+])
+
+
+def kb_paths() -> List[str]:
+    return [MASTER_PATH, COMM_PATH] + (SINAPSI_RULES_PATHS if SINAPSI_OVERRIDE_ENABLE else [])
+
+
+def read_sinapsi_rules() -> List[Tuple[str, List[Dict[str, Any]]]]:
+    return read_rule_files(SINAPSI_RULES_PATHS) if SINAPSI_OVERRIDE_ENABLE else []
+
+
+def build_snapshot() -> KBSnapshot:
+    """
+    Snapshot dall'artefatto precompilato se le sorgenti non sono cambiate,
+    altrimenti dai JSON (e l'artefatto viene riscritto per il prossimo avvio).
+    """
+    version = paths_fingerprint(kb_paths())
+    source_hash = fingerprint([version, KB_INDEX_FORMAT])
+
+    if KB_SNAPSHOT_ENABLE and not KB_SNAPSHOT_REBUILD:
+        payload = KB_STORE.load("app", source_hash)
+        if payload is not None:
+            snap = KBSnapshot.from_compiled(payload, version)
+            print(f"[INFO] KB da snapshot compilato: {len(snap.blocks)} blocchi, versione {version[:12]}")
+            return snap
 
-        print(f"[INFO] COMM caricata: {len(COMM_ITEMS)} blocchi COMM")
+    snap = KBSnapshot(read_kb_blocks(), read_comm_items(), version, read_sinapsi_rules())
+    print(f"[INFO] KB indicizzata: {len(snap.postings)} token, versione {version[:12]}")
+    if KB_SNAPSHOT_ENABLE:
+        KB_STORE.save("app", source_hash, snap.to_compiled())
+    return snap
+
+
+def load_initial_snapshot() -> KBSnapshot:
+    """All'avvio un file illeggibile non deve impedire la partenza: KB vuota."""
+    try:
+        return build_snapshot()
     except Exception as e:
-        print(f"[ERROR] caricando COMM: {e}")
-        COMM_ITEMS = []
+        print(f"[ERROR] caricando KB/COMM: {e}")
+        return KBSnapshot([], [], "")
+
+
+KB = load_initial_snapshot()
+
+
+# ============================================================
+# RICONOSCIMENTO INTENT (automa unico, un solo passaggio sulla domanda)
+# ============================================================
+# Le frasi valgono a confine di parola ("rea" non scatta in "realizzare");
+# "*" finale = prefisso ("foto*" copre anche "fotografie").
+
+INTENT_COMM = "comm"
+INTENT_SITUATIONAL = "situational"
+
+COMMERCIAL_KEYWORDS = [
+    "partita iva", "p.iva", "p iva", "codice fiscale",
+    "rea", "registro imprese", "camera di commercio",
+    "indirizzo", "sede", "dove si trova tecnaria",
+    "telefono", "numero di telefono", "recapito",
+    "email", "mail", "posta elettronica",
+    "orari", "orario", "apertura", "chiusura",
+    "codice sdi", "sdi", "codice destinatario",
+    "fatturazione elettronica",
+    "dati aziendali", "dati societari", "azienda tecnaria",
+]
+
+SITUATIONAL_TRIGGERS = [
+    "ho un solaio", "abbiamo un solaio", "c'è un solaio",
+    "ho un cantiere", "abbiamo un cantiere",
+    "vorrei rinforzare", "voglio rinforzare", "devo rinforzare",
+    "ho delle travi", "abbiamo delle travi",
+    "il cliente ha", "il progettista chiede",
+    "situazione", "caso", "problema",
+    "ho solo", "abbiamo solo", "non abbiamo",
+    "non so", "non siamo sicuri",
+    "edificio", "palazzo", "capannone", "villa",
+    "anni '", "anni 6*", "anni 7*", "anni 8*", "anni 9*",
+    "struttura esistente", "struttura vecchia",
+    "foto*", "rilievo", "stratigrafia",
+]
+
+INTENT_AUTOMATON = KeywordAutomaton()
+INTENT_AUTOMATON.add_all(COMMERCIAL_KEYWORDS, INTENT_COMM)
+INTENT_AUTOMATON.add_all(SITUATIONAL_TRIGGERS, INTENT_SITUATIONAL)
+INTENT_AUTOMATON.build()
+
+
+def detect_intents(question: str) -> Set[str]:
+    """
+    Tutti gli intent riconosciuti nella domanda (es. {"comm", "situational"}).
+    """
+    return INTENT_AUTOMATON.labels(question)
 
 
 def is_commercial_question(q: str) -> bool:
-    q = q.lower()
-    keywords = [
-        "partita iva", "p.iva", "p iva", "codice fiscale",
-        "rea", "registro imprese", "camera di commercio",
-        "indirizzo", "sede", "dove si trova tecnaria",
-        "telefono", "numero di telefono", "recapito",
-        "email", "mail", "posta elettronica",
-        "orari", "orario", "apertura", "chiusura",
-        "codice sdi", "sdi", "codice destinatario",
-        "fatturazione elettronica",
-        "dati aziendali", "dati societari", "azienda tecnaria",
-    ]
-    return any(k in q for k in keywords)
-
-
-def match_comm(question: str) -> Optional[Dict[str, Any]]:
-    if not COMM_ITEMS:
+    return INTENT_COMM in detect_intents(q)
+
+
+def match_comm(question: str, kb: Optional[KBSnapshot] = None) -> Optional[Dict[str, Any]]:
+    comm_items = (kb or KB).comm_items
+    if not comm_items:
         return None
 
     q = normalize(question)
     best: Optional[Dict[str, Any]] = None
     best_score = 0
 
-    for item in COMM_ITEMS:
+    for item in comm_items:
         local_score = 0
         for tag in item.get("tags", []):
             tag_norm = tag.lower()
@@ -207,9 +476,6 @@ def match_comm(question: str) -> Optional[Dict[str, Any]]:
 
     return best if best_score >= 1 else None
 
-
-load_comm()
-
 # ============================================================
 # LLM: PROMPT TECNARIA GOLD
 # ============================================================
@@ -314,52 +580,278 @@ Stile: tecnico, diretto, aziendale. Niente marketing.
 """
 
 
+def answer_cache_version(kb_version: str) -> str:
+    """La versione della cache cambia se cambiano KB, COMM o prompt → invalidazione automatica."""
+    return fingerprint([
+        kb_version,
+        SYSTEM_PROMPT_GOLD,
+        SYSTEM_PROMPT_NARRATORE,
+        SYSTEM_PROMPT_SUPERRISPONDITORE,
+    ])
+
+
+ANSWER_CACHE = AnswerCache(
+    ANSWER_CACHE_DB if ANSWER_CACHE_ENABLE else None,
+    version=answer_cache_version(KB.version),
+    max_items=ANSWER_CACHE_MAX_ITEMS,
+    ttl=ANSWER_CACHE_TTL,
+)
+
+
+def reload_kb() -> KBSnapshot:
+    """
+    Costruisce il nuovo snapshot (thread del watcher o /api/reload) e lo
+    pubblica con un solo assegnamento; le richieste in corso restano sul vecchio.
+    """
+    global KB
+    snap = build_snapshot()
+    KB = snap
+    if ANSWER_CACHE_ENABLE:
+        ANSWER_CACHE.set_version(answer_cache_version(snap.version))
+    return snap
+
+
+KB_WATCHER = FileWatcher("KB/COMM", kb_paths, reload_kb, KB_WATCH_INTERVAL)
+
+
 def is_situational(question: str) -> bool:
     """
     Rileva se la domanda descrive una situazione
     invece di fare una domanda tecnica diretta.
     """
-    q = question.lower()
-    triggers = [
-        "ho un solaio", "abbiamo un solaio", "c'è un solaio",
-        "ho un cantiere", "abbiamo un cantiere",
-        "vorrei rinforzare", "voglio rinforzare", "devo rinforzare",
-        "ho delle travi", "abbiamo delle travi",
-        "il cliente ha", "il progettista chiede",
-        "situazione", "caso", "problema",
-        "ho solo", "abbiamo solo", "non abbiamo",
-        "non so", "non siamo sicuri",
-        "edificio", "palazzo", "capannone", "villa",
-        "anni '", "anni 6", "anni 7", "anni 8", "anni 9",
-        "struttura esistente", "struttura vecchia",
-        "foto", "rilievo", "stratigrafia",
-    ]
-    return any(t in q for t in triggers)
-
-
-def call_openai(prompt_system: str, question: str, temperature: float = 0.3) -> str:
-    """
-    Wrapper unico per chiamare OpenAI.
+    return INTENT_SITUATIONAL in detect_intents(question)
+
+
+def answer_cache_key(route: str, prompt_system: str, question: str, temperature: float) -> str:
+    return ANSWER_CACHE.make_key(
+        normalize(question), route, prompt_system, OPENAI_MODEL_EFFECTIVE, temperature
+    )
+
+
+async def call_openai(
+    prompt_system: str,
+    question: str,
+    temperature: float = 0.3,
+    timeout: Optional[float] = None,
+    route: Optional[str] = None,
+) -> str:
+    """
+    Wrapper unico per chiamare OpenAI (client asincrono, non blocca l'event loop).
     Modello FORZATO a gpt-5.1 (ignora OPENAI_MODEL_ENV).
+    Al massimo LLM_MAX_CONCURRENCY chiamate in volo per worker;
+    ogni chiamata ha un tempo massimo (default OPENAI_TIMEOUT secondi),
+    attesa in coda per il semaforo compresa.
+    Se `route` è indicato la risposta passa dalla cache (solo le risposte riuscite).
     """
     if client is None:
         return "Il motore esterno non è disponibile (OPENAI_API_KEY mancante)."
 
+    cache_key = None
+    if route and ANSWER_CACHE_ENABLE:
+        cache_key = answer_cache_key(route, prompt_system, question, temperature)
+        cached = await ANSWER_CACHE.aget(cache_key)
+        if cached is not None:
+            return cached
+
     try:
-        completion = client.chat.completions.create(
-            model="gpt-5.1",
-            messages=[
-                {"role": "system", "content": prompt_system},
-                {"role": "user", "content": question},
-            ],
-            temperature=temperature,
-            top_p=1.0,
-        )
-        return (completion.choices[0].message.content or "").strip()
+        # il tempo massimo comprende anche l'attesa di un posto nel semaforo
+        async with asyncio.timeout(timeout or OPENAI_TIMEOUT):
+            async with llm_semaphore:
+                completion = await client.chat.completions.create(
+                    model=OPENAI_MODEL_EFFECTIVE,
+                    messages=[
+                        {"role": "system", "content": prompt_system},
+                        {"role": "user", "content": question},
+                    ],
+                    temperature=temperature,
+                    top_p=1.0,
+                )
+        answer = (completion.choices[0].message.content or "").strip()
+        if cache_key is not None:
+            await ANSWER_CACHE.aset(cache_key, answer)
+        return answer
+    except asyncio.TimeoutError:
+        print(f"[ERROR] timeout OpenAI dopo {timeout or OPENAI_TIMEOUT}s")
+        return "Il motore esterno non ha risposto in tempo. Riprova tra poco."
     except Exception as e:
         print(f"[ERROR] chiamando OpenAI: {e}")
         return "Si è verificato un errore nella chiamata al motore esterno."
 
+
+# task dei produttori di stream: riferimento forte finché sono in esecuzione
+_STREAM_TASKS: Set["asyncio.Task[None]"] = set()
+_STREAM_END = object()
+
+
+async def _produce_openai_stream(
+    prompt_system: str,
+    question: str,
+    temperature: float,
+    deadline: float,
+    queue: "asyncio.Queue[Any]",
+) -> None:
+    """
+    Legge lo stream OpenAI dentro il semaforo e mette i delta nella coda.
+    Il semaforo si libera appena l'upstream ha finito (anche se chi legge la
+    coda è lento); lo stream viene sempre chiuso. Eccezioni e fine stream
+    arrivano al consumatore tramite la coda.
+    """
+    try:
+        # la scadenza comprende anche l'attesa di un posto nel semaforo
+        async with asyncio.timeout_at(deadline):
+            async with llm_semaphore:
+                stream = await client.chat.completions.create(
+                    model=OPENAI_MODEL_EFFECTIVE,
+                    messages=[
+                        {"role": "system", "content": prompt_system},
+                        {"role": "user", "content": question},
+                    ],
+                    temperature=temperature,
+                    top_p=1.0,
+                    stream=True,
+                )
+                try:
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            queue.put_nowait(delta)
+                finally:
+                    await stream.close()
+        queue.put_nowait(_STREAM_END)
+    except Exception as e:
+        queue.put_nowait(e)
+
+
+async def stream_openai(
+    prompt_system: str,
+    question: str,
+    temperature: float = 0.3,
+    timeout: Optional[float] = None,
+    route: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """
+    Come call_openai, ma restituisce i token man mano che arrivano (stream=True).
+    Il timeout vale per l'intera completion (attesa del semaforo compresa),
+    non per il singolo chunk. La lettura da OpenAI avviene in un task separato:
+    il posto nel semaforo non resta occupato mentre il client scarica i token.
+    Con `route` una risposta in cache viene restituita in un solo pezzo.
+    """
+    if client is None:
+        yield "Il motore esterno non è disponibile (OPENAI_API_KEY mancante)."
+        return
+
+    cache_key = None
+    if route and ANSWER_CACHE_ENABLE:
+        cache_key = answer_cache_key(route, prompt_system, question, temperature)
+        cached = await ANSWER_CACHE.aget(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    parts: List[str] = []
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + (timeout or OPENAI_TIMEOUT)
+    queue: "asyncio.Queue[Any]" = asyncio.Queue()
+    producer = asyncio.create_task(
+        _produce_openai_stream(prompt_system, question, temperature, deadline, queue)
+    )
+    _STREAM_TASKS.add(producer)
+    producer.add_done_callback(_STREAM_TASKS.discard)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            parts.append(item)
+            yield item
+        if cache_key is not None:
+            await ANSWER_CACHE.aset(cache_key, "".join(parts).strip())
+    except asyncio.TimeoutError:
+        print(f"[ERROR] timeout OpenAI (stream) dopo {timeout or OPENAI_TIMEOUT}s")
+        yield "\n[Il motore esterno non ha risposto in tempo. Riprova tra poco.]"
+    except Exception as e:
+        print(f"[ERROR] streaming OpenAI: {e}")
+        yield "\n[Si è verificato un errore nella chiamata al motore esterno.]"
+    finally:
+        # client disconnesso o generatore chiuso: interrompe la lettura upstream
+        if not producer.done():
+            producer.cancel()
+
+# ============================================================
+# COMPOSIZIONE RISPOSTE (condivisa da /api/ask e /api/ask/stream)
+# ============================================================
+
+ORACOLO_TITLE_NARRATORE = "📋 ANALISI SITUAZIONE\n\n"
+ORACOLO_TITLE_SUPER = "💡 RISPOSTA TECNICA\n\n"
+ORACOLO_SEPARATOR = f"\n\n{'─' * 40}\n\n"
+
+
+def answer_from_comm(q_norm: str, kb: Optional[KBSnapshot] = None) -> AnswerResponse:
+    kb = kb or KB
+    comm_block = match_comm(q_norm, kb)
+    if comm_block:
+        answer = comm_block.get("response_variants", {}).get("gold", {}).get("it")
+        if not answer:
+            answer = comm_block.get("answer_it") or comm_block.get("answer", "")
+        return AnswerResponse(
+            answer=answer,
+            source="json_comm",
+            meta={"comm_id": comm_block.get("id"), "kb_version": kb.version[:12]},
+        )
+    return AnswerResponse(
+        answer=(
+            "Le informazioni richieste rientrano nei dati aziendali/commerciali. "
+            "Per sicurezza è necessario fare riferimento ai canali ufficiali Tecnaria."
+        ),
+        source="json_comm_fallback",
+        meta={"kb_version": kb.version[:12]},
+    )
+
+
+def sinapsi_override_response(rule: OverrideRule, kb: KBSnapshot) -> AnswerResponse:
+    return AnswerResponse(
+        answer=rule.answer,
+        source="sinapsi_override",
+        meta={
+            "sinapsi_id": rule.id,
+            "sinapsi_file": rule.source,
+            "used_chatgpt": False,
+            "kb_version": kb.version[:12],
+        },
+    )
+
+
+def with_sinapsi_extras(res: AnswerResponse, extras: List[OverrideRule]) -> AnswerResponse:
+    """Risposta del routing + testi delle regole augment/postscript."""
+    if extras:
+        res.answer = apply_extras(res.answer, extras)
+        res.meta["sinapsi_extra"] = [r.id for r in extras]
+    return res
+
+
+def sinapsi_extra_delta(extras: List[OverrideRule], meta: Dict[str, Any]) -> Optional[str]:
+    """Come with_sinapsi_extras per lo stream: delta finale con i testi aggiunti (o None)."""
+    if not extras:
+        return None
+    meta["sinapsi_extra"] = [r.id for r in extras]
+    return sse_event("delta", {"text": "\n\n" + apply_extras("", extras)})
+
+
+def build_contesto_super(question_raw: str, analisi_narratore: str) -> str:
+    return (
+        f"DESCRIZIONE CLIENTE:\n{question_raw}\n\n"
+        f"ANALISI NARRATORE:\n{analisi_narratore}\n\n"
+        f"Ora dai la risposta tecnica completa."
+    )
+
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 # ============================================================
 # ENDPOINTS
 # ============================================================
@@ -380,104 +872,147 @@ async def status():
     """
     Riepilogo rapido dello stato backend.
     """
+    kb = KB
     return {
         "status": "Tecnaria Bot attivo (GOLD only)",
-        "kb_blocks": len(KB_BLOCKS),
-        "comm_blocks": len(COMM_ITEMS),
+        "kb_blocks": len(kb.blocks),
+        "comm_blocks": len(kb.comm_items),
+        "kb_version": kb.version[:12],
+        "kb_loaded_at": kb.loaded_at,
+        "kb_snapshot": KB_SNAPSHOT_PATH if KB_SNAPSHOT_ENABLE else None,
+        "sinapsi_rules": len(kb.overrides),
+        # KB caricata nel master gunicorn (preload) e condivisa con questo worker
+        "kb_shared_from_master": kb.loaded_pid != os.getpid(),
+        "memory": process_memory(),
+        "kb_watch": KB_WATCHER.stats() if KB_WATCH_ENABLE else None,
         "openai_api_key_present": bool(OPENAI_API_KEY),
         "openai_model_env": OPENAI_MODEL_ENV,
-        "openai_model_effective": "gpt-5.1",
+        "openai_model_effective": OPENAI_MODEL_EFFECTIVE,
+        "openai_base_url": OPENAI_BASE_URL or "default",
+        "llm_max_concurrency": LLM_MAX_CONCURRENCY,
+        "kb_fast_path": KB_FAST_PATH_ENABLE,
+        "kb_gold_threshold": KB_GOLD_THRESHOLD,
+        "answer_cache": ANSWER_CACHE.stats() if ANSWER_CACHE_ENABLE else None,
     }
 
 
-@app.post("/api/ask", response_model=AnswerResponse)
-async def api_ask(req: QuestionRequest):
+@app.post("/api/reload")
+async def api_reload():
     """
-    Tre modalità:
-    1. COMM    — domande aziendali/commerciali → COMM.json
-    2. ORACOLO — descrizioni situazionali → Narratore → Superrisponditore
-    3. GOLD    — domande tecniche dirette → GPT GOLD
+    Ricarica subito KB e COMM (senza attendere il watcher).
     """
-    question_raw = (req.question or "").strip()
-    if not question_raw:
-        raise HTTPException(status_code=400, detail="Domanda vuota")
+    try:
+        kb = await asyncio.to_thread(reload_kb)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ricaricamento fallito: {e}")
+    KB_WATCHER.prime()
+    return {"ok": True, "kb_version": kb.version[:12], "kb_blocks": len(kb.blocks), "comm_blocks": len(kb.comm_items)}
 
-    q_norm = question_raw.lower()
 
-    try:
-        # 1) DOMANDE AZIENDALI / COMMERCIALI → SOLO COMM.JSON
-        if is_commercial_question(q_norm):
-            comm_block = match_comm(q_norm)
-            if comm_block:
-                answer = comm_block.get("response_variants", {}).get("gold", {}).get("it")
-                if not answer:
-                    answer = comm_block.get("answer_it") or comm_block.get("answer", "")
-                return AnswerResponse(
-                    answer=answer,
-                    source="json_comm",
-                    meta={"comm_id": comm_block.get("id")},
-                )
-            else:
-                return AnswerResponse(
-                    answer=(
-                        "Le informazioni richieste rientrano nei dati aziendali/commerciali. "
-                        "Per sicurezza è necessario fare riferimento ai canali ufficiali Tecnaria."
-                    ),
-                    source="json_comm_fallback",
-                    meta={},
-                )
+@app.post("/api/cache/clear")
+async def cache_clear():
+    """
+    Svuota la cache risposte (memoria di questo worker + SQLite condiviso).
+    """
+    await asyncio.to_thread(ANSWER_CACHE.clear)
+    return {"ok": True, "answer_cache": ANSWER_CACHE.stats()}
 
-        # 2) DESCRIZIONE SITUAZIONALE → NARRATORE + SUPERRISPONDITORE
-        if is_situational(question_raw):
-            # Step 1: Narratore legge la situazione
-            analisi_narratore = call_openai(
-                SYSTEM_PROMPT_NARRATORE,
-                question_raw,
-                temperature=0.2
-            )
-
-            # Step 2: Superrisponditore risponde con contesto completo
-            contesto_super = (
-                f"DESCRIZIONE CLIENTE:\n{question_raw}\n\n"
-                f"ANALISI NARRATORE:\n{analisi_narratore}\n\n"
-                f"Ora dai la risposta tecnica completa."
-            )
-            risposta_super = call_openai(
-                SYSTEM_PROMPT_SUPERRISPONDITORE,
-                contesto_super,
-                temperature=0.2
-            )
-
-            risposta_finale = (
-                f"📋 ANALISI SITUAZIONE\n\n{analisi_narratore}"
-                f"\n\n{'─' * 40}\n\n"
-                f"💡 RISPOSTA TECNICA\n\n{risposta_super}"
-            )
-
-            return AnswerResponse(
-                answer=risposta_finale,
-                source="oracolo_narratore_superrisponditore",
-                meta={
-                    "narratore": analisi_narratore,
-                    "superrisponditore": risposta_super,
-                    "used_chatgpt": True,
-                },
-            )
 
-        # 3) DOMANDE TECNICHE DIRETTE → CHATGPT GOLD TECNARIA
-        gpt_answer = call_openai(SYSTEM_PROMPT_GOLD, question_raw, temperature=0.2)
-        kb_block = match_from_kb(question_raw)
-        kb_id = kb_block.get("id") if kb_block else None
+async def route_question(question_raw: str, kb: KBSnapshot) -> AnswerResponse:
+    """Routing COMM / ORACOLO / GOLD di /api/ask."""
+    q_norm = question_raw.lower()
+    intents = detect_intents(q_norm)
+
+    # 1) DOMANDE AZIENDALI / COMMERCIALI → SOLO COMM.JSON
+    if INTENT_COMM in intents:
+        return answer_from_comm(q_norm, kb)
+
+    # 2) DESCRIZIONE SITUAZIONALE → NARRATORE + SUPERRISPONDITORE
+    if INTENT_SITUATIONAL in intents:
+        # Step 1: Narratore legge la situazione
+        analisi_narratore = await call_openai(
+            SYSTEM_PROMPT_NARRATORE,
+            question_raw,
+            temperature=0.2,
+            route="oracolo",
+        )
+
+        # Step 2: Superrisponditore risponde con contesto completo
+        risposta_super = await call_openai(
+            SYSTEM_PROMPT_SUPERRISPONDITORE,
+            build_contesto_super(question_raw, analisi_narratore),
+            temperature=0.2,
+            route="oracolo",
+        )
+
+        risposta_finale = (
+            f"{ORACOLO_TITLE_NARRATORE}{analisi_narratore}"
+            f"{ORACOLO_SEPARATOR}"
+            f"{ORACOLO_TITLE_SUPER}{risposta_super}"
+        )
 
         return AnswerResponse(
-            answer=gpt_answer,
-            source="chatgpt_gold_tecnaria",
+            answer=risposta_finale,
+            source="oracolo_narratore_superrisponditore",
             meta={
+                "narratore": analisi_narratore,
+                "superrisponditore": risposta_super,
                 "used_chatgpt": True,
+                "kb_version": kb.version[:12],
+            },
+        )
+
+    # 3) DOMANDE TECNICHE DIRETTE → KB GOLD se confidente, altrimenti CHATGPT GOLD
+    kb_block, kb_confidence, kb_answer = kb_fast_answer(question_raw, kb)
+    kb_id = kb_block.get("id") if kb_block else None
+
+    if kb_answer:
+        return AnswerResponse(
+            answer=kb_answer,
+            source="kb_gold",
+            meta={
+                "used_chatgpt": False,
                 "kb_id": kb_id,
+                "kb_confidence": round(kb_confidence, 3),
+                "kb_version": kb.version[:12],
             },
         )
 
+    gpt_answer = await call_openai(SYSTEM_PROMPT_GOLD, question_raw, temperature=0.2, route="gold")
+
+    return AnswerResponse(
+        answer=gpt_answer,
+        source="chatgpt_gold_tecnaria",
+        meta={
+            "used_chatgpt": True,
+            "kb_id": kb_id,
+            "kb_confidence": round(kb_confidence, 3),
+            "kb_version": kb.version[:12],
+        },
+    )
+
+
+@app.post("/api/ask", response_model=AnswerResponse)
+async def api_ask(req: QuestionRequest):
+    """
+    Regole Sinapsi critiche, poi tre modalità:
+    0. SINAPSI — pattern "override" → risposta curata, nessun routing né LLM
+    1. COMM    — domande aziendali/commerciali → COMM.json
+    2. ORACOLO — descrizioni situazionali → Narratore → Superrisponditore
+    3. GOLD    — domande tecniche dirette → KB GOLD (se confidente) o GPT GOLD
+    Le regole "augment"/"postscript" aggiungono il loro testo alla risposta 1-3.
+    """
+    question_raw = (req.question or "").strip()
+    if not question_raw:
+        raise HTTPException(status_code=400, detail="Domanda vuota")
+
+    kb = KB
+    override, extras = kb.overrides.resolve(question_raw)
+    if override is not None:
+        return sinapsi_override_response(override, kb)
+
+    try:
+        res = await route_question(question_raw, kb)
     except HTTPException:
         raise
     except Exception as e:
@@ -487,3 +1022,132 @@ async def api_ask(req: QuestionRequest):
             source="error",
             meta={"exception": str(e)},
         )
+    return with_sinapsi_extras(res, extras)
+
+
+@app.post("/api/ask/stream")
+async def api_ask_stream(req: QuestionRequest):
+    """
+    Come /api/ask (regole Sinapsi comprese), ma in Server-Sent Events:
+    - event: start   → {"source": ...}
+    - event: section → {"name": ..., "title": ...} (solo Oracolo)
+    - event: delta   → {"text": ...} token man mano che arrivano
+    - event: done    → {"source": ..., "meta": {...}}
+    Per Oracolo viene streamato prima il Narratore, poi il Superrisponditore.
+    """
+    question_raw = (req.question or "").strip()
+    if not question_raw:
+        raise HTTPException(status_code=400, detail="Domanda vuota")
+
+    q_norm = question_raw.lower()
+    intents = detect_intents(q_norm)
+    kb = KB
+    override, extras = kb.overrides.resolve(question_raw)
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            # 0) SINAPSI override → risposta curata in un solo delta
+            if override is not None:
+                res = sinapsi_override_response(override, kb)
+                yield sse_event("start", {"source": res.source})
+                yield sse_event("delta", {"text": res.answer})
+                yield sse_event("done", {"source": res.source, "meta": res.meta})
+                return
+
+            # 1) COMM → risposta intera in un solo delta
+            if INTENT_COMM in intents:
+                res = answer_from_comm(q_norm, kb)
+                yield sse_event("start", {"source": res.source})
+                yield sse_event("delta", {"text": res.answer})
+                extra = sinapsi_extra_delta(extras, res.meta)
+                if extra:
+                    yield extra
+                yield sse_event("done", {"source": res.source, "meta": res.meta})
+                return
+
+            # 2) ORACOLO → Narratore in stream, poi Superrisponditore in stream
+            if INTENT_SITUATIONAL in intents:
+                source = "oracolo_narratore_superrisponditore"
+                yield sse_event("start", {"source": source})
+
+                yield sse_event("section", {"name": "narratore", "title": ORACOLO_TITLE_NARRATORE})
+                parts: List[str] = []
+                async for delta in stream_openai(
+                    SYSTEM_PROMPT_NARRATORE, question_raw, temperature=0.2, route="oracolo"
+                ):
+                    parts.append(delta)
+                    yield sse_event("delta", {"text": delta})
+                analisi_narratore = "".join(parts).strip()
+
+                yield sse_event("section", {
+                    "name": "superrisponditore",
+                    "title": ORACOLO_SEPARATOR + ORACOLO_TITLE_SUPER,
+                })
+                parts = []
+                async for delta in stream_openai(
+                    SYSTEM_PROMPT_SUPERRISPONDITORE,
+                    build_contesto_super(question_raw, analisi_narratore),
+                    temperature=0.2,
+                    route="oracolo",
+                ):
+                    parts.append(delta)
+                    yield sse_event("delta", {"text": delta})
+
+                meta = {
+                    "narratore": analisi_narratore,
+                    "superrisponditore": "".join(parts).strip(),
+                    "used_chatgpt": True,
+                    "kb_version": kb.version[:12],
+                }
+                extra = sinapsi_extra_delta(extras, meta)
+                if extra:
+                    yield extra
+                yield sse_event("done", {"source": source, "meta": meta})
+                return
+
+            # 3) GOLD → KB GOLD se confidente, altrimenti stream diretto
+            kb_block, kb_confidence, kb_answer = kb_fast_answer(question_raw, kb)
+            kb_id = kb_block.get("id") if kb_block else None
+
+            if kb_answer:
+                meta = {
+                    "used_chatgpt": False,
+                    "kb_id": kb_id,
+                    "kb_confidence": round(kb_confidence, 3),
+                    "kb_version": kb.version[:12],
+                }
+                yield sse_event("start", {"source": "kb_gold"})
+                yield sse_event("delta", {"text": kb_answer})
+                extra = sinapsi_extra_delta(extras, meta)
+                if extra:
+                    yield extra
+                yield sse_event("done", {"source": "kb_gold", "meta": meta})
+                return
+
+            source = "chatgpt_gold_tecnaria"
+            yield sse_event("start", {"source": source})
+            async for delta in stream_openai(SYSTEM_PROMPT_GOLD, question_raw, temperature=0.2, route="gold"):
+                yield sse_event("delta", {"text": delta})
+            meta = {
+                "used_chatgpt": True,
+                "kb_id": kb_id,
+                "kb_confidence": round(kb_confidence, 3),
+                "kb_version": kb.version[:12],
+            }
+            extra = sinapsi_extra_delta(extras, meta)
+            if extra:
+                yield extra
+            yield sse_event("done", {"source": source, "meta": meta})
+
+        except Exception as e:
+            print(f"[ERROR] /api/ask/stream: {e}")
+            yield sse_event("error", {
+                "answer": "Si è verificato un problema interno. Contatta l’Ufficio Tecnico Tecnaria.",
+                "exception": str(e),
+            })
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
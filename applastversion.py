@@ -1,9 +1,12 @@
 import os
 import json
 import re
+import heapq
+import threading
+import time
 import unicodedata
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
@@ -13,13 +16,23 @@ from fastapi.responses import FileResponse
 
 from openai import OpenAI
 
+from answer_cache import AnswerCache, fingerprint
+from kb_snapshot import SnapshotStore
+from kb_watcher import FileWatcher, paths_fingerprint
+import lang_id
+from proc_memory import process_memory
+from local_reranker import LocalReranker
+
 # ============================================================
 # CONFIG
 # ============================================================
 
 APP_VERSION = "12.6.0-DIAGNOSTIC-LIMITI"
 
-client = OpenAI()
+# senza chiave il rerank LLM viene saltato (routing solo lessicale/locale);
+# OPENAI_BASE_URL punta a un endpoint compatibile (es. llm_standin.py)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "").strip() or None
+client = OpenAI(base_url=OPENAI_BASE_URL) if os.getenv("OPENAI_API_KEY") else None
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "static", "data")
@@ -27,6 +40,9 @@ STATIC_DIR = os.path.join(BASE_DIR, "static")
 
 MASTER_PATH = os.path.join(DATA_DIR, "ctf_system_COMPLETE_GOLD_master.json")
 OVERLAY_DIR = os.path.join(DATA_DIR, "overlays")
+RERANKER_MODEL_PATH = os.getenv(
+    "RERANKER_MODEL_PATH", os.path.join(DATA_DIR, "models", "reranker_lr.json")
+)
 
 FALLBACK_FAMILY = "COMM"
 FALLBACK_ID = "COMM-FALLBACK-NOANSWER-0001"
@@ -35,6 +51,43 @@ FALLBACK_MESSAGE = (
     "Meglio un confronto diretto con l’ufficio tecnico Tecnaria."
 )
 
+# Rerank AI solo se il leader lessicale non è netto:
+# - RERANK_MARGIN: distacco relativo (leader - secondo) / leader sotto cui si chiama l'LLM
+# - RERANK_WINDOW: nel prompt solo i candidati con score >= leader * (1 - window)
+# - RERANK_MAX_CANDIDATES: tetto ai candidati inviati all'LLM
+RERANK_MARGIN = float(os.getenv("RERANK_MARGIN", "0.25"))
+RERANK_WINDOW = float(os.getenv("RERANK_WINDOW", "0.35"))
+RERANK_MAX_CANDIDATES = int(os.getenv("RERANK_MAX_CANDIDATES", "5"))
+
+# Reranker locale (modello appreso offline, vedi train_reranker.py):
+# - RERANK_MODE: "llm" (default: LLM, senza chiave il leader delle patch v12.x)
+#   | "auto" (locale se il modello c'è, altrimenti LLM) | "local".
+#   Il locale resta opt-in finché train_reranker non lo vede battere il leader
+#   v12.x sulle domande reali etichettate.
+# - RERANK_LLM_FALLBACK=1: LLM solo se la probabilità del migliore < RERANK_LOCAL_MIN_CONF
+RERANK_MODE = os.getenv("RERANK_MODE", "llm").lower()
+RERANK_LLM_FALLBACK = os.getenv("RERANK_LLM_FALLBACK", "0") == "1"
+RERANK_LOCAL_MIN_CONF = float(os.getenv("RERANK_LOCAL_MIN_CONF", "0.5"))
+
+# Cache delle decisioni di rerank LLM: (domanda normalizzata, ID candidati, versione KB).
+# RERANK_CACHE_DB vuoto = solo memoria (niente persistenza tra riavvii).
+RERANK_MODEL = "gpt-4.1-mini"
+RERANK_CACHE_ENABLE = os.getenv("RERANK_CACHE_ENABLE", "1") == "1"
+RERANK_CACHE_DB = os.getenv(
+    "RERANK_CACHE_DB", os.path.join(BASE_DIR, ".cache", "rerank_cache.sqlite3")
+)
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", str(30 * 86400)))
+RERANK_CACHE_MAX_ITEMS = int(os.getenv("RERANK_CACHE_MAX_ITEMS", "4096"))
+
+# Ricaricamento a caldo: master + overlays controllati ogni KB_WATCH_INTERVAL secondi
+KB_WATCH_ENABLE = os.getenv("KB_WATCH_ENABLE", "1") == "1"
+KB_WATCH_INTERVAL = float(os.getenv("KB_WATCH_INTERVAL", "2"))
+
+# Artefatto KB precompilato (kb_snapshot.py, sezione "gold"): blocchi già compilati
+KB_SNAPSHOT_ENABLE = os.getenv("KB_SNAPSHOT_ENABLE", "1") == "1"
+KB_SNAPSHOT_PATH = os.getenv("KB_SNAPSHOT_PATH", os.path.join(BASE_DIR, ".cache", "kb_snapshot.bin"))
+KB_SNAPSHOT_REBUILD = os.getenv("KB_SNAPSHOT_REBUILD", "0") == "1"
+
 # ============================================================
 # FASTAPI
 # ============================================================
@@ -68,6 +121,7 @@ def index():
 
 class AskRequest(BaseModel):
     question: str
+    # lingua suggerita dal client: usata solo se il riconoscimento locale non è sicuro
     lang: str = "it"
     mode: str = "gold"
 
@@ -80,6 +134,7 @@ class AskResponse(BaseModel):
     mode: str
     lang: str
     score: float
+    kb_version: str = ""
 
 
 # ============================================================
@@ -136,108 +191,411 @@ def load_overlay_blocks() -> List[Dict[str, Any]]:
 
 
 # ============================================================
-# STATE
+# TERMINI PATCH v12.2–v12.6 (rerank)
 # ============================================================
 
-class KBState:
-    master_blocks: List[Dict[str, Any]] = []
-    overlay_blocks: List[Dict[str, Any]] = []
+# Lato domanda (*_TERMS / NEG_PATTERNS)
+# e lato blocco (BLOCK_* / DIAGNOSTIC_KILLER_* / LIMITS_BLOCK_ID).
+DIAGNOSTIC_TERMS = [
+    "come verifico", "come faccio a verificare",
+    "come controllo", "come faccio a controllare",
+    "come faccio a capire se", "come posso capire se",
+    "come posso verificare", "come si verifica",
+    "come si controlla", "verificare se", "controllare se",
+    "come faccio a sapere se", "come posso essere sicuro",
+    "come posso essere certa", "come posso essere certo",
+    "come faccio a essere sicuro", "come faccio a essere certo"
+]
+
+LIMIT_TERMS = [
+    "in quali casi non posso usare i ctf",
+    "in quali casi non posso usare i ctf su lamiera",
+    "quando non posso usare i ctf",
+    "quando non è possibile usare i ctf",
+    "limiti di applicazione dei ctf",
+    "casi in cui i ctf non sono ammessi",
+    "quando i ctf sono fuori campo",
+]
+
+STRUCTURAL_TERMS = [
+    "spessa", "spessore", "spess", "1 2", "1 5", "2 0",
+    "due lamiere", "doppia lamiera", "lamiera doppia", "sovrappost",
+    "propulsore forte", "propulsore molto forte",
+    "classe alta", "potenza alta",
+    "fuori eta", "fuori campo", "non coperto", "coperto dalle prestazioni",
+    "prestazioni dichiarate",
+    "prove tecnaria", "non rappresentativo",
+    "deformazione non rappresentativa",
+]
+
+NEG_PATTERNS = [
+    "non posso", "in quali casi non", "quando non posso",
+    "quando non si puo", "non e valido", "non e ammesso",
+    "non si deve", "non coperto", "non rappresentativo",
+]
+
+GEOMETRY_TERMS = [
+    "lamiera", "ondina", "onda", "ala", "imbarcata",
+    "laminazione", "rigonfiamento", "bombatura",
+    "rigidita", "rigidezza"
+]
+
+DEFECT_TERMS = [
+    "chiodo", "chiodi", "punta", "danneggiata",
+    "danneggiato", "difettoso", "difettosi"
+]
+
+# Killer strutturali
+BLOCK_STRUCTURAL_KEYS = [
+    "spesso", "spessore", "fuori campo", "fuori eta",
+    "doppia lamiera", "due lamiere", "lamiera sovrapposta",
+    "non rappresentativa", "prove tecnaria",
+    "sovra infissione", "sovra-infissione", "propulsore",
+    "rigidezza aumentata", "rigidita aumentata"
+]
+
+# Killer ambientali (da escludere nei casi strutturali)
+BLOCK_AMBIENT_KEYS = [
+    "ghiaccio", "acqua", "condensa", "bagnata", "umidita",
+    "vibrazione", "vibra", "puntale scivola",
+    "sporco", "residui", "clack",
+]
+
+BLOCK_KILLER_KEYS = [
+    "errore", "fuori campo", "non valido", "non ammesso",
+    "sovra infissione", "sovra-infissione", "deformazione anomala"
+]
+
+DIAGNOSTIC_KILLER_ID_TAGS = ["ERR", "KILLER", "LIMITE", "LIMITI"]
+
+DIAGNOSTIC_KILLER_TERMS = [
+    "errore", "errore di posa", "fuori campo",
+    "non valido", "non ammesso", "da considerarsi non valido",
+    "difetto", "difettoso", "anomalia", "anomala",
+    "sovra infissione", "sovra-infissione",
+    "deformazione anomala", "colpo non valido",
+    "testa schiacciata", "propulsore eccessivo"
+]
+
+LIMITS_BLOCK_ID = "LIMITI-APPLICAZIONE-LAMIERA"
+
+# Classi dei blocchi, calcolate una volta al load come bit (vedi classify_block):
+# (nome, campi del blocco su cui cercare i termini, termini, tag cercati nell'id)
+BLOCK_CLASSES = [
+    ("structural", ("question_it", "triggers"), BLOCK_STRUCTURAL_KEYS, ()),
+    ("ambient", ("question_it", "triggers"), BLOCK_AMBIENT_KEYS, ()),
+    ("killer", ("question_it", "triggers"), BLOCK_KILLER_KEYS, ()),
+    ("defect", ("id", "question_it", "triggers"), DEFECT_TERMS, ()),
+    ("geometry", ("id", "question_it", "triggers"), GEOMETRY_TERMS, ()),
+    ("diag_killer", ("id", "question_it", "triggers", "tags"),
+     DIAGNOSTIC_KILLER_TERMS, DIAGNOSTIC_KILLER_ID_TAGS),
+    ("limits", (), (), (LIMITS_BLOCK_ID,)),
+]
+B = {name: 1 << i for i, (name, _, _, _) in enumerate(BLOCK_CLASSES)}
+
+# Classi della domanda (una volta per richiesta)
+QUESTION_CLASSES = [
+    ("diagnostic", DIAGNOSTIC_TERMS),   # v12.5
+    ("limits", LIMIT_TERMS),            # v12.6
+    ("structural", STRUCTURAL_TERMS),   # v12.4
+    ("negation", NEG_PATTERNS),         # v12.3
+    ("geometry", GEOMETRY_TERMS),       # v12.2
+]
+Q = {name: 1 << i for i, (name, _) in enumerate(QUESTION_CLASSES)}
+
+# Patch v12.x come tabella di regole, applicate in ordine.
+# (patch, classe domanda, azione, bit richiesti nel blocco, bit esclusi)
+# - keep:   tieni solo i blocchi che soddisfano la condizione
+# - drop:   scarta i blocchi che la soddisfano
+# - prefer: porta in testa i blocchi che la soddisfano
+# Se un'azione lascerebbe zero candidati, i candidati restano invariati.
+RERANK_RULES = [
+    ("v12.4", Q["structural"], "keep", B["structural"], B["ambient"]),
+    ("v12.3", Q["negation"], "keep", B["killer"], 0),
+    ("v12.2", Q["geometry"], "drop", B["defect"], B["geometry"]),
+    ("v12.5", Q["diagnostic"], "drop", B["diag_killer"], 0),
+    ("v12.6", Q["limits"], "prefer", B["limits"], 0),
+]
 
 
-S = KBState()
+# ============================================================
+# INDICE DI SCORING PRECOMPILATO
+# ============================================================
 
+def compile_block(block: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Precompila un blocco per lo scoring (una volta sola, in reload_all):
+    - triggers: (token frozenset, trigger normalizzato, n. token)
+    - q_it_tokens: token di question_it
+    - is_overview: id contiene OVERVIEW
+    Patch v12.1: i trigger con UNA SOLA PAROLA (es. 'ctf', 'posare')
+    vengono scartati qui perché troppo generici e rumorosi.
+    """
+    triggers = []
+    for trigger in block.get("triggers", []) or []:
+        trig_norm = normalize(trigger)
+        if not trig_norm:
+            continue
+        trig_tokens = frozenset(trig_norm.split())
+        if len(trig_tokens) <= 1:
+            continue
+        triggers.append((trig_tokens, trig_norm, len(trig_tokens)))
 
-def reload_all():
-    S.master_blocks = load_master_blocks()
-    S.overlay_blocks = load_overlay_blocks()
-    print(f"[KB LOADED] master={len(S.master_blocks)} overlay={len(S.overlay_blocks)}")
+    q_it = block.get("question_it") or ""
+    return {
+        "block": block,
+        "triggers": triggers,
+        "q_it_tokens": frozenset(tokenize(q_it)) if q_it else frozenset(),
+        "is_overview": "OVERVIEW" in (block.get("id") or "").upper(),
+        "mask": classify_block(block),
+    }
 
 
-reload_all()
+def block_text(block: Dict[str, Any], fields) -> str:
+    parts = []
+    for f in fields:
+        v = block.get(f)
+        if isinstance(v, list):
+            v = " ".join(v)
+        parts.append(v or "")
+    return normalize(" ".join(parts))
+
+
+def classify_block(block: Dict[str, Any]) -> int:
+    """Bitmask delle classi BLOCK_CLASSES del blocco (calcolata una volta al load)."""
+    bid_upper = (block.get("id") or "").upper()
+    texts: Dict[Tuple[str, ...], str] = {}
+    mask = 0
+    for name, fields, terms, id_tags in BLOCK_CLASSES:
+        hit = any(tag in bid_upper for tag in id_tags)
+        if not hit and terms:
+            if fields not in texts:
+                texts[fields] = block_text(block, fields)
+            hit = any(t in texts[fields] for t in terms)
+        if hit:
+            mask |= B[name]
+    return mask
+
+
+def question_mask(q_norm: str) -> int:
+    """Bitmask delle classi QUESTION_CLASSES della domanda normalizzata."""
+    mask = 0
+    for name, terms in QUESTION_CLASSES:
+        if any(t in q_norm for t in terms):
+            mask |= Q[name]
+    return mask
 
 
 # ============================================================
-# MATCHING ENGINE (LESSIC + AI RERANK) – v12.6.0
+# STATE
 # ============================================================
 
-def score_trigger(trigger: str, q_tokens: set, q_norm: str) -> float:
+class KBState:
     """
-    Punteggio di un singolo trigger.
-    Patch v12.1: i trigger con UNA SOLA PAROLA (es. 'ctf', 'posare')
-    vengono ignorati perché troppo generici e rumorosi.
+    Snapshot della KB compilata. Non si modifica mai dopo la costruzione:
+    un ricaricamento ne costruisce uno nuovo e lo pubblica riassegnando S,
+    così ogni richiesta lavora su una sola versione coerente.
     """
-    trig_norm = normalize(trigger)
-    if not trig_norm:
-        return 0.0
 
-    trig_tokens = set(trig_norm.split())
+    def __init__(
+        self,
+        master_blocks: Optional[List[Dict[str, Any]]] = None,
+        overlay_blocks: Optional[List[Dict[str, Any]]] = None,
+        kb_version: str = "",
+    ) -> None:
+        self.master_blocks = master_blocks or []
+        self.overlay_blocks = overlay_blocks or []
+        # indice di scoring precompilato (vedi compile_block)
+        self.master_index = [compile_block(b) for b in self.master_blocks]
+        self.overlay_index = [compile_block(b) for b in self.overlay_blocks]
+        self.compiled_by_id: Dict[str, Dict[str, Any]] = {
+            cb["block"].get("id"): cb for cb in self.master_index + self.overlay_index
+        }
+        self.kb_version = kb_version
+        self.loaded_at = time.time()
+        self.loaded_pid = os.getpid()
+
+    @classmethod
+    def from_compiled(cls, payload: Dict[str, Any], kb_version: str) -> "KBState":
+        """Snapshot dall'artefatto precompilato: compile_block non viene rieseguito."""
+        snap = cls.__new__(cls)
+        snap.master_blocks = payload["master_blocks"]
+        snap.overlay_blocks = payload["overlay_blocks"]
+        compiled = []
+        for block, (triggers, q_it_tokens, is_overview, mask) in zip(
+            snap.master_blocks + snap.overlay_blocks, payload["compiled"]
+        ):
+            compiled.append({
+                "block": block,
+                "triggers": [(frozenset(t), norm, n) for t, norm, n in triggers],
+                "q_it_tokens": frozenset(q_it_tokens),
+                "is_overview": is_overview,
+                "mask": mask,
+            })
+        snap.master_index = compiled[:len(snap.master_blocks)]
+        snap.overlay_index = compiled[len(snap.master_blocks):]
+        snap.compiled_by_id = {cb["block"].get("id"): cb for cb in compiled}
+        snap.kb_version = kb_version
+        snap.loaded_at = time.time()
+        snap.loaded_pid = os.getpid()
+        return snap
+
+    def to_compiled(self) -> Dict[str, Any]:
+        return {
+            "master_blocks": self.master_blocks,
+            "overlay_blocks": self.overlay_blocks,
+            "compiled": [
+                [
+                    [[sorted(t), norm, n] for t, norm, n in cb["triggers"]],
+                    sorted(cb["q_it_tokens"]),
+                    cb["is_overview"],
+                    cb["mask"],
+                ]
+                for cb in self.master_index + self.overlay_index
+            ],
+        }
 
-    # Trigger troppo generici (una sola parola) → li ignoriamo
-    if len(trig_tokens) <= 1:
-        return 0.0
 
-    score = 0.0
+S = KBState()
+_RELOAD_LOCK = threading.Lock()
+KB_STORE = SnapshotStore(KB_SNAPSHOT_PATH if KB_SNAPSHOT_ENABLE else None)
 
-    # 1) token match totale
-    if trig_tokens.issubset(q_tokens):
-        score += 3.0
+# firma del codice che compila i blocchi: le classi v12.x entrano nella maschera
+GOLD_INDEX_FORMAT = fingerprint(["gold-index-1", repr(BLOCK_CLASSES)])
 
-    # 2) match parziale > metà token
-    inter = trig_tokens.intersection(q_tokens)
-    if len(inter) >= max(1, len(trig_tokens) // 2):
-        score += len(inter) / len(trig_tokens)
+RERANK_CACHE = AnswerCache(
+    RERANK_CACHE_DB or None,
+    max_items=RERANK_CACHE_MAX_ITEMS,
+    ttl=RERANK_CACHE_TTL,
+)
 
-    # 3) substring significativa
-    if len(trig_norm) >= 10 and trig_norm in q_norm:
-        score += 0.5
 
-    return score
+def kb_paths() -> List[str]:
+    return [MASTER_PATH] + sorted(str(f) for f in Path(OVERLAY_DIR).glob("*.json"))
 
 
-def score_block(question: str, block: Dict[str, Any]) -> float:
+def kb_fingerprint() -> str:
+    return paths_fingerprint(kb_paths())
+
+
+def load_snapshot() -> KBState:
+    """Dall'artefatto precompilato se aggiornato, altrimenti dai JSON (e lo riscrive)."""
+    version = kb_fingerprint()
+    source_hash = fingerprint([version, GOLD_INDEX_FORMAT])
+    if KB_SNAPSHOT_ENABLE and not KB_SNAPSHOT_REBUILD:
+        payload = KB_STORE.load("gold", source_hash)
+        if payload is not None:
+            return KBState.from_compiled(payload, version)
+
+    snap = KBState(load_master_blocks(), load_overlay_blocks(), version)
+    if KB_SNAPSHOT_ENABLE:
+        KB_STORE.save("gold", source_hash, snap.to_compiled())
+    return snap
+
+
+def reload_all() -> KBState:
     """
-    Punteggio complessivo di un blocco:
+    Costruisce un nuovo snapshot completo (fuori dal percorso delle richieste)
+    e lo pubblica con un solo assegnamento: chi ha già letto S continua sul vecchio.
+    """
+    global S
+    with _RELOAD_LOCK:
+        snap = load_snapshot()
+        S = snap
+        if RERANK_CACHE_ENABLE:
+            RERANK_CACHE.set_version(snap.kb_version)
+    print(
+        f"[KB LOADED] master={len(snap.master_blocks)} overlay={len(snap.overlay_blocks)} "
+        f"version={snap.kb_version[:12]}"
+    )
+    return snap
+
+
+reload_all()
+
+KB_WATCHER = FileWatcher("KB GOLD", kb_paths, reload_all, KB_WATCH_INTERVAL)
+
+
+# ============================================================
+# MATCHING ENGINE (LESSIC + AI RERANK) – v12.6.0
+# ============================================================
+
+def score_compiled(cb: Dict[str, Any], q_tokens: set, q_norm: str) -> float:
+    """
+    Punteggio complessivo di un blocco precompilato:
     - somma dei punteggi trigger
     - + similarità domanda_utente vs question_it del blocco
     """
-    q_norm = normalize(question)
-    q_tokens = set(tokenize(question))
-
     # trigger score
     trig_score = 0.0
-    for trigger in block.get("triggers", []) or []:
-        trig_score += score_trigger(trigger, q_tokens, q_norm)
+    for trig_tokens, trig_norm, n in cb["triggers"]:
+        # 1) token match totale
+        if trig_tokens <= q_tokens:
+            trig_score += 3.0
 
-    # question_it similarity
-    q_it = block.get("question_it") or ""
-    q_it_tokens = set(tokenize(q_it)) if q_it else set()
+        # 2) match parziale > metà token
+        inter = len(trig_tokens & q_tokens)
+        if inter >= max(1, n // 2):
+            trig_score += inter / n
 
+        # 3) substring significativa
+        if len(trig_norm) >= 10 and trig_norm in q_norm:
+            trig_score += 0.5
+
+    # question_it similarity
     sim_score = 0.0
+    q_it_tokens = cb["q_it_tokens"]
     if q_it_tokens:
-        inter = q_tokens.intersection(q_it_tokens)
+        inter = len(q_tokens & q_it_tokens)
         if inter:
-            sim_score = len(inter) / len(q_it_tokens)
+            sim_score = inter / len(q_it_tokens)
             sim_score *= 3.0  # peso forte
 
     total = trig_score + sim_score
 
     # penalizza overview se ci sono candidati più specifici
-    if "OVERVIEW" in (block.get("id") or "").upper():
+    if cb["is_overview"]:
         total *= 0.5
 
     return total
 
 
-def lexical_candidates(question: str, blocks: List[Dict[str, Any]], limit: int = 15):
-    scored: List[Tuple[float, Dict[str, Any]]] = []
+def score_block(question: str, block: Dict[str, Any]) -> float:
+    """Punteggio di un blocco non precompilato (debug / uso puntuale)."""
+    return score_compiled(compile_block(block), set(tokenize(question)), normalize(question))
+
+
+def top_k(scored: List[Tuple[float, Dict[str, Any]]], limit: int) -> List[Tuple[float, Dict[str, Any]]]:
+    # nlargest è stabile: a parità di punteggio resta l'ordine della KB
+    return heapq.nlargest(limit, scored, key=lambda x: x[0])
+
+
+def lexical_candidates(question: str, limit: int = 15, snap: Optional[KBState] = None):
+    """
+    Generatore candidati in un solo passaggio su tutti i livelli:
+    domanda normalizzata una volta, ogni blocco valutato una volta.
+    Ritorna (overlay, overview, master), ciascuno top-k [(score, block)].
+    """
+    snap = snap or S
+    q_norm = normalize(question)
+    q_tokens = set(tokenize(question))
 
-    for block in blocks:
-        s = score_block(question, block)
+    overlay: List[Tuple[float, Dict[str, Any]]] = []
+    for cb in snap.overlay_index:
+        s = score_compiled(cb, q_tokens, q_norm)
         if s > 0:
-            scored.append((s, block))
+            overlay.append((s, cb["block"]))
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return scored[:limit]
+    master: List[Tuple[float, Dict[str, Any]]] = []
+    overview: List[Tuple[float, Dict[str, Any]]] = []
+    for cb in snap.master_index:
+        s = score_compiled(cb, q_tokens, q_norm)
+        if s > 0:
+            master.append((s, cb["block"]))
+            if cb["is_overview"]:
+                overview.append((s, cb["block"]))
+
+    return top_k(overlay, limit), top_k(overview, limit), top_k(master, limit)
 
 
 def is_overview_question(q_norm: str) -> bool:
@@ -253,12 +611,24 @@ def is_overview_question(q_norm: str) -> bool:
 
 
 # ============================================================
-# RERANK AI – v12.6 con DIAGNOSTIC SAFE + LIMITI
+# PATCH v12.2–v12.6
 # ============================================================
 
-def ai_rerank(question: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]:
+def block_mask(block: Dict[str, Any], snap: Optional[KBState] = None) -> int:
+    cb = (snap or S).compiled_by_id.get(block.get("id"))
+    if cb is not None and cb["block"] is block:
+        return cb["mask"]
+    return classify_block(block)
+
+
+def apply_rerank_heuristics(
+    q_norm: str,
+    candidates: List[Dict[str, Any]],
+    snap: Optional[KBState] = None,
+) -> List[Dict[str, Any]]:
     """
-    Usa l'AI SOLO per scegliere l'ID tra i candidati.
+    Filtri/ordinamenti deterministici prima della scelta finale,
+    valutati come operazioni su bitmask (RERANK_RULES).
 
     Patch v12.2 STRADA A: geometria vs chiodi difettosi.
     Patch v12.3: negazioni → killer.
@@ -272,211 +642,198 @@ def ai_rerank(question: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]
     Patch v12.6 LIMITI:
       per domande 'in quali casi non posso usare...' preferire il blocco limiti di applicazione.
     """
-    if not candidates:
-        return None
-    if len(candidates) == 1:
-        return candidates[0]
-
-    q_norm = normalize(question)
-
-    # -------------------------
-    # Riconoscimento domande DIAGNOSTICHE (v12.5)
-    # -------------------------
-    diagnostic_terms = [
-        "come verifico", "come faccio a verificare",
-        "come controllo", "come faccio a controllare",
-        "come faccio a capire se", "come posso capire se",
-        "come posso verificare", "come si verifica",
-        "come si controlla", "verificare se", "controllare se",
-        "come faccio a sapere se", "come posso essere sicuro",
-        "come posso essere certa", "come posso essere certo",
-        "come faccio a essere sicuro", "come faccio a essere certo"
-    ]
-    question_is_diagnostic = any(t in q_norm for t in diagnostic_terms)
+    qmask = question_mask(q_norm)
+    if not qmask:
+        return candidates
+
+    snap = snap or S
+    items = [(b, block_mask(b, snap)) for b in candidates]
+    for _, qbit, action, all_of, none_of in RERANK_RULES:
+        if not qmask & qbit:
+            continue
+        hit = [(m & all_of) == all_of and not m & none_of for _, m in items]
+        if action == "keep":
+            selected = [it for it, h in zip(items, hit) if h]
+        elif action == "drop":
+            selected = [it for it, h in zip(items, hit) if not h]
+        elif any(hit):  # prefer
+            selected = [it for it, h in zip(items, hit) if h] + [it for it, h in zip(items, hit) if not h]
+        else:
+            selected = []
+        if selected:
+            items = selected
+
+    return [b for b, _ in items]
 
-    # -------------------------
-    # Riconoscimento domande sui LIMITI CTF (v12.6)
-    # -------------------------
-    limit_terms = [
-        "in quali casi non posso usare i ctf",
-        "in quali casi non posso usare i ctf su lamiera",
-        "quando non posso usare i ctf",
-        "quando non è possibile usare i ctf",
-        "limiti di applicazione dei ctf",
-        "casi in cui i ctf non sono ammessi",
-        "quando i ctf sono fuori campo",
-    ]
-    question_is_limits = any(t in q_norm for t in limit_terms)
-
-    # -------------------------
-    # PATCH 12.4: riconoscimento "caso strutturale"
-    # -------------------------
-
-    structural_terms = [
-        "spessa", "spessore", "spess", "1 2", "1 5", "2 0",
-        "due lamiere", "doppia lamiera", "lamiera doppia", "sovrappost",
-        "propulsore forte", "propulsore molto forte",
-        "classe alta", "potenza alta",
-        "fuori eta", "fuori campo", "non coperto", "coperto dalle prestazioni",
-        "prestazioni dichiarate",
-        "prove tecnaria", "non rappresentativo",
-        "deformazione non rappresentativa",
-    ]
 
-    question_is_structural = any(t in q_norm for t in structural_terms)
-
-    if question_is_structural:
-        structural_killers = []
-        others = []
+# ============================================================
+# RERANK LOCALE (modello appreso offline)
+# ============================================================
 
-        for b in candidates:
-            text_block = (b.get("question_it") or "") + " " + " ".join(b.get("triggers") or [])
-            tb_norm = normalize(text_block)
+RERANK_FEATURES = [
+    "score_rel", "rank_inv", "heuristic_first",
+    "trig_full", "trig_partial", "qit_recall", "qit_precision",
+    "overview", "family_mentioned",
+    "structural_match", "negation_match", "geometry_conflict",
+    "diagnostic_conflict", "limits_match",
+]
+
+
+def rerank_features(
+    q_norm: str,
+    candidates: List[Dict[str, Any]],
+    scores: Optional[Dict[str, float]] = None,
+    snap: Optional[KBState] = None,
+) -> List[List[float]]:
+    """
+    Una riga di feature per candidato (ordine = RERANK_FEATURES).
+    I candidati sono quelli già passati da apply_rerank_heuristics.
+    """
+    snap = snap or S
+    scores = scores or {}
+    q_tokens = set(q_norm.split(" "))
+    qmask = question_mask(q_norm)
+
+    cand_scores = [scores.get(b.get("id"), 0.0) for b in candidates]
+    top = max(cand_scores) if cand_scores else 0.0
+    order = sorted(range(len(candidates)), key=lambda i: -cand_scores[i])
+    rank = {i: r for r, i in enumerate(order)}
+
+    rows: List[List[float]] = []
+    for i, b in enumerate(candidates):
+        cb = snap.compiled_by_id.get(b.get("id"))
+        if cb is None or cb["block"] is not b:
+            cb = compile_block(b)
+        m = cb["mask"]
+
+        full = 0
+        partial = 0.0
+        for trig_tokens, _, n in cb["triggers"]:
+            inter = len(trig_tokens & q_tokens)
+            if inter == n:
+                full += 1
+            partial = max(partial, inter / n)
+
+        q_it_tokens = cb["q_it_tokens"]
+        inter_q = len(q_tokens & q_it_tokens)
+        family = (b.get("family") or "").lower().split("_")[0]
+        id_head = (b.get("id") or "").lower().split("-")[0].split("_")[0]
+
+        rows.append([
+            cand_scores[i] / top if top > 0 else 0.0,
+            1.0 / (1.0 + rank[i]),
+            1.0 if i == 0 else 0.0,
+            min(full, 3) / 3.0,
+            partial,
+            inter_q / len(q_it_tokens) if q_it_tokens else 0.0,
+            inter_q / len(q_tokens) if q_tokens else 0.0,
+            1.0 if cb["is_overview"] else 0.0,
+            1.0 if (family in q_tokens or id_head in q_tokens) else 0.0,
+            1.0 if qmask & Q["structural"] and m & B["structural"] and not m & B["ambient"] else 0.0,
+            1.0 if qmask & Q["negation"] and m & B["killer"] else 0.0,
+            1.0 if qmask & Q["geometry"] and m & B["defect"] and not m & B["geometry"] else 0.0,
+            1.0 if qmask & Q["diagnostic"] and m & B["diag_killer"] else 0.0,
+            1.0 if qmask & Q["limits"] and m & B["limits"] else 0.0,
+        ])
+    return rows
+
+
+LOCAL_RERANKER = (
+    LocalReranker.load(RERANKER_MODEL_PATH, RERANK_FEATURES)
+    if RERANK_MODE != "llm" else None
+)
+if LOCAL_RERANKER is not None:
+    print(f"[RERANKER] modello locale caricato: {RERANKER_MODEL_PATH}")
 
-            # Killer strutturali
-            is_structural = any(key in tb_norm for key in [
-                "spesso", "spessore", "fuori campo", "fuori eta",
-                "doppia lamiera", "due lamiere", "lamiera sovrapposta",
-                "non rappresentativa", "prove tecnaria",
-                "sovra infissione", "sovra-infissione", "propulsore",
-                "rigidezza aumentata", "rigidita aumentata"
-            ])
+# modello lid.176.ftz caricato qui: con il preload di gunicorn lo condividono i worker
+lang_id.is_ready()
 
-            # Killer ambientali da ESCLUDERE
-            is_ambient = any(key in tb_norm for key in [
-                "ghiaccio", "acqua", "condensa", "bagnata", "umidita",
-                "vibrazione", "vibra", "puntale scivola",
-                "sporco", "residui", "clack",
-            ])
 
-            if is_structural and not is_ambient:
-                structural_killers.append(b)
-            else:
-                others.append(b)
+# ============================================================
+# RERANK AI – v12.6 con DIAGNOSTIC SAFE + LIMITI
+# ============================================================
 
-        if structural_killers:
-            candidates = structural_killers
+def rerank_shortlist(
+    q_norm: str,
+    candidates: List[Dict[str, Any]],
+    scores: Optional[Dict[str, float]] = None,
+    snap: Optional[KBState] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Candidati che arrivano davvero al reranker (locale o LLM): patch v12.x,
+    poi gate sul margine e finestra sui punteggi. Un solo elemento = scelta
+    già fatta. Usata anche da train_reranker, così il modello viene
+    addestrato e valutato sugli stessi casi che vede in produzione.
+    """
+    candidates = apply_rerank_heuristics(q_norm, candidates, snap)
+    if len(candidates) <= 1 or not scores:
+        return candidates
 
     # -------------------------
-    # PATCH 12.3: negazioni → killer
+    # GATE MARGINE: LLM solo se il distacco del leader è sotto RERANK_MARGIN
     # -------------------------
-    neg_patterns = [
-        "non posso", "in quali casi non", "quando non posso",
-        "quando non si puo", "non e valido", "non e ammesso",
-        "non si deve", "non coperto", "non rappresentativo",
+    leader = candidates[0]
+    lead_score = scores.get(leader.get("id"), 0.0)
+    next_score = max(scores.get(b.get("id"), 0.0) for b in candidates[1:])
+    if lead_score > 0 and (lead_score - next_score) >= RERANK_MARGIN * lead_score:
+        return [leader]
+
+    # prompt ridotto ai soli candidati vicini al leader
+    floor = max(lead_score, next_score) * (1.0 - RERANK_WINDOW)
+    close = [leader] + [
+        b for b in candidates[1:] if scores.get(b.get("id"), 0.0) >= floor
     ]
-    if any(p in q_norm for p in neg_patterns):
-        killer_like = []
-        others = []
-        for b in candidates:
-            tb_norm = normalize(
-                (b.get("question_it") or "") + " " +
-                " ".join(b.get("triggers") or [])
-            )
-            if any(k in tb_norm for k in [
-                "errore", "fuori campo", "non valido", "non ammesso",
-                "sovra infissione", "sovra-infissione", "deformazione anomala"
-            ]):
-                killer_like.append(b)
-            else:
-                others.append(b)
-
-        if killer_like:
-            candidates = killer_like
+    return close[:max(1, RERANK_MAX_CANDIDATES)]
 
-    # -------------------------
-    # PATCH STRADA A (12.2): geometria vs chiodi difettosi
-    # -------------------------
 
-    geometry_terms = [
-        "lamiera", "ondina", "onda", "ala", "imbarcata",
-        "laminazione", "rigonfiamento", "bombatura",
-        "rigidita", "rigidezza"
-    ]
-    defect_terms = [
-        "chiodo", "chiodi", "punta", "danneggiata",
-        "danneggiato", "difettoso", "difettosi"
-    ]
-    question_is_geometry = any(t in q_norm for t in geometry_terms)
-
-    if question_is_geometry:
-        geometric = []
-        for b in candidates:
-            tb_norm = normalize(
-                (b.get("id") or "") + " " +
-                (b.get("question_it") or "") + " " +
-                " ".join(b.get("triggers") or [])
-            )
-            has_defect = any(t in tb_norm for t in defect_terms)
-            has_geometry = any(t in tb_norm for t in geometry_terms)
-
-            if has_defect and not has_geometry:
-                continue
-            geometric.append(b)
-        if geometric:
-            candidates = geometric
+def ai_rerank(
+    question: str,
+    candidates: List[Dict[str, Any]],
+    scores: Optional[Dict[str, float]] = None,
+    snap: Optional[KBState] = None,
+) -> Dict[str, Any]:
+    """
+    Sceglie l'ID tra i candidati: patch v12.x (apply_rerank_heuristics),
+    poi reranker locale se disponibile, altrimenti AI.
+    `scores` (id blocco → punteggio lessicale) abilita il gate sul margine:
+    con un leader netto né il modello né l'LLM vengono interpellati.
+    Con RERANK_LLM_FALLBACK=1 l'LLM interviene solo se il modello locale è incerto.
+    `snap` è lo snapshot KB da cui vengono i candidati (default: quello corrente).
+    """
+    if not candidates:
+        return None
+    if len(candidates) == 1:
+        return candidates[0]
 
-    # -------------------------
-    # PATCH 12.5: domande DIAGNOSTICHE → escludi killer
-    # -------------------------
-    if question_is_diagnostic:
-        safe_candidates = []
-        for b in candidates:
-            combined_text = " ".join(filter(None, [
-                b.get("id") or "",
-                b.get("question_it") or "",
-                " ".join(b.get("triggers") or []),
-                " ".join(b.get("tags") or []),
-            ]))
-            tb_norm = normalize(combined_text)
-
-            is_killer_like = False
-
-            # ID che contengono pattern di errore
-            if any(tag in (b.get("id") or "").upper() for tag in ["ERR", "KILLER", "LIMITE", "LIMITI"]):
-                is_killer_like = True
-
-            # Testo che parla di errore / non valido / fuori campo / difetto
-            killer_terms = [
-                "errore", "errore di posa", "fuori campo",
-                "non valido", "non ammesso", "da considerarsi non valido",
-                "difetto", "difettoso", "anomalia", "anomala",
-                "sovra infissione", "sovra-infissione",
-                "deformazione anomala", "colpo non valido",
-                "testa schiacciata", "propulsore eccessivo"
-            ]
-            if any(term in tb_norm for term in killer_terms):
-                is_killer_like = True
-
-            if not is_killer_like:
-                safe_candidates.append(b)
-
-        # Se abbiamo almeno un candidato “sicuro”, usiamo solo quelli
-        if safe_candidates:
-            candidates = safe_candidates
+    q_norm = normalize(question)
+    candidates = rerank_shortlist(q_norm, candidates, scores, snap)
+    if len(candidates) == 1:
+        return candidates[0]
 
     # -------------------------
-    # PATCH 12.6: domande sui LIMITI → preferisci blocco limiti applicazione
+    # RERANK LOCALE
     # -------------------------
-    if question_is_limits:
-        preferred = []
-        others = []
-        for b in candidates:
-            bid = (b.get("id") or "").upper()
-            if "LIMITI-APPLICAZIONE-LAMIERA" in bid:
-                preferred.append(b)
-            else:
-                others.append(b)
-        if preferred:
-            candidates = preferred + others
+    if LOCAL_RERANKER is not None:
+        probs = LOCAL_RERANKER.predict(rerank_features(q_norm, candidates, scores, snap))
+        best_i = max(range(len(candidates)), key=lambda i: probs[i])
+        if not RERANK_LLM_FALLBACK or probs[best_i] >= RERANK_LOCAL_MIN_CONF:
+            return candidates[best_i]
+
+    if client is None or RERANK_MODE == "local":
+        return candidates[0]
 
     # ====================================
     # AI RERANK
     # ====================================
 
     candidate_ids = [b.get("id") for b in candidates]
-    if not candidates:
-        return None
+
+    cache_key = None
+    if RERANK_CACHE_ENABLE:
+        cache_key = fingerprint([RERANK_MODEL, q_norm] + [str(i) for i in candidate_ids])
+        cached = RERANK_CACHE.get(cache_key)
+        if cached in candidate_ids:
+            return candidates[candidate_ids.index(cached)]
 
     try:
         desc = "\n".join(
@@ -499,7 +856,7 @@ def ai_rerank(question: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]
         )
 
         res = client.chat.completions.create(
-            model="gpt-4.1-mini",
+            model=RERANK_MODEL,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=20,
             temperature=0.0,
@@ -508,6 +865,8 @@ def ai_rerank(question: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]
         chosen = (res.choices[0].message.content or "").strip()
 
         if chosen in candidate_ids:
+            if cache_key is not None:
+                RERANK_CACHE.set(cache_key, chosen)
             for b in candidates:
                 if b.get("id") == chosen:
                     return b
@@ -522,36 +881,32 @@ def ai_rerank(question: str, candidates: List[Dict[str, Any]]) -> Dict[str, Any]
 # BEST BLOCK
 # ============================================================
 
-def find_best_block(question: str) -> Tuple[Dict[str, Any], float]:
+def find_best_block(question: str, snap: Optional[KBState] = None) -> Tuple[Dict[str, Any], float]:
+    # un solo snapshot per tutta la richiesta, anche se nel frattempo arriva un reload
+    snap = snap or S
     q_norm = normalize(question)
+    over_scored, overview_scored, master_scored = lexical_candidates(question, snap=snap)
 
     # 1. Overlay
-    over_scored = lexical_candidates(question, S.overlay_blocks)
     if over_scored:
         over_blocks = [b for s, b in over_scored]
-        best_o = ai_rerank(question, over_blocks)
+        best_o = ai_rerank(question, over_blocks, {b.get("id"): s for s, b in over_scored}, snap)
         best_s = max(s for s, b in over_scored if b is best_o)
         return best_o, float(best_s)
 
     # 2. Overview
-    if is_overview_question(q_norm):
-        overview_blocks = [
-            b for b in S.master_blocks if "OVERVIEW" in (b.get("id") or "").upper()
-        ]
-        scored = lexical_candidates(question, overview_blocks)
-        if scored:
-            blocks = [b for s, b in scored]
-            best = ai_rerank(question, blocks)
-            best_s = max(s for s, b in scored if b is best)
-            return best, float(best_s)
+    if is_overview_question(q_norm) and overview_scored:
+        blocks = [b for s, b in overview_scored]
+        best = ai_rerank(question, blocks, {b.get("id"): s for s, b in overview_scored}, snap)
+        best_s = max(s for s, b in overview_scored if b is best)
+        return best, float(best_s)
 
     # 3. Master
-    master_scored = lexical_candidates(question, S.master_blocks)
     if not master_scored:
         return None, 0.0
 
     master_blocks = [b for s, b in master_scored]
-    best = ai_rerank(question, master_blocks)
+    best = ai_rerank(question, master_blocks, {b.get("id"): s for s, b in master_scored}, snap)
     best_s = max(s for s, b in master_scored if b is best)
     return best, float(best_s)
 
@@ -560,24 +915,46 @@ def find_best_block(question: str) -> Tuple[Dict[str, Any], float]:
 # ENDPOINTS
 # ============================================================
 
+@app.on_event("startup")
+def start_kb_watcher() -> None:
+    if KB_WATCH_ENABLE:
+        KB_WATCHER.start()
+
+
+@app.on_event("shutdown")
+def stop_kb_watcher() -> None:
+    KB_WATCHER.stop()
+
+
 @app.get("/health")
 def health():
+    snap = S
     return {
         "ok": True,
         "version": APP_VERSION,
-        "master_blocks": len(S.master_blocks),
-        "overlay_blocks": len(S.overlay_blocks),
+        "kb_version": snap.kb_version[:12],
+        "kb_loaded_at": snap.loaded_at,
+        "kb_snapshot": KB_SNAPSHOT_PATH if KB_SNAPSHOT_ENABLE else None,
+        "kb_shared_from_master": snap.loaded_pid != os.getpid(),
+        "memory": process_memory(),
+        "master_blocks": len(snap.master_blocks),
+        "overlay_blocks": len(snap.overlay_blocks),
+        "kb_watch": KB_WATCHER.stats() if KB_WATCH_ENABLE else None,
+        "rerank_cache": RERANK_CACHE.stats() if RERANK_CACHE_ENABLE else None,
+        "lang_id": lang_id.cache_info(),
     }
 
 
 @app.post("/api/reload")
 def api_reload():
-    reload_all()
+    snap = reload_all()
+    KB_WATCHER.prime()
     return {
         "ok": True,
         "version": APP_VERSION,
-        "master_blocks": len(S.master_blocks),
-        "overlay_blocks": len(S.overlay_blocks),
+        "kb_version": snap.kb_version[:12],
+        "master_blocks": len(snap.master_blocks),
+        "overlay_blocks": len(snap.overlay_blocks),
     }
 
 
@@ -591,7 +968,11 @@ def api_ask(req: AskRequest):
     if not question:
         raise HTTPException(400, "Domanda vuota.")
 
-    block, score = find_best_block(question)
+    # lingua riconosciuta localmente dalla domanda; il lang del client è il fallback
+    lang = lang_id.detect_lang(question, default=(req.lang or "it").lower())
+
+    snap = S
+    block, score = find_best_block(question, snap)
 
     if block is None:
         return AskResponse(
@@ -600,15 +981,16 @@ def api_ask(req: AskRequest):
             family=FALLBACK_FAMILY,
             id=FALLBACK_ID,
             mode="gold",
-            lang=req.lang,
-            score=0.0
+            lang=lang,
+            score=0.0,
+            kb_version=snap.kb_version[:12],
         )
 
-    answer = (
-        block.get(f"answer_{req.lang}")
-        or block.get("answer_it")
-        or FALLBACK_MESSAGE
-    )
+    answer = block.get(f"answer_{lang}")
+    if not answer:
+        # nessuna traduzione GOLD nella lingua della domanda: si risponde in italiano
+        lang = "it"
+        answer = block.get("answer_it") or FALLBACK_MESSAGE
 
     return AskResponse(
         ok=True,
@@ -616,6 +998,7 @@ def api_ask(req: AskRequest):
         family=block.get("family", "CTF_SYSTEM"),
         id=block.get("id", "UNKNOWN-ID"),
         mode=block.get("mode", "gold"),
-        lang=req.lang,
-        score=float(score)
+        lang=lang,
+        score=float(score),
+        kb_version=snap.kb_version[:12],
     )
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+bench_routing.py
+----------------
+Benchmark offline del routing sui set di test inclusi nel repo.
+
+Motori misurati (LLM sostituito da uno stub deterministico, nessuna rete):
+- applastversion.find_best_block
+- app.match_from_kb
+- app.match_comm
+- scraper_tecnaria.search_best_answer
+
+Per ogni motore e set di test: latenza p50/p95/p99, throughput,
+accuratezza top-1 del routing (famiglia attesa vs famiglia del risultato)
+e rispetto dei must_include di expected_patterns.json.
+Il risultato va in un JSON (default .cache/routing_bench.json) confrontato
+con la baseline versionata (static/data/tests/routing_baseline.json): le
+regressioni diventano diff. La baseline si riscrive solo con --update-baseline.
+
+Uso:
+    python bench_routing.py [--out PATH] [--compare PATH] [--repeat N] [--engines a,b]
+                            [--update-baseline]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from kb_watcher import stat_signature
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "static", "data")
+TESTS_DIR = os.path.join(DATA_DIR, "tests")
+
+TEST_SETS = {
+    "must_pass": os.path.join(TESTS_DIR, "must_pass.json"),
+    "smoke_200": os.path.join(TESTS_DIR, "smoke_200.json"),
+    "batch6": os.path.join(TESTS_DIR, "domande_test_batch6_full.json"),
+    "batch7": os.path.join(TESTS_DIR, "domande_test_batch7_full.json"),
+    "comm_batch": os.path.join(TESTS_DIR, "domande_test_comm_batch.json"),
+    "quick100": os.path.join(DATA_DIR, "domande_test_quick100.json"),
+}
+EXPECTED_PATTERNS_PATH = os.path.join(TESTS_DIR, "expected_patterns.json")
+BASELINE_PATH = os.path.join(TESTS_DIR, "routing_baseline.json")
+RESULTS_PATH = os.path.join(BASE_DIR, ".cache", "routing_bench.json")
+
+# cache di produzione: le scelte dello stub non devono mai finirci dentro
+PRODUCTION_CACHES = [
+    os.path.join(BASE_DIR, ".cache", name + suffix)
+    for name in ("rerank_cache.sqlite3", "answer_cache.sqlite3")
+    for suffix in ("", "-wal", "-shm")
+]
+
+# famiglie KB → famiglie dei set di test
+KB_FAMILY_MAP = {"CTF_SYSTEM": "CTF", "CTL MAXI": "CTL_MAXI"}
+
+
+# ============================================================
+# SET DI TEST
+# ============================================================
+
+def load_json_documents(path: str) -> List[Any]:
+    """Legge file con uno o più documenti JSON concatenati (vuoto → [])."""
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        txt = f.read()
+    dec = json.JSONDecoder()
+    docs: List[Any] = []
+    i = 0
+    while True:
+        while i < len(txt) and txt[i].isspace():
+            i += 1
+        if i >= len(txt):
+            break
+        doc, i = dec.raw_decode(txt, i)
+        docs.append(doc)
+    return docs
+
+
+def load_test_questions(path: str) -> List[Dict[str, Any]]:
+    """Domande di un set di test: lista di {question, family?, id?}."""
+    out: List[Dict[str, Any]] = []
+    for doc in load_json_documents(path):
+        items = doc.get("domande", []) if isinstance(doc, dict) else doc
+        for it in items or []:
+            if isinstance(it, str):
+                out.append({"question": it})
+            elif isinstance(it, dict) and it.get("question"):
+                out.append(it)
+    return out
+
+
+def load_expected_patterns() -> Dict[str, List[Dict[str, Any]]]:
+    """Regole di expected_patterns.json raggruppate per famiglia."""
+    by_family: Dict[str, List[Dict[str, Any]]] = {}
+    for doc in load_json_documents(EXPECTED_PATTERNS_PATH):
+        for r in doc.get("rules", []):
+            by_family.setdefault(r.get("family", ""), []).append(r)
+    return by_family
+
+
+# ============================================================
+# STUB LLM
+# ============================================================
+
+class _StubMessage:
+    def __init__(self, content: str) -> None:
+        self.content = content
+
+
+class _StubChoice:
+    def __init__(self, content: str) -> None:
+        self.message = _StubMessage(content)
+
+
+class _StubCompletion:
+    def __init__(self, content: str) -> None:
+        self.choices = [_StubChoice(content)]
+
+
+class StubChatClient:
+    """
+    Sostituto deterministico del client OpenAI per il rerank:
+    sceglie sempre il primo ID candidato presente nel prompt.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, **kwargs) -> _StubCompletion:
+        self.calls += 1
+        prompt = kwargs["messages"][-1]["content"]
+        for line in prompt.splitlines():
+            if line.startswith("- ID:"):
+                return _StubCompletion(line[5:].split(" |", 1)[0].strip())
+        return _StubCompletion("")
+
+
+# ============================================================
+# MOTORI
+# ============================================================
+
+def block_family(block: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not block:
+        return None
+    fam = (block.get("family") or "").upper()
+    return KB_FAMILY_MAP.get(fam, fam) or None
+
+
+def comm_answer(item: Dict[str, Any]) -> str:
+    return (
+        item.get("response_variants", {}).get("gold", {}).get("it")
+        or item.get("answer_it") or item.get("answer", "")
+    )
+
+
+def load_engines(names: List[str]) -> Dict[str, Callable[[str], Tuple[Any, Optional[str], str]]]:
+    """
+    Ogni motore restituisce (id_risultato, famiglia_risultato, testo_risposta).
+    I moduli vengono importati solo se il motore è richiesto.
+    """
+    engines: Dict[str, Callable[[str], Tuple[Any, Optional[str], str]]] = {}
+
+    # cache LLM solo in memoria: niente letture/scritture sui file SQLite di produzione
+    os.environ["RERANK_CACHE_DB"] = ""
+    os.environ["ANSWER_CACHE_DB"] = ""
+
+    if "find_best_block" in names:
+        import applastversion as A
+        stub = StubChatClient()
+        A.client = stub
+        A.RERANK_CACHE_ENABLE = False
+
+        def run_fbb(q: str):
+            block, _ = A.find_best_block(q)
+            if block is None:
+                return None, None, ""
+            return block.get("id"), block_family(block), block.get("answer_it") or ""
+        run_fbb.stub = stub
+        engines["find_best_block"] = run_fbb
+
+    if "match_from_kb" in names or "match_comm" in names:
+        import app as G
+
+        def run_kb(q: str):
+            block = G.match_from_kb(q)
+            if block is None:
+                return None, None, ""
+            return block.get("id"), block_family(block), block.get("answer_it") or ""
+
+        def run_comm(q: str):
+            item = G.match_comm(q)
+            if item is None:
+                return None, None, ""
+            return item.get("id"), "COMM", comm_answer(item)
+
+        if "match_from_kb" in names:
+            engines["match_from_kb"] = run_kb
+        if "match_comm" in names:
+            engines["match_comm"] = run_comm
+
+    if "search_best_answer" in names:
+        import scraper_tecnaria as T
+        T.build_index()
+
+        def run_scraper(q: str):
+            res = T.search_best_answer(q)
+            if not res.get("found"):
+                return None, None, ""
+            text = res.get("answer") or ""
+            # la famiglia si riconosce da file, domanda abbinata (D:) e risposta
+            hay = " ".join([str(res.get("from") or ""), str(res.get("matched_question") or ""), text]).upper()
+            fam = None
+            for f in ("CTL_MAXI", "CTL MAXI", "CTCEM", "VCEM", "DIAPASON", "P560", "CTF", "CTL"):
+                if f in hay:
+                    fam = KB_FAMILY_MAP.get(f, f)
+                    break
+            return res.get("from"), fam, text
+        engines["search_best_answer"] = run_scraper
+
+    return engines
+
+
+# ============================================================
+# MISURE
+# ============================================================
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def is_correct(engine: str, expected: str, result_family: Optional[str]) -> bool:
+    if engine == "match_comm":
+        # il motore COMM deve rispondere solo alle domande COMM
+        return (result_family == "COMM") == (expected == "COMM")
+    return result_family == expected
+
+
+def must_include_ok(rules: List[Dict[str, Any]], result_id: Any, text: str) -> Optional[bool]:
+    """True/False se una regola si applica all'ID del risultato, None altrimenti."""
+    applicable = [r for r in rules if str(result_id or "").startswith(r.get("id_hint") or "\x00")]
+    if not applicable:
+        return None
+    low = text.lower()
+    return all(
+        all(m.lower() in low for m in r.get("must_include", []))
+        for r in applicable
+    )
+
+
+def bench_engine(
+    name: str,
+    run: Callable[[str], Tuple[Any, Optional[str], str]],
+    questions: List[Dict[str, Any]],
+    patterns: Dict[str, List[Dict[str, Any]]],
+    repeat: int,
+) -> Dict[str, Any]:
+    latencies: List[float] = []
+    labeled = correct = 0
+    mi_total = mi_ok = 0
+    found = 0
+
+    t_start = time.perf_counter()
+    for rep in range(repeat):
+        for it in questions:
+            t0 = time.perf_counter()
+            result_id, result_family, text = run(it["question"])
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+            if rep:
+                continue
+
+            found += result_id is not None
+            expected = (it.get("family") or "").upper()
+            if not expected:
+                continue
+            labeled += 1
+            correct += is_correct(name, expected, result_family)
+            if result_id is not None:
+                ok = must_include_ok(patterns.get(expected, []), result_id, text)
+                if ok is not None:
+                    mi_total += 1
+                    mi_ok += ok
+    elapsed = time.perf_counter() - t_start
+
+    n = len(questions)
+    return {
+        "questions": n,
+        "found": found,
+        "labeled": labeled,
+        "top1_accuracy": round(correct / labeled, 4) if labeled else None,
+        "must_include_rate": round(mi_ok / mi_total, 4) if mi_total else None,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "throughput_qps": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any]) -> None:
+    """Stampa le differenze di accuratezza e latenza rispetto a una baseline."""
+    for eng, sets in current.get("results", {}).items():
+        for ts, r in sets.items():
+            old = previous.get("results", {}).get(eng, {}).get(ts)
+            if not old:
+                continue
+            notes = []
+            for k in ("top1_accuracy", "must_include_rate"):
+                if r.get(k) is not None and old.get(k) is not None and r[k] != old[k]:
+                    notes.append(f"{k} {old[k]:.3f}→{r[k]:.3f}")
+            if old.get("p95_ms"):
+                ratio = r["p95_ms"] / old["p95_ms"]
+                if ratio > 1.2 or ratio < 0.8:
+                    notes.append(f"p95 x{ratio:.2f}")
+            if notes:
+                print(f"[DIFF] {eng}/{ts}: " + ", ".join(notes))
+
+
+def main() -> None:
+    all_engines = ["find_best_block", "match_from_kb", "match_comm", "search_best_answer"]
+    ap = argparse.ArgumentParser(description="Benchmark offline del routing Tecnaria")
+    ap.add_argument("--out", default=RESULTS_PATH, help="dove salvare i risultati di questa esecuzione")
+    ap.add_argument("--compare", default=BASELINE_PATH, help="baseline da confrontare ('' = nessuna)")
+    ap.add_argument(
+        "--update-baseline", action="store_true",
+        help=f"riscrive anche la baseline versionata ({os.path.relpath(BASELINE_PATH, BASE_DIR)})",
+    )
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--engines", default=",".join(all_engines))
+    args = ap.parse_args()
+    if os.path.abspath(args.out) == os.path.abspath(BASELINE_PATH) and not args.update_baseline:
+        ap.error("per riscrivere la baseline versionata serve --update-baseline")
+
+    names = [e.strip() for e in args.engines.split(",") if e.strip()]
+    caches_before = stat_signature(PRODUCTION_CACHES)
+    engines = load_engines(names)
+    patterns = load_expected_patterns()
+    test_sets = {k: load_test_questions(p) for k, p in TEST_SETS.items()}
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in names:
+        run = engines[name]
+        results[name] = {}
+        for ts, questions in test_sets.items():
+            if not questions:
+                continue
+            r = bench_engine(name, run, questions, patterns, args.repeat)
+            results[name][ts] = r
+            print(
+                f"[BENCH] {name:<20} {ts:<10} n={r['questions']:<4} "
+                f"acc={r['top1_accuracy']} must={r['must_include_rate']} "
+                f"p50={r['p50_ms']}ms p95={r['p95_ms']}ms p99={r['p99_ms']}ms "
+                f"qps={r['throughput_qps']}"
+            )
+        stub = getattr(run, "stub", None)
+        if stub is not None:
+            results[name]["_llm_stub_calls"] = stub.calls
+
+    assert stat_signature(PRODUCTION_CACHES) == caches_before, (
+        "il benchmark ha modificato le cache LLM di produzione in .cache/"
+    )
+
+    out = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": args.repeat,
+        "rerank_mode": os.getenv("RERANK_MODE", "llm"),
+        "empty_sets": [k for k, v in test_sets.items() if not v],
+        "results": results,
+    }
+
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(out, json.load(f))
+
+    targets = [args.out]
+    if args.update_baseline and os.path.abspath(args.out) != os.path.abspath(BASELINE_PATH):
+        targets.append(BASELINE_PATH)
+    for path in targets:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(out, f, ensure_ascii=False, indent=2)
+        print(f"[BENCH] risultati salvati in {path}")
+
+
+if __name__ == "__main__":
+    main()
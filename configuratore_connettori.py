@@ -19,6 +19,8 @@ from typing import Dict, Any, Optional
 # OPENAI_MODEL=gpt-4o-mini (o altro modello)
 #
 # Se usi provider compatibile (es. DeepSeek-compat), basta impostare OPENAI_BASE_URL.
+# Per i test di carico: OPENAI_BASE_URL=http://127.0.0.1:8099/v1 (llm_standin.py).
+# OPENAI_TIMEOUT=60 (secondi, opzionale)
 
 def ask_chatgpt(prompt: str) -> str:
     import requests
@@ -44,7 +46,7 @@ def ask_chatgpt(prompt: str) -> str:
             {"role": "user", "content": prompt},
         ],
     }
-    resp = requests.post(url, headers=headers, json=data, timeout=60)
+    resp = requests.post(url, headers=headers, json=data, timeout=float(os.getenv("OPENAI_TIMEOUT", "60")))
     resp.raise_for_status()
     content = resp.json()["choices"][0]["message"]["content"]
     return content
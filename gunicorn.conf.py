@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn.conf.py
+----------------
+Configurazione gunicorn per il servizio GOLD (vedi Procfile).
+
+Preload: l'app (KB, COMM, indici) viene importata una volta nel master e i
+worker la ereditano con il fork, condividendo le stesse pagine di memoria.
+Prima di ogni fork gli oggetti già caricati vengono "congelati" (gc.freeze):
+il garbage collector dei worker non li visita più e quindi non riscrive le
+loro pagine, che restano condivise invece di essere copiate (copy-on-write).
+
+Variabili:
+- GUNICORN_PRELOAD=0   disattiva il preload (ogni worker carica la propria KB)
+- GUNICORN_GC_FREEZE=0 disattiva gc.freeze
+
+Nota: un ricaricamento a caldo della KB (kb_watcher) crea nel worker uno
+snapshot nuovo e privato; la condivisione torna piena al restart dei worker.
+"""
+
+import gc
+import os
+
+from proc_memory import process_memory
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+GC_FREEZE = os.getenv("GUNICORN_GC_FREEZE", "1") == "1"
+
+
+def when_ready(server):
+    if preload_app and GC_FREEZE:
+        gc.collect()
+        gc.freeze()
+    server.log.info(
+        "[MEM] master pronto (preload=%s, gc_freeze=%s): %s",
+        preload_app, GC_FREEZE, process_memory(),
+    )
+
+
+def pre_fork(server, worker):
+    # gli oggetti creati nel master dopo when_ready (es. worker rigenerati)
+    if preload_app and GC_FREEZE:
+        gc.freeze()
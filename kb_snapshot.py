@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+kb_snapshot.py
+--------------
+Artefatto binario precompilato della KB, per avvii e restart dei worker
+in pochi millisecondi.
+
+- Un solo file (default .cache/kb_snapshot.bin) con una sezione per
+  consumatore ("app" per app.py, "gold" per applastversion.py): blocchi,
+  token già normalizzati e indici già costruiti.
+- Ogni sezione porta l'hash delle sorgenti da cui è stata compilata
+  (contenuto dei JSON + firma del codice che la compila): se non coincide
+  la sezione è scaduta e il chiamante ricade sul caricamento dai JSON,
+  poi la riscrive.
+- Lettura via mmap, decodificando con orjson solo la sezione richiesta;
+  senza orjson si usa json (più lento).
+
+Compilazione esplicita (es. in fase di build/deploy):
+    python kb_snapshot.py
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # dipendenza opzionale
+    orjson = None
+
+KB_SNAPSHOT_MAGIC = b"TKBS2\n"
+
+# Formato del file:
+#   MAGIC
+#   header JSON su una riga: {sezione: {offset, length, source_hash, built_at}}
+#   payload delle sezioni concatenati (offset relativi alla fine dell'header)
+# Così ogni consumatore decodifica solo la propria sezione, e solo se aggiornata.
+
+
+def encode(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode(raw: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(bytes(raw).decode("utf-8"))
+
+
+class SnapshotStore:
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+
+    def _open(self) -> Tuple[Dict[str, Any], Optional[mmap.mmap], int]:
+        """(header, mappa del file, inizio dei payload); header vuoto se manca o non valido."""
+        if not self.path or not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return {}, None, 0
+        with open(self.path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(KB_SNAPSHOT_MAGIC)] != KB_SNAPSHOT_MAGIC:
+            mm.close()
+            return {}, None, 0
+        end = mm.find(b"\n", len(KB_SNAPSHOT_MAGIC))
+        header = decode(mm[len(KB_SNAPSHOT_MAGIC):end])
+        return header, mm, end + 1
+
+    def _sections_raw(self) -> Dict[str, Tuple[Dict[str, Any], bytes]]:
+        header, mm, base = self._open()
+        if mm is None:
+            return {}
+        try:
+            return {
+                name: (meta, mm[base + meta["offset"]: base + meta["offset"] + meta["length"]])
+                for name, meta in header.items()
+            }
+        finally:
+            mm.close()
+
+    def load(self, section: str, source_hash: str) -> Optional[Dict[str, Any]]:
+        """Payload della sezione, o None se manca, è illeggibile o è scaduta."""
+        try:
+            header, mm, base = self._open()
+        except Exception as e:
+            print(f"[SNAPSHOT][WARN] artefatto illeggibile {self.path}: {e}")
+            return None
+        if mm is None:
+            return None
+        try:
+            meta = header.get(section)
+            if not meta or meta.get("source_hash") != source_hash:
+                return None
+            start = base + meta["offset"]
+            return decode(mm[start:start + meta["length"]])
+        except Exception as e:
+            print(f"[SNAPSHOT][WARN] sezione {section} illeggibile: {e}")
+            return None
+        finally:
+            mm.close()
+
+    def save(self, section: str, source_hash: str, payload: Dict[str, Any]) -> None:
+        """Riscrive la sezione in modo atomico (file temporaneo + rename), le altre restano."""
+        if not self.path:
+            return
+        try:
+            try:
+                sections = self._sections_raw()
+            except Exception:
+                sections = {}
+            sections[section] = (
+                {"source_hash": source_hash, "built_at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+                encode(payload),
+            )
+            header: Dict[str, Any] = {}
+            offset = 0
+            for name, (meta, blob) in sections.items():
+                header[name] = {
+                    "offset": offset,
+                    "length": len(blob),
+                    "source_hash": meta["source_hash"],
+                    "built_at": meta.get("built_at"),
+                }
+                offset += len(blob)
+
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(KB_SNAPSHOT_MAGIC)
+                f.write(encode(header))
+                f.write(b"\n")
+                for _, blob in sections.values():
+                    f.write(blob)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print(f"[SNAPSHOT][WARN] scrittura {self.path} fallita: {e}")
+
+    def info(self) -> Dict[str, Any]:
+        try:
+            header, mm, _ = self._open()
+            if mm is not None:
+                mm.close()
+        except Exception:
+            header = {}
+        return {
+            "path": self.path,
+            "size": os.path.getsize(self.path) if self.path and os.path.exists(self.path) else 0,
+            "sections": {
+                k: {"source_hash": v.get("source_hash", "")[:12], "built_at": v.get("built_at"), "bytes": v.get("length")}
+                for k, v in header.items()
+            },
+        }
+
+
+def main() -> None:
+    # ricompila sempre dai JSON e scrive tutte le sezioni
+    os.environ["KB_SNAPSHOT_REBUILD"] = "1"
+    t0 = time.perf_counter()
+    import app
+    import applastversion  # noqa: F401
+    print(f"[SNAPSHOT] compilato in {time.perf_counter() - t0:.2f}s: {app.KB_STORE.info()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+kb_watcher.py
+-------------
+Sorveglianza dei file della KB per il ricaricamento a caldo.
+
+- Un thread in background controlla periodicamente mtime e dimensione dei file.
+- Solo se cambiano si ricalcola l'hash del contenuto: un "touch" senza
+  modifiche reali non provoca ricaricamenti.
+- Su cambiamento reale chiama on_change() (che costruisce e pubblica il nuovo
+  snapshot); se on_change() fallisce (es. JSON scritto a metà) lo snapshot
+  in uso resta valido e si riprova ai giri successivi: subito se i file
+  cambiano di nuovo, altrimenti con attesa crescente (interval, 2x, 4x...
+  fino a max_backoff).
+
+Dipendenze: solo libreria standard.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from answer_cache import file_fingerprint, fingerprint
+
+
+def paths_fingerprint(paths: List[str]) -> str:
+    """Hash del contenuto di un insieme di file (nome + contenuto di ciascuno)."""
+    return fingerprint([os.path.basename(p) + ":" + file_fingerprint(p) for p in paths])
+
+
+def stat_signature(paths: List[str]) -> Tuple[Tuple[str, int, int], ...]:
+    sig = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            sig.append((p, st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append((p, 0, -1))
+    return tuple(sig)
+
+
+class FileWatcher:
+    def __init__(
+        self,
+        name: str,
+        paths_fn: Callable[[], List[str]],
+        on_change: Callable[[], object],
+        interval: float = 2.0,
+        max_backoff: float = 60.0,
+    ) -> None:
+        self.name = name
+        self.paths_fn = paths_fn
+        self.on_change = on_change
+        self.interval = interval
+        self.max_backoff = max(max_backoff, interval)
+
+        self._stat: Optional[tuple] = None
+        self._hash: Optional[str] = None
+        # ultimo tentativo fallito: firma dei file, attesa corrente, prossimo tentativo
+        self._failed_stat: Optional[tuple] = None
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.reloads = 0
+        self.failures = 0
+
+    def prime(self) -> None:
+        """Registra lo stato attuale dei file come già caricato."""
+        paths = self.paths_fn()
+        self._stat = stat_signature(paths)
+        self._hash = paths_fingerprint(paths)
+
+    def poll(self) -> bool:
+        """Un controllo: True se i file erano cambiati e on_change() è andato a buon fine."""
+        paths = self.paths_fn()
+        sig = stat_signature(paths)
+        if sig == self._stat:
+            return False
+        if sig == self._failed_stat and time.monotonic() < self._retry_at:
+            return False
+        content = paths_fingerprint(paths)
+        if content == self._hash:
+            self._stat = sig
+            self._failed_stat = None
+            return False
+        try:
+            self.on_change()
+        except Exception as e:
+            # _stat resta invariato: il cambiamento verrà riprovato
+            self._backoff = self.interval if sig != self._failed_stat else min(
+                self._backoff * 2, self.max_backoff
+            )
+            self._failed_stat = sig
+            self._retry_at = time.monotonic() + self._backoff
+            self.failures += 1
+            print(
+                f"[WATCH][WARN] {self.name}: ricaricamento fallito, resta lo snapshot in uso "
+                f"(nuovo tentativo tra {self._backoff:.0f}s): {e}"
+            )
+            return False
+        self._stat = sig
+        self._hash = content
+        self._failed_stat = None
+        self.reloads += 1
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"[WATCH][WARN] {self.name}: {e}")
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if self._stat is None:
+            self.prime()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"watch-{self.name}", daemon=True)
+        self._thread.start()
+        print(f"[WATCH] {self.name}: controllo file ogni {self.interval}s")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1.0)
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "interval": self.interval,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "retry_pending": self._failed_stat is not None,
+        }
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+keyword_automaton.py
+--------------------
+Automa Aho–Corasick per il riconoscimento di molte frasi chiave in un solo
+passaggio sul testo (costo proporzionale alla lunghezza del testo, non al
+numero di frasi).
+
+- Ogni frase ha un'etichetta (es. l'intent "comm" o "situational").
+- Confini di parola: una frase che inizia/finisce con una lettera o cifra
+  deve iniziare/finire a confine di parola ("sdi" non trova "sdirenare").
+- Una frase che termina con "*" è un prefisso: nessun confine richiesto
+  a destra ("anni 6*" trova "anni 60", "foto*" trova "fotografie").
+- Con add(..., boundaries=False) la frase vale come sottostringa qualsiasi
+  (prefiltro dei frammenti letterali in sinapsi_overrides).
+
+Dipendenze: solo libreria standard.
+"""
+
+from __future__ import annotations
+
+from collections import deque
+from typing import Dict, Iterator, List, Set, Tuple
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+class KeywordAutomaton:
+    def __init__(self) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # per ogni stato: (etichetta, frase, lunghezza, confine_sx, confine_dx)
+        self._out: List[List[Tuple[str, str, int, bool, bool]]] = [[]]
+        self._built = False
+
+    def add(self, phrase: str, label: str, boundaries: bool = True) -> None:
+        prefix = phrase.endswith("*")
+        if prefix:
+            phrase = phrase[:-1]
+        phrase = phrase.lower()
+        if not phrase:
+            return
+
+        state = 0
+        for ch in phrase:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][ch] = nxt
+            state = nxt
+
+        self._out[state].append((
+            label,
+            phrase,
+            len(phrase),
+            boundaries and _is_word_char(phrase[0]),
+            boundaries and _is_word_char(phrase[-1]) and not prefix,
+        ))
+        self._built = False
+
+    def add_all(self, phrases, label: str) -> None:
+        for p in phrases:
+            self.add(p, label)
+
+    def build(self) -> "KeywordAutomaton":
+        """Calcola i link di fallimento (BFS) e fonde gli output."""
+        queue = deque()
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            queue.append(nxt)
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+        self._built = True
+        return self
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, str, str]]:
+        """Restituisce (inizio, fine, etichetta, frase) per ogni occorrenza valida."""
+        if not self._built:
+            self.build()
+        goto, fail, out = self._goto, self._fail, self._out
+        n = len(text)
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if not out[state]:
+                continue
+            end = i + 1
+            for label, phrase, length, left, right in out[state]:
+                start = end - length
+                if left and start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if right and end < n and _is_word_char(text[end]):
+                    continue
+                yield start, end, label, phrase
+
+    def labels(self, text: str) -> Set[str]:
+        """Insieme delle etichette trovate nel testo (case-insensitive)."""
+        return {label for _, _, label, _ in self.iter_matches(text.lower())}
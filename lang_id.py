@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+lang_id.py
+----------
+Riconoscimento locale della lingua della domanda con il modello fastText
+lid.176.ftz (176 lingue, ~1 MB, nella root del repo).
+
+- Il modello viene caricato una volta per processo (alla prima domanda, o
+  nel master con il preload di gunicorn) e poi condiviso da tutte le richieste.
+- Una predizione costa pochi microsecondi; le domande recenti sono comunque
+  memorizzate (LRU) perché i client ripetono spesso le stesse domande.
+- Nessuna chiamata di rete: se fasttext o il modello mancano, oppure la
+  confidenza è bassa (testi corti tipo "P560", "ciao"), si usa il default.
+
+Variabili:
+- LID_MODEL_PATH       percorso del modello (default: lid.176.ftz accanto a questo file)
+- LID_MIN_CONFIDENCE   probabilità minima per accettare la lingua (default 0.5)
+- LID_CACHE_SIZE       domande memorizzate (default 2048)
+
+Dipendenze: fasttext (pacchetto fasttext-wheel), opzionale.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from functools import lru_cache
+from typing import Any, Iterable, Optional, Tuple
+
+try:
+    import fasttext  # type: ignore
+except ImportError:  # pragma: no cover
+    fasttext = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LID_MODEL_PATH = os.getenv("LID_MODEL_PATH", os.path.join(BASE_DIR, "lid.176.ftz"))
+LID_MIN_CONFIDENCE = float(os.getenv("LID_MIN_CONFIDENCE", "0.5"))
+LID_CACHE_SIZE = int(os.getenv("LID_CACHE_SIZE", "2048"))
+
+_LABEL_PREFIX = "__label__"
+_MODEL: Any = None
+_MODEL_TRIED = False
+_MODEL_LOCK = threading.Lock()
+
+
+def _load_model() -> Any:
+    """Modello fastText (o None), caricato una sola volta per processo."""
+    global _MODEL, _MODEL_TRIED
+    if _MODEL_TRIED:
+        return _MODEL
+    with _MODEL_LOCK:
+        if _MODEL_TRIED:
+            return _MODEL
+        if fasttext is None:
+            print("[LANG][WARN] fasttext non installato: lingua di default")
+        elif not os.path.exists(LID_MODEL_PATH):
+            print(f"[LANG][WARN] modello non trovato: {LID_MODEL_PATH}")
+        else:
+            try:
+                # l'oggetto C++ interno: predict() del wrapper Python usa
+                # np.array(copy=False) e con numpy 2 solleva un errore
+                _MODEL = fasttext.load_model(LID_MODEL_PATH).f
+                print(f"[LANG] modello caricato: {os.path.basename(LID_MODEL_PATH)}")
+            except Exception as e:
+                print(f"[LANG][WARN] errore nel caricamento di {LID_MODEL_PATH}: {e}")
+        _MODEL_TRIED = True
+    return _MODEL
+
+
+def is_ready() -> bool:
+    return _load_model() is not None
+
+
+@lru_cache(maxsize=LID_CACHE_SIZE)
+def _predict(text: str) -> Tuple[str, float]:
+    model = _load_model()
+    if model is None:
+        return "", 0.0
+    # fastText legge una riga: niente a capo interni, "\n" finale obbligatorio
+    preds = model.predict(" ".join(text.split()) + "\n", 1, 0.0, "strict")
+    if not preds:
+        return "", 0.0
+    prob, label = preds[0]
+    return label[len(_LABEL_PREFIX):], float(prob)
+
+
+def detect_lang_scored(text: str) -> Tuple[str, float]:
+    """(codice ISO, probabilità) per il testo; ("", 0.0) se non disponibile."""
+    text = (text or "").strip()
+    if not text:
+        return "", 0.0
+    return _predict(text)
+
+
+def detect_lang(
+    text: str,
+    default: str = "it",
+    allowed: Optional[Iterable[str]] = None,
+) -> str:
+    """
+    Lingua del testo (codice ISO 639-1, es. "it", "en"); `default` se il modello
+    non è disponibile, la confidenza è sotto LID_MIN_CONFIDENCE o la lingua non
+    è tra quelle `allowed`.
+    """
+    lang, prob = detect_lang_scored(text)
+    if not lang or prob < LID_MIN_CONFIDENCE:
+        return default
+    if allowed is not None and lang not in allowed:
+        return default
+    return lang
+
+
+def cache_info() -> dict:
+    info = _predict.cache_info()
+    return {
+        "model": os.path.basename(LID_MODEL_PATH) if _MODEL is not None else None,
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "max_size": info.maxsize,
+    }
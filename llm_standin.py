@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+llm_standin.py
+--------------
+Finto server OpenAI-compatibile per i test di carico (nessun costo, nessuna rete).
+
+Espone /v1/chat/completions (normale e stream SSE) e /v1/models, con
+latenza, velocità dei token ed errori configurabili via variabili d'ambiente:
+
+- STANDIN_LATENCY_DIST   fixed | uniform | exp | lognormal   (default lognormal)
+- STANDIN_LATENCY_MS     latenza mediana prima del primo token (default 800)
+- STANDIN_LATENCY_SPREAD dispersione: sigma per lognormal, +/- frazione per uniform (default 0.5)
+- STANDIN_TOKENS_PER_SEC velocità di generazione (default 60; 0 = istantanea)
+- STANDIN_ANSWER_TOKENS  lunghezza della risposta in token/parole (default 120)
+- STANDIN_ERROR_RATE     probabilità di HTTP 500 (default 0)
+- STANDIN_429_RATE       probabilità di HTTP 429 con Retry-After (default 0)
+- STANDIN_SEED           seme per rendere riproducibili latenze ed errori
+
+Le risposte sono deterministiche: per i prompt di rerank (righe "- ID:...")
+si sceglie il primo ID, altrimenti si genera un testo fisso della lunghezza
+richiesta. Statistiche su /standin/stats.
+
+Uso:
+    python llm_standin.py --port 8099
+    OPENAI_BASE_URL=http://127.0.0.1:8099/v1 OPENAI_API_KEY=standin gunicorn ...
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# ============================================================
+# CONFIG
+# ============================================================
+
+STANDIN_LATENCY_DIST = os.getenv("STANDIN_LATENCY_DIST", "lognormal").lower()
+STANDIN_LATENCY_MS = float(os.getenv("STANDIN_LATENCY_MS", "800"))
+STANDIN_LATENCY_SPREAD = float(os.getenv("STANDIN_LATENCY_SPREAD", "0.5"))
+STANDIN_TOKENS_PER_SEC = float(os.getenv("STANDIN_TOKENS_PER_SEC", "60"))
+STANDIN_ANSWER_TOKENS = int(os.getenv("STANDIN_ANSWER_TOKENS", "120"))
+STANDIN_ERROR_RATE = float(os.getenv("STANDIN_ERROR_RATE", "0"))
+STANDIN_429_RATE = float(os.getenv("STANDIN_429_RATE", "0"))
+STANDIN_SEED = os.getenv("STANDIN_SEED")
+
+rng = random.Random(int(STANDIN_SEED) if STANDIN_SEED else None)
+
+FILLER_WORDS = (
+    "Il connettore Tecnaria va posato secondo le istruzioni di posa "
+    "verificando supporto spessori e passo dei connettori prima del getto "
+    "del calcestruzzo in accordo con il progettista strutturale"
+).split()
+
+STATS: Dict[str, Any] = {
+    "requests": 0,
+    "streams": 0,
+    "errors_500": 0,
+    "errors_429": 0,
+    "in_flight": 0,
+    "max_in_flight": 0,
+}
+
+
+# ============================================================
+# SIMULAZIONE
+# ============================================================
+
+def sample_latency() -> float:
+    """Latenza (secondi) prima del primo token secondo la distribuzione scelta."""
+    base = max(0.0, STANDIN_LATENCY_MS) / 1000.0
+    if base == 0.0 or STANDIN_LATENCY_DIST == "fixed":
+        return base
+    if STANDIN_LATENCY_DIST == "uniform":
+        return max(0.0, base * (1.0 + rng.uniform(-STANDIN_LATENCY_SPREAD, STANDIN_LATENCY_SPREAD)))
+    if STANDIN_LATENCY_DIST == "exp":
+        # mediana = base → media = base / ln 2
+        return rng.expovariate(math.log(2) / base)
+    return rng.lognormvariate(math.log(base), STANDIN_LATENCY_SPREAD)
+
+
+def fake_answer(messages: List[Dict[str, Any]], max_tokens: int) -> List[str]:
+    """Token (parole con spazio) della risposta simulata, deterministica."""
+    prompt = str(messages[-1].get("content", "")) if messages else ""
+    for line in prompt.splitlines():
+        if line.startswith("- ID:"):
+            return [line[5:].split(" |", 1)[0].strip()]
+
+    n = STANDIN_ANSWER_TOKENS
+    if max_tokens:
+        n = min(n, max_tokens)
+    return [FILLER_WORDS[i % len(FILLER_WORDS)] + (" " if i < n - 1 else ".") for i in range(n)]
+
+
+def completion_id() -> str:
+    return "chatcmpl-standin-" + uuid.uuid4().hex[:16]
+
+
+def usage(messages: List[Dict[str, Any]], tokens: List[str]) -> Dict[str, int]:
+    prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in messages)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(tokens),
+        "total_tokens": prompt_tokens + len(tokens),
+    }
+
+
+def error_response(status: int, message: str, kind: str) -> JSONResponse:
+    headers = {"Retry-After": "1"} if status == 429 else None
+    return JSONResponse(
+        status_code=status,
+        content={"error": {"message": message, "type": kind, "code": None}},
+        headers=headers,
+    )
+
+
+# ============================================================
+# FASTAPI APP
+# ============================================================
+
+app = FastAPI(title="Tecnaria – LLM stand-in")
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "standin", "object": "model", "owned_by": "standin"}]}
+
+
+@app.get("/standin/stats")
+async def stats():
+    return {
+        **STATS,
+        "config": {
+            "latency_dist": STANDIN_LATENCY_DIST,
+            "latency_ms": STANDIN_LATENCY_MS,
+            "latency_spread": STANDIN_LATENCY_SPREAD,
+            "tokens_per_sec": STANDIN_TOKENS_PER_SEC,
+            "answer_tokens": STANDIN_ANSWER_TOKENS,
+            "error_rate": STANDIN_ERROR_RATE,
+            "rate_limit_rate": STANDIN_429_RATE,
+        },
+    }
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    STATS["requests"] += 1
+
+    r = rng.random()
+    if r < STANDIN_429_RATE:
+        STATS["errors_429"] += 1
+        return error_response(429, "Rate limit simulato (stand-in).", "rate_limit_error")
+    if r < STANDIN_429_RATE + STANDIN_ERROR_RATE:
+        STATS["errors_500"] += 1
+        return error_response(500, "Errore simulato (stand-in).", "server_error")
+
+    messages = body.get("messages") or []
+    model = body.get("model") or "standin"
+    max_tokens = int(body.get("max_tokens") or body.get("max_completion_tokens") or 0)
+    tokens = fake_answer(messages, max_tokens)
+    delay = sample_latency()
+    per_token = 1.0 / STANDIN_TOKENS_PER_SEC if STANDIN_TOKENS_PER_SEC > 0 else 0.0
+
+    if body.get("stream"):
+        STATS["streams"] += 1
+        return StreamingResponse(
+            stream_tokens(model, tokens, delay, per_token),
+            media_type="text/event-stream",
+        )
+
+    STATS["in_flight"] += 1
+    STATS["max_in_flight"] = max(STATS["max_in_flight"], STATS["in_flight"])
+    try:
+        await asyncio.sleep(delay + per_token * len(tokens))
+    finally:
+        STATS["in_flight"] -= 1
+
+    return {
+        "id": completion_id(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(tokens)},
+            "finish_reason": "stop",
+        }],
+        "usage": usage(messages, tokens),
+    }
+
+
+async def stream_tokens(model: str, tokens: List[str], delay: float, per_token: float) -> AsyncIterator[str]:
+    cid = completion_id()
+    created = int(time.time())
+
+    def chunk(delta: Dict[str, Any], finish: Any = None) -> str:
+        payload = {
+            "id": cid,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    STATS["in_flight"] += 1
+    STATS["max_in_flight"] = max(STATS["max_in_flight"], STATS["in_flight"])
+    try:
+        await asyncio.sleep(delay)
+        yield chunk({"role": "assistant", "content": ""})
+        for tok in tokens:
+            if per_token:
+                await asyncio.sleep(per_token)
+            yield chunk({"content": tok})
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+    finally:
+        STATS["in_flight"] -= 1
+
+
+def main() -> None:
+    import uvicorn
+
+    ap = argparse.ArgumentParser(description="Stand-in OpenAI-compatibile per test di carico")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8099)
+    args = ap.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
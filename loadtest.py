@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+loadtest.py
+-----------
+Test di carico end-to-end del servizio GOLD (app.py) con LLM simulato.
+
+- Rigioca un mix realistico di domande COMM / Oracolo / GOLD su /api/ask
+  (o /api/ask/stream con --stream) con N utenti concorrenti per --duration secondi.
+- Con --spawn avvia da sé llm_standin.py e l'app con il comando del Procfile
+  (gunicorn + UvicornWorker) e --workers N, puntando l'app allo stand-in.
+- Riporta richieste/s, percentili di latenza per `source`, errori HTTP,
+  eccezioni di rete e risposte "degradate" (LLM in errore/timeout).
+- Il report JSON include la configurazione: confrontabile tra numeri di
+  worker e impostazioni diverse con --compare.
+
+Uso:
+    python loadtest.py --spawn --workers 2 --concurrency 32 --duration 30 --out report_w2.json
+    python loadtest.py --url http://127.0.0.1:8000 --concurrency 16
+    python loadtest.py --compare report_w1.json report_w2.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+import httpx
+
+from bench_routing import TEST_SETS, load_test_questions, percentile
+from proc_memory import process_tree_memory
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROCFILE_PATH = os.path.join(BASE_DIR, "Procfile")
+
+# mix di default: quota di domande per route
+DEFAULT_MIX = "gold=0.7,oracolo=0.2,comm=0.1"
+
+# domande aggiuntive per le route poco presenti nei set di test
+COMM_QUESTIONS = [
+    "Qual è la partita iva di Tecnaria?",
+    "Mi date l'indirizzo della sede Tecnaria?",
+    "Qual è il numero di telefono dell'ufficio tecnico?",
+    "Che orari di apertura ha Tecnaria?",
+    "Qual è il codice SDI per la fatturazione elettronica?",
+    "A quale email posso scrivere per un preventivo?",
+]
+ORACOLO_QUESTIONS = [
+    "Ho un solaio in legno degli anni 60 con travi un po' deformate, vorrei rinforzarlo con una soletta collaborante.",
+    "Abbiamo un cantiere su un capannone con lamiera grecata e travi in acciaio, il progettista chiede i CTF.",
+    "Ho un solaio in laterocemento anni 70 con travetti degradati, non so se usare VCEM o CTCEM.",
+    "Il cliente ha una villa con struttura esistente in legno e vuole alzare poco lo spessore.",
+    "Situazione: edificio storico, travi in castagno, non abbiamo accesso dal basso. Cosa conviene?",
+    "Vi mando le foto del solaio: travi in acciaio e lamiera, devo rinforzare per un cambio d'uso.",
+]
+
+# testi con cui app.py segnala un errore/timeout del motore esterno
+LLM_DEGRADED_MARKERS = (
+    "Il motore esterno non ha risposto in tempo",
+    "Si è verificato un errore nella chiamata al motore esterno",
+    "Il motore esterno non è disponibile",
+    "Si è verificato un problema interno",
+)
+
+
+# ============================================================
+# MIX DI DOMANDE
+# ============================================================
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix: Dict[str, float] = {}
+    for part in spec.split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            mix[k.strip().lower()] = float(v)
+    tot = sum(mix.values()) or 1.0
+    return {k: v / tot for k, v in mix.items() if v > 0}
+
+
+def build_pools() -> Dict[str, List[str]]:
+    """Domande per route, classificate con gli stessi intent di app.py."""
+    from app import INTENT_COMM, INTENT_SITUATIONAL, detect_intents
+
+    pools: Dict[str, List[str]] = {
+        "comm": list(COMM_QUESTIONS),
+        "oracolo": list(ORACOLO_QUESTIONS),
+        "gold": [],
+    }
+    seen = set()
+    for path in TEST_SETS.values():
+        for it in load_test_questions(path):
+            q = it["question"].strip()
+            if q in seen:
+                continue
+            seen.add(q)
+            intents = detect_intents(q.lower())
+            if INTENT_COMM in intents:
+                pools["comm"].append(q)
+            elif INTENT_SITUATIONAL in intents:
+                pools["oracolo"].append(q)
+            else:
+                pools["gold"].append(q)
+    return pools
+
+
+# ============================================================
+# AVVIO SERVIZI (--spawn)
+# ============================================================
+
+def procfile_command(port: int, workers: int) -> List[str]:
+    """Comando web del Procfile, con bind e numero di worker espliciti."""
+    cmd = "gunicorn -k uvicorn.workers.UvicornWorker app:app"
+    if os.path.exists(PROCFILE_PATH):
+        with open(PROCFILE_PATH, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("web:"):
+                    cmd = line[4:].strip()
+                    break
+    return shlex.split(cmd) + ["--bind", f"127.0.0.1:{port}", "--workers", str(workers)]
+
+
+def wait_ready(url: str, timeout: float = 60.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=2.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    raise RuntimeError(f"servizio non pronto: {url}")
+
+
+def spawn_services(args) -> Tuple[str, List[subprocess.Popen]]:
+    procs: List[subprocess.Popen] = []
+    standin_url = f"http://127.0.0.1:{args.standin_port}"
+    procs.append(subprocess.Popen(
+        [sys.executable, os.path.join(BASE_DIR, "llm_standin.py"), "--port", str(args.standin_port)],
+        cwd=BASE_DIR,
+    ))
+    wait_ready(standin_url + "/v1/models")
+
+    env = dict(os.environ)
+    env["OPENAI_BASE_URL"] = standin_url + "/v1"
+    env["OPENAI_API_KEY"] = env.get("OPENAI_API_KEY") or "standin"
+    if not args.cache:
+        env["ANSWER_CACHE_ENABLE"] = "0"
+    procs.append(subprocess.Popen(procfile_command(args.port, args.workers), cwd=BASE_DIR, env=env))
+    app_url = f"http://127.0.0.1:{args.port}"
+    wait_ready(app_url + "/api/status")
+    return app_url, procs
+
+
+def stop_services(procs: List[subprocess.Popen]) -> None:
+    for p in reversed(procs):
+        p.terminate()
+    for p in procs:
+        try:
+            p.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+# ============================================================
+# CARICO
+# ============================================================
+
+async def ask(http: httpx.AsyncClient, question: str, stream: bool) -> Dict[str, Any]:
+    """Una richiesta: ritorna status, source, latenza totale e (stream) al primo token."""
+    t0 = time.perf_counter()
+    rec: Dict[str, Any] = {"status": 0, "source": None, "ttft": None, "degraded": False}
+    try:
+        if not stream:
+            resp = await http.post("/api/ask", json={"question": question})
+            rec["status"] = resp.status_code
+            if resp.status_code == 200:
+                data = resp.json()
+                rec["source"] = data.get("source")
+                rec["degraded"] = data.get("answer", "").startswith(LLM_DEGRADED_MARKERS)
+        else:
+            text_parts: List[str] = []
+            async with http.stream("POST", "/api/ask/stream", json={"question": question}) as resp:
+                rec["status"] = resp.status_code
+                event = None
+                async for line in resp.aiter_lines():
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        data = json.loads(line[5:].strip() or "{}")
+                        if event == "start":
+                            rec["source"] = data.get("source")
+                        elif event == "delta":
+                            if rec["ttft"] is None:
+                                rec["ttft"] = time.perf_counter() - t0
+                            text_parts.append(data.get("text", ""))
+                        elif event == "error":
+                            rec["degraded"] = True
+            answer = "".join(text_parts)
+            rec["degraded"] = rec["degraded"] or any(m in answer for m in LLM_DEGRADED_MARKERS)
+    except httpx.HTTPError as e:
+        rec["error"] = type(e).__name__
+    rec["latency"] = time.perf_counter() - t0
+    return rec
+
+
+async def run_load(
+    url: str,
+    pools: Dict[str, List[str]],
+    mix: Dict[str, float],
+    concurrency: int,
+    duration: float,
+    warmup: float,
+    stream: bool,
+    seed: int,
+    timeout: float,
+) -> Tuple[List[Dict[str, Any]], float]:
+    routes = [r for r in mix if pools.get(r)]
+    weights = [mix[r] for r in routes]
+    records: List[Dict[str, Any]] = []
+    t_start = time.perf_counter()
+    t_measure = t_start + warmup
+    t_end = t_measure + duration
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as http:
+
+        async def user(i: int) -> None:
+            rnd = random.Random(seed * 1000 + i)
+            while time.perf_counter() < t_end:
+                route = rnd.choices(routes, weights)[0]
+                rec = await ask(http, rnd.choice(pools[route]), stream)
+                if time.perf_counter() - rec["latency"] >= t_measure:
+                    rec["route"] = route
+                    records.append(rec)
+
+        await asyncio.gather(*(user(i) for i in range(concurrency)))
+    return records, time.perf_counter() - t_measure
+
+
+def latency_stats(values: List[float]) -> Dict[str, float]:
+    ms = [v * 1000.0 for v in values]
+    return {
+        "p50_ms": round(percentile(ms, 50), 1),
+        "p95_ms": round(percentile(ms, 95), 1),
+        "p99_ms": round(percentile(ms, 99), 1),
+        "max_ms": round(max(ms), 1) if ms else 0.0,
+    }
+
+
+def summarize(records: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    ok = [r for r in records if r["status"] == 200 and "error" not in r]
+    by_source: Dict[str, Dict[str, Any]] = {}
+    for src in sorted({r["source"] or "?" for r in ok}):
+        rs = [r for r in ok if (r["source"] or "?") == src]
+        entry = {"count": len(rs), **latency_stats([r["latency"] for r in rs])}
+        ttft = [r["ttft"] for r in rs if r["ttft"] is not None]
+        if ttft:
+            entry["ttft"] = latency_stats(ttft)
+        by_source[src] = entry
+
+    errors: Dict[str, int] = {}
+    for r in records:
+        if "error" in r:
+            key = r["error"]
+        elif r["status"] != 200:
+            key = f"http_{r['status']}"
+        elif r["degraded"]:
+            key = "llm_degraded"
+        else:
+            continue
+        errors[key] = errors.get(key, 0) + 1
+
+    n = len(records)
+    return {
+        "requests": n,
+        "elapsed_s": round(elapsed, 2),
+        "rps": round(n / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency": latency_stats([r["latency"] for r in ok]),
+        "error_rate": round(sum(errors.values()) / n, 4) if n else 0.0,
+        "errors": errors,
+        "routes": {k: sum(1 for r in records if r["route"] == k) for k in sorted({r["route"] for r in records})},
+        "by_source": by_source,
+    }
+
+
+def print_summary(rep: Dict[str, Any]) -> None:
+    s = rep["summary"]
+    print(
+        f"[LOAD] {rep['label']}: {s['requests']} richieste in {s['elapsed_s']}s → "
+        f"{s['rps']} req/s, p50={s['latency']['p50_ms']}ms p95={s['latency']['p95_ms']}ms "
+        f"p99={s['latency']['p99_ms']}ms, errori={s['error_rate']:.2%} {s['errors']}"
+    )
+    for src, e in s["by_source"].items():
+        print(f"[LOAD]   {src:<40} n={e['count']:<6} p50={e['p50_ms']}ms p95={e['p95_ms']}ms p99={e['p99_ms']}ms")
+
+
+def compare_reports(paths: List[str]) -> None:
+    print(f"{'report':<28}{'workers':>8}{'conc':>6}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'err%':>8}")
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            rep = json.load(f)
+        c, s = rep["config"], rep["summary"]
+        print(
+            f"{rep['label'][:27]:<28}{str(c.get('workers') or '-'):>8}{c['concurrency']:>6}"
+            f"{s['rps']:>9}{s['latency']['p50_ms']:>9}{s['latency']['p95_ms']:>9}"
+            f"{s['latency']['p99_ms']:>9}{s['error_rate'] * 100:>8.2f}"
+        )
+
+
+def standin_config() -> Dict[str, str]:
+    return {k: v for k, v in os.environ.items() if k.startswith("STANDIN_")}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Test di carico end-to-end del servizio GOLD")
+    ap.add_argument("--url", default="http://127.0.0.1:8000", help="app già in esecuzione")
+    ap.add_argument("--spawn", action="store_true", help="avvia stand-in LLM e app dal Procfile")
+    ap.add_argument("--workers", type=int, default=1, help="worker gunicorn con --spawn")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--standin-port", type=int, default=8099)
+    ap.add_argument("--cache", action="store_true", help="lascia attiva la cache risposte LLM")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--duration", type=float, default=30.0)
+    ap.add_argument("--warmup", type=float, default=3.0)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--mix", default=DEFAULT_MIX)
+    ap.add_argument("--stream", action="store_true", help="usa /api/ask/stream (misura anche il primo token)")
+    ap.add_argument("--seed", type=int, default=12)
+    ap.add_argument("--label", default=None)
+    ap.add_argument("--out", default=None, help="report JSON")
+    ap.add_argument("--compare", nargs="+", default=None, help="confronta report JSON esistenti")
+    args = ap.parse_args()
+
+    if args.compare:
+        compare_reports(args.compare)
+        return
+
+    mix = parse_mix(args.mix)
+    pools = build_pools()
+    print("[LOAD] domande per route: " + ", ".join(f"{k}={len(v)}" for k, v in pools.items()))
+
+    procs: List[subprocess.Popen] = []
+    url = args.url
+    if args.spawn:
+        url, procs = spawn_services(args)
+    try:
+        records, elapsed = asyncio.run(run_load(
+            url, pools, mix, args.concurrency, args.duration, args.warmup,
+            args.stream, args.seed, args.timeout,
+        ))
+        status = httpx.get(url + "/api/status", timeout=5.0).json()
+        # memoria di master e worker a fine carico (solo con --spawn)
+        memory = process_tree_memory(procs[-1].pid) if procs else None
+    finally:
+        stop_services(procs)
+
+    label = args.label or f"w{args.workers if args.spawn else '?'}-c{args.concurrency}{'-stream' if args.stream else ''}"
+    report = {
+        "label": label,
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "url": url,
+            "spawned": args.spawn,
+            "workers": args.workers if args.spawn else None,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "mix": mix,
+            "stream": args.stream,
+            "answer_cache": args.cache if args.spawn else None,
+            "standin": standin_config(),
+            "app_status": status,
+        },
+        "memory": memory,
+        "summary": summarize(records, elapsed),
+    }
+    print_summary(report)
+    if memory:
+        print(
+            f"[LOAD] memoria: PSS totale={memory['total_pss_mb']}MB "
+            f"USS medio per worker={memory['avg_worker_uss_mb']}MB ({len(memory['workers'])} worker)"
+        )
+
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[LOAD] report salvato in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
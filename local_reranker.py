@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+local_reranker.py
+-----------------
+Reranker locale per il routing GOLD: regressione logistica su feature
+lessicali e sui flag delle patch v12.x (vedi applastversion.rerank_features).
+
+- Il modello è un piccolo JSON (pesi + standardizzazione), addestrato offline
+  con train_reranker.py e caricato una volta all'avvio.
+- predict() costa pochi microsecondi per candidato: nessuna chiamata di rete.
+
+Dipendenze: solo libreria standard.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+def _sigmoid(z: float) -> float:
+    if z >= 0:
+        return 1.0 / (1.0 + math.exp(-z))
+    e = math.exp(z)
+    return e / (1.0 + e)
+
+
+class LocalReranker:
+    def __init__(
+        self,
+        features: List[str],
+        weights: List[float],
+        bias: float,
+        mean: List[float],
+        std: List[float],
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.features = features
+        self.weights = weights
+        self.bias = bias
+        self.mean = mean
+        self.std = std
+        self.meta = meta or {}
+
+    def score(self, row: Sequence[float]) -> float:
+        z = self.bias
+        for x, w, m, sd in zip(row, self.weights, self.mean, self.std):
+            z += w * ((x - m) / sd)
+        return _sigmoid(z)
+
+    def predict(self, rows: Sequence[Sequence[float]]) -> List[float]:
+        return [self.score(r) for r in rows]
+
+    # ---------------------------
+    # Persistenza
+    # ---------------------------
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "type": "logistic_regression",
+            "features": self.features,
+            "weights": [round(w, 6) for w in self.weights],
+            "bias": round(self.bias, 6),
+            "mean": [round(m, 6) for m in self.mean],
+            "std": [round(s, 6) for s in self.std],
+            "meta": self.meta,
+        }
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path: str, expected_features: Optional[List[str]] = None) -> Optional["LocalReranker"]:
+        """Carica il modello; None se manca o se le feature non coincidono."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                d = json.load(f)
+            model = cls(
+                features=list(d["features"]),
+                weights=[float(w) for w in d["weights"]],
+                bias=float(d["bias"]),
+                mean=[float(m) for m in d["mean"]],
+                std=[float(s) or 1.0 for s in d["std"]],
+                meta=d.get("meta") or {},
+            )
+        except Exception as e:
+            print(f"[RERANKER][WARN] modello non leggibile {path}: {e}")
+            return None
+        if expected_features is not None and model.features != list(expected_features):
+            print(f"[RERANKER][WARN] feature del modello diverse da quelle attese: {path}")
+            return None
+        return model
+
+
+# ============================================================
+# TRAINING (offline)
+# ============================================================
+
+def train_logistic(
+    X: List[List[float]],
+    y: List[int],
+    sample_weight: Optional[List[float]] = None,
+    epochs: int = 300,
+    lr: float = 0.5,
+    l2: float = 1e-3,
+) -> Tuple[List[float], float, List[float], List[float]]:
+    """
+    Regressione logistica pesata, discesa del gradiente full-batch su
+    feature standardizzate. Ritorna (pesi, bias, media, deviazione std).
+    """
+    n = len(X)
+    d = len(X[0]) if X else 0
+    sw = sample_weight or [1.0] * n
+    tot_w = sum(sw) or 1.0
+
+    mean = [sum(r[j] for r in X) / n for j in range(d)]
+    std = []
+    for j in range(d):
+        var = sum((r[j] - mean[j]) ** 2 for r in X) / n
+        std.append(math.sqrt(var) or 1.0)
+    Z = [[(r[j] - mean[j]) / std[j] for j in range(d)] for r in X]
+
+    # bilanciamento classi: i positivi sono pochi rispetto ai candidati
+    pos_w = sum(w for w, t in zip(sw, y) if t) or 1.0
+    neg_w = sum(w for w, t in zip(sw, y) if not t) or 1.0
+    cw = [w * (0.5 * tot_w / pos_w if t else 0.5 * tot_w / neg_w) for w, t in zip(sw, y)]
+
+    w = [0.0] * d
+    b = 0.0
+    for _ in range(epochs):
+        gw = [0.0] * d
+        gb = 0.0
+        for z, t, c in zip(Z, y, cw):
+            p = _sigmoid(b + sum(wj * zj for wj, zj in zip(w, z)))
+            err = (p - t) * c
+            gb += err
+            for j in range(d):
+                gw[j] += err * z[j]
+        for j in range(d):
+            w[j] -= lr * (gw[j] / tot_w + l2 * w[j])
+        b -= lr * gb / tot_w
+    return w, b, mean, std
@@ -1,43 +1,161 @@
 import os
 import openai
-from langdetect import detect
-from deep_translator import GoogleTranslator
 from dotenv import load_dotenv
 
+from lang_id import detect_lang
+from kb_watcher import stat_signature
+from scraper_tecnaria import (
+    BM25F_FIELDS,
+    BM25_K1,
+    BM25FIndex,
+    expand_query_synonyms,
+    item_fields,
+    list_txt_files,
+    normalize_text,
+    parse_passages,
+)
+
 load_dotenv()
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+# 📚 Cartelle dei documenti (separate da virgola), indicizzate una volta sola
+DOCUMENTI_DIRS = [d.strip() for d in os.getenv("DOCUMENTI_DIRS", "documenti").split(",") if d.strip()]
+# Nel prompt entrano solo i CONTEXT_TOP_K passaggi più pertinenti, entro CONTEXT_TOKEN_BUDGET token
+CONTEXT_TOP_K = int(os.getenv("CONTEXT_TOP_K", "6"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# I passaggi lunghi (testo libero) vengono divisi in blocchi di paragrafi di al massimo N caratteri
+PASSAGE_MAX_CHARS = int(os.getenv("PASSAGE_MAX_CHARS", "900"))
+# termini della domanda assenti dal corpus: si cercano i termini con lo stesso prefisso
+PREFIX_LEN = 5
+
+NESSUNA_INFO = {
+    "it": "Mi dispiace, non ho trovato informazioni pertinenti nei documenti forniti.",
+    "en": "I'm sorry, I could not find any relevant information in the documents provided.",
+}
+
+# Corpus indicizzato: sostituito in blocco quando i file cambiano
+_CORPUS = {"sig": None, "chunks": [], "bm25": None, "prefissi": {}}
+
+
+def stima_token(testo):
+    # stima prudente senza tokenizer: ~4 caratteri per token
+    return len(testo) // 4 + 1
+
+
+def _dividi_passaggio(p):
+    """Divide un passaggio lungo in blocchi di paragrafi consecutivi (ognuno con titolo e file)."""
+    paragrafi = [x.strip() for x in p["a"].split("\n\n") if x.strip()]
+    blocchi, corrente = [], []
+    for par in paragrafi:
+        if corrente and len("\n\n".join(corrente + [par])) > PASSAGE_MAX_CHARS:
+            blocchi.append(corrente)
+            corrente = []
+        corrente.append(par)
+    if corrente:
+        blocchi.append(corrente)
+
+    out = []
+    for i, blocco in enumerate(blocchi):
+        testo = "\n\n".join(blocco)
+        chunk = dict(p, a=testo, id=f"{p['id']}/{i}" if len(blocchi) > 1 else p["id"])
+        titolo = f"{p['q']}\n" if p.get("q") else ""
+        chunk["contesto"] = f"### FILE: {p['file']} ###\n{titolo}{testo}"
+        chunk["token"] = stima_token(chunk["contesto"])
+        out.append(chunk)
+    return out
+
+
+def _file_documenti():
+    paths = []
+    for d in DOCUMENTI_DIRS:
+        if os.path.isdir(d):
+            paths.extend(list_txt_files(d))
+    return paths
+
+
+def carica_corpus():
+    """Indicizza i documenti alla prima chiamata e di nuovo solo se file/mtime/dimensioni cambiano."""
+    paths = _file_documenti()
+    sig = stat_signature(paths)
+    if sig == _CORPUS["sig"]:
+        return _CORPUS
+
+    chunks = []
+    for percorso in paths:
+        try:
+            for p in parse_passages(percorso):
+                chunks.extend(_dividi_passaggio(p))
+        except Exception as e:
+            print(f"[DOCUMENTI][WARN] Errore nella lettura di {percorso}: {e}")
+
+    bm25 = BM25FIndex([item_fields(c) for c in chunks], BM25F_FIELDS, BM25_K1) if chunks else None
+    # prefisso (5 caratteri) -> termini del corpus, per le flessioni (ordine/ordini)
+    prefissi = {}
+    for t in (bm25.postings if bm25 else {}):
+        if len(t) >= PREFIX_LEN:
+            prefissi.setdefault(t[:PREFIX_LEN], []).append(t)
+    _CORPUS.update({"sig": sig, "chunks": chunks, "bm25": bm25, "prefissi": prefissi})
+    print(f"[DOCUMENTI] {len(chunks)} passaggi da {len(paths)} file")
+    return _CORPUS
+
+
+def costruisci_contesto(domanda, top_k=None, budget=None):
+    """Testo dei passaggi più pertinenti alla domanda, entro il budget di token."""
+    top_k = top_k or CONTEXT_TOP_K
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    corpus = carica_corpus()
+    if corpus["bm25"] is None:
+        return ""
+
+    base = normalize_text(domanda)
+    tokens = list(dict.fromkeys(expand_query_synonyms(base).split() + base.split()))
+    for t in list(tokens):
+        if t not in corpus["bm25"].postings and len(t) >= PREFIX_LEN:
+            tokens.extend(corpus["prefissi"].get(t[:PREFIX_LEN], []))
+    scores = corpus["bm25"].get_scores(tokens)
+    ranking = sorted(
+        (i for i in range(len(corpus["chunks"])) if scores[i] > 0),
+        key=lambda i: -scores[i],
+    )[:top_k]
+
+    parti, usati = [], 0
+    for i in ranking:
+        c = corpus["chunks"][i]
+        if usati + c["token"] > budget:
+            if parti:
+                continue
+            # il passaggio migliore da solo supera il budget: si tronca
+            parti.append(c["contesto"][: budget * 4])
+            break
+        parti.append(c["contesto"])
+        usati += c["token"]
+    return "\n\n".join(parti)
+
+
 def ottieni_risposta_unificata(domanda):
     try:
-        # 🔍 Legge tutti i file .txt nella cartella /documenti
-        documenti_dir = "documenti"
-        contesto = ""
-        for nome_file in os.listdir(documenti_dir):
-            if nome_file.endswith(".txt"):
-                percorso = os.path.join(documenti_dir, nome_file)
-                try:
-                    with open(percorso, "r", encoding="utf-8") as f:
-                        contesto += f"\n\n### FILE: {nome_file} ###\n"
-                        contesto += f.read()
-                except Exception as e:
-                    contesto += f"\n[Errore nella lettura di {nome_file}: {e}]\n"
-
-        # 🔤 Traduzione domanda (per compatibilità con OpenAI)
-        lingua_originale = detect(domanda)
-        domanda_en = GoogleTranslator(source='auto', target='en').translate(domanda)
+        # 🔍 Solo i passaggi pertinenti dei documenti (indicizzati una volta)
+        contesto = costruisci_contesto(domanda)
+
+        # 🔤 Lingua della domanda (fastText locale, nessuna chiamata di rete):
+        # il modello risponde direttamente in quella lingua
+        lingua_originale = detect_lang(domanda, default="it")
+        if not contesto:
+            return NESSUNA_INFO.get(lingua_originale, NESSUNA_INFO["en"])
 
         # ⚠️ Prompt rigido: NO invenzioni
-        prompt = f"""You are a technical assistant for the company Tecnaria. 
-Only answer using the content provided in the 'context' below. 
+        prompt = f"""You are a technical assistant for the company Tecnaria.
+Only answer using the content provided in the 'context' below.
 If the answer is not explicitly found in the context, simply reply:
 "I'm sorry, I could not find any relevant information in the documents provided."
+Always answer in the language of the question (ISO code: {lingua_originale}).
 
 CONTEXT:
 {contesto}
 
 QUESTION:
-{domanda_en}
+{domanda}
 """
 
         # 🧠 Chiamata all’API OpenAI
@@ -51,15 +169,7 @@ QUESTION:
             max_tokens=1200
         )
 
-        risposta_en = response.choices[0].message["content"]
-
-        # 🔁 Traduzione finale nella lingua dell’utente
-        if lingua_originale != "en":
-            risposta = GoogleTranslator(source='en', target=lingua_originale).translate(risposta_en)
-        else:
-            risposta = risposta_en
-
-        return risposta
+        return response.choices[0].message["content"]
 
     except Exception as e:
         return f"Errore durante l'elaborazione: {e}"
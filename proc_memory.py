@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+proc_memory.py
+--------------
+Metriche di memoria per processo, per verificare quanta KB è condivisa
+tra i worker gunicorn (preload + copy-on-write).
+
+- rss: memoria residente (conta anche le pagine condivise con il master)
+- pss: quota proporzionale (pagine condivise divise tra i processi che le usano)
+- uss: memoria privata del processo (Private_Clean + Private_Dirty)
+- shared: pagine condivise (Shared_Clean + Shared_Dirty)
+
+Su Linux i valori vengono da /proc/<pid>/smaps_rollup; altrove solo il picco
+RSS da resource (quando disponibile).
+
+Dipendenze: solo libreria standard.
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Any, Dict, List
+
+_FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Private_Clean": "uss",
+    "Private_Dirty": "uss",
+    "Shared_Clean": "shared",
+    "Shared_Dirty": "shared",
+}
+
+
+def process_memory(pid: int = 0) -> Dict[str, Any]:
+    """Memoria del processo in MB (pid=0 → processo corrente)."""
+    pid = pid or os.getpid()
+    out: Dict[str, Any] = {"pid": pid}
+    path = f"/proc/{pid}/smaps_rollup"
+    if os.path.exists(path):
+        kb = {"rss": 0, "pss": 0, "uss": 0, "shared": 0}
+        with open(path, "r") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                key = _FIELDS.get(name)
+                if key:
+                    kb[key] += int(rest.split()[0])
+        out.update({f"{k}_mb": round(v / 1024.0, 1) for k, v in kb.items()})
+        return out
+
+    try:
+        import resource
+        import sys
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux riporta KB, macOS byte
+        out["max_rss_mb"] = round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+    except Exception:
+        pass
+    return out
+
+
+def child_pids(pid: int) -> List[int]:
+    """Figli diretti di un processo (Linux)."""
+    pids: List[int] = []
+    task_dir = f"/proc/{pid}/task"
+    if not os.path.isdir(task_dir):
+        return pids
+    for tid in os.listdir(task_dir):
+        try:
+            with open(f"{task_dir}/{tid}/children", "r") as f:
+                pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def process_tree_memory(master_pid: int) -> Dict[str, Any]:
+    """Memoria del master gunicorn e di ogni worker, con i totali PSS/USS."""
+    master = process_memory(master_pid)
+    workers = [process_memory(p) for p in child_pids(master_pid)]
+    procs = [master] + workers
+    return {
+        "master": master,
+        "workers": workers,
+        "total_pss_mb": round(sum(p.get("pss_mb", 0.0) for p in procs), 1),
+        "total_uss_mb": round(sum(p.get("uss_mb", 0.0) for p in procs), 1),
+        "avg_worker_uss_mb": round(
+            sum(p.get("uss_mb", 0.0) for p in workers) / len(workers), 1
+        ) if workers else 0.0,
+    }
@@ -2,24 +2,37 @@
 """
 scraper_tecnaria.py
 - Indicizza tutti i .txt in DOC_DIR (default: documenti_gTab)
-- Estrae TAG e coppie D:/R: (domanda/risposta)
-- Retrieval ibrido: BM25 (rank-bm25) + keyword overlap + fuzzy (rapidfuzz) + boost TAG/nome file
+- Divide ogni file in passaggi (coppie D:/R:, sezioni === Titolo ===, testo libero)
+  con ID stabile e offset in byte; il ranking è direttamente sui passaggi
+- Indice incrementale: passaggi e manifest (mtime/dimensione/hash per file) salvati in
+  SCRAPER_INDEX_PATH; a ogni build_index si ri-leggono solo i file cambiati
+- Reindicizzazione su copie: passaggi e BM25F vengono pubblicati insieme con un solo
+  assegnamento, le ricerche in corso restano sullo snapshot precedente
+- Retrieval ibrido: BM25F nativo (campi pesati) + keyword overlap + fuzzy (rapidfuzz) + boost TAG/nome file
 - Ritorna SOLO la risposta (mai "D:" in output). Aggiunge opzionale arricchimento Sinapsi (topics/rules).
-- Robusto: se BM25/rapidfuzz mancano, cade su keyword senza errori.
+- Robusto: senza NumPy il BM25F usa Python puro; senza rapidfuzz un fuzzy minimale.
 
 API esposte:
 - build_index(doc_dir) -> int
 - is_ready() -> bool
-- search_best_answer(q) -> {answer, found, score, from, tags, matched_question?}
-- INDEX -> indice globale (for debugging/log)
+- search_best_answer(q) -> {answer, found, score, from, tags, passage, span, matched_question?}
+- INDEX -> passaggi indicizzati dell'ultimo snapshot (for debugging/log, sola lettura)
 """
 
 from __future__ import annotations
 import os
 import re
 import json
+import math
+import copy
+import hashlib
+import threading
+import time
 import unicodedata
-from typing import Any, Dict, List, Tuple, Optional
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from answer_cache import fingerprint
+from kb_snapshot import SnapshotStore
 
 # ===== Dipendenze soft =====
 try:
@@ -27,11 +40,6 @@ try:
 except Exception:
     np = None
 
-try:
-    from rank_bm25 import BM25Okapi
-except Exception:
-    BM25Okapi = None
-
 try:
     from rapidfuzz import fuzz
 except Exception:
@@ -46,21 +54,61 @@ except Exception:
     fuzz = _F()
 
 # ===== ENV =====
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DOC_DIR = os.getenv("DOC_DIR", "documenti_gTab")
 SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", os.getenv("SIM_THRESHOLD", "0.30")))
 TOP_K = int(os.getenv("TOP_K", os.getenv("TOPK_SEMANTIC", "8")))
 MIN_CHARS_PER_CHUNK = int(os.getenv("MIN_CHARS_PER_CHUNK", "500"))
 MAX_ANSWER_CHARS = int(os.getenv("MAX_ANSWER_CHARS", "1200"))
+# overlap e fuzzy solo sui primi N passaggi per BM25F (costo indipendente dal corpus)
+FUZZY_SHORTLIST = int(os.getenv("FUZZY_SHORTLIST", "32"))
 DEBUG = os.getenv("DEBUG_SCRAPER", os.getenv("DEBUG", "0")) == "1"
 
+# BM25F: saturazione k1 e, per campo, (peso, normalizzazione di lunghezza b)
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25F_FIELDS: Dict[str, Tuple[float, float]] = {
+    "name": (3.0, 0.0),    # nome file
+    "tags": (2.0, 0.3),    # [TAGS: ...]
+    "q": (2.5, 0.5),       # domanda D: o titolo === sezione ===
+    "a": (1.0, 0.75),      # risposta R: o corpo della sezione
+    "text": (0.5, 0.75),   # testo libero fuori da coppie D/R e sezioni
+}
+# override dei pesi: BM25F_WEIGHTS="name=3,tags=2,q=2.5,a=1,text=0.5"
+for _part in os.getenv("BM25F_WEIGHTS", "").split(","):
+    if "=" in _part:
+        _k, _v = _part.split("=", 1)
+        if _k.strip() in BM25F_FIELDS:
+            BM25F_FIELDS[_k.strip()] = (float(_v), BM25F_FIELDS[_k.strip()][1])
+
+# indice persistito (passaggi + manifest dei file); vuoto = solo in memoria
+SCRAPER_INDEX_PATH = os.getenv("SCRAPER_INDEX_PATH", os.path.join(BASE_DIR, ".cache", "scraper_index.bin"))
+SCRAPER_INDEX_FORMAT = "scraper-index-2"
+# parsing su pool di processi quando i file da (ri)leggere sono almeno SCRAPER_PARALLEL_MIN
+SCRAPER_WORKERS = int(os.getenv("SCRAPER_WORKERS", str(min(8, os.cpu_count() or 1))))
+SCRAPER_PARALLEL_MIN = int(os.getenv("SCRAPER_PARALLEL_MIN", "16"))
+# fino a BM25_FULL_REBUILD_MAX passaggi ogni modifica ricostruisce BM25F dai token in memoria
+# (~45 µs a passaggio): ranking identico a una costruzione completa. Oltre, aggiornamento
+# incrementale finché le lunghezze medie non si scostano più di BM25_AVGLEN_DRIFT
+BM25_FULL_REBUILD_MAX = int(os.getenv("BM25_FULL_REBUILD_MAX", "5000"))
+BM25_AVGLEN_DRIFT = float(os.getenv("BM25_AVGLEN_DRIFT", "0.2"))
+
 SINAPSI_ENABLE = os.getenv("SINAPSI_ENABLE", "1") == "1"
 SINAPSI_PATH = os.getenv("SINAPSI_BOT_JSON", "SINAPSI_BOT.JSON")
 
 # ===== Stato globale =====
-INDEX: List[Dict[str, Any]] = []
-_BM25: Optional[BM25Okapi] = None
-_CORPUS_TOKENS: List[List[str]] = []
-_SINAPSI: Dict[str, Any] = {}
+# snapshot pubblicato (passaggi, BM25F, n. passaggi vivi): le ricerche leggono _LIVE
+# una volta sola, build_index lavora su copie e lo sostituisce con un solo assegnamento (_publish)
+_LIVE: Tuple[List[Optional[Dict[str, Any]]], Optional["BM25FIndex"], int] = ([], None, 0)
+INDEX: List[Optional[Dict[str, Any]]] = []  # = _LIVE[0]; slot liberi = None (vedi _sync_files)
+_BM25: Optional["BM25FIndex"] = None        # = _LIVE[1]
+_BUILD_LOCK = threading.Lock()  # una indicizzazione alla volta (manifest e copie di lavoro)
+_MANIFEST: Dict[str, Dict[str, Any]] = {}     # path relativo -> {mtime_ns, size, sha1, slots}
+_INDEX_DIR: Optional[str] = None
+_INDEX_STORE = SnapshotStore(SCRAPER_INDEX_PATH or None)
+_SAVE_LOCK = threading.Lock()
+_SAVE_THREAD: Optional[threading.Thread] = None
+_SINAPSI: Optional["SinapsiEngine"] = None
+_SINAPSI_SIG: Optional[Tuple[int, int]] = None
 
 # ===== Stopwords / Normalizzazione =====
 STOPWORDS_MIN = {
@@ -112,64 +160,105 @@ def expand_query_synonyms(q: str) -> str:
             seen.add(t)
     return " ".join(out)
 
-# ===== Parsing TXT =====
+# ===== Parsing TXT (passaggi) =====
 _TAGS_RE = re.compile(r"^\s*\[TAGS\s*:\s*(.*?)\]\s*$", re.IGNORECASE)
 _D_RE = re.compile(r"^\s*(D|DOMANDA)\s*:\s*(.*)$", re.IGNORECASE)
 _R_RE = re.compile(r"^\s*(R|RISPOSTA)\s*:\s*(.*)$", re.IGNORECASE)
-
-def parse_txt_file(path: str) -> Dict[str, Any]:
+# titolo obbligatorio: "======" da solo è un separatore decorativo (_RULE_RE), non una sezione
+_SECTION_RE = re.compile(r"^\s*={3,}\s*([^=\s].*?)\s*={3,}\s*$")
+_RULE_RE = re.compile(r"^\s*[─━—\-_=*]{3,}(?:\s+[─━—\-_=*]{3,})*\s*$")
+
+def _passage_id(name: str, kind: str, key: str, seen: Dict[str, int]) -> str:
+    """ID stabile: file + tipo + hash del titolo/domanda (non cambia se il passaggio si sposta)."""
+    h = hashlib.sha1(normalize_text(key).encode("utf-8")).hexdigest()[:10]
+    pid = f"{name}#{kind}-{h}"
+    seen[pid] = seen.get(pid, 0) + 1
+    return pid if seen[pid] == 1 else f"{pid}-{seen[pid]}"
+
+def parse_passages(path: str, data: Optional[bytes] = None) -> List[Dict[str, Any]]:
+    """
+    Divide un .txt in passaggi autonomi:
+    - "qa": una coppia D:/R: (la risposta prosegue fino alla D: o sezione successiva)
+    - "section": un blocco introdotto da un'intestazione === Titolo ===
+    - "text": testo libero prima della prima D:/sezione
+    Ogni passaggio ha un ID stabile e gli offset in byte [start, end) nel file;
+    i [TAGS: ...] valgono per tutto il file.
+    """
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    raw_lines = data.splitlines(keepends=True)
+
+    file = os.path.basename(path)
+    name = os.path.splitext(file)[0].lower()
     tags: List[str] = []
-    qas: List[Dict[str, str]] = []
-    text_lines: List[str] = []
-
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        lines = f.read().splitlines()
-
-    cur_q: Optional[str] = None
-    cur_a: List[str] = []
+    units: List[Dict[str, Any]] = []
+    cur: Optional[Dict[str, Any]] = None
+    offset = 0
 
-    for raw in lines:
-        line = raw.rstrip("\n")
+    for raw in raw_lines:
+        line_start, offset = offset, offset + len(raw)
+        line = raw.decode("utf-8", errors="ignore").rstrip("\r\n")
 
         m_tags = _TAGS_RE.match(line)
         if m_tags:
-            tline = m_tags.group(1)
-            parts = [t.strip() for t in tline.split(",") if t.strip()]
-            tags.extend(parts)
+            tags.extend(t.strip() for t in m_tags.group(1).split(",") if t.strip())
+            continue
+        if _RULE_RE.match(line) and not _SECTION_RE.match(line):
             continue
 
+        m_sec = _SECTION_RE.match(line)
         m_d = _D_RE.match(line)
-        if m_d:
-            if cur_q is not None:
-                qas.append({"q": (cur_q or "").strip(), "a": "\n".join(cur_a).strip()})
-            cur_q = m_d.group(2).strip()
-            cur_a = []
+        if m_sec or m_d:
+            cur = {
+                "kind": "section" if m_sec else "qa",
+                "q": (m_sec.group(1) if m_sec else m_d.group(2)).strip(),
+                "lines": [],
+                "start": line_start,
+                "end": offset,
+            }
+            units.append(cur)
             continue
 
+        if cur is None:
+            if not line.strip():
+                continue
+            cur = {"kind": "text", "q": "", "lines": [], "start": line_start, "end": offset}
+            units.append(cur)
+
         m_r = _R_RE.match(line)
-        if m_r:
-            cur_a.append(m_r.group(2))
+        cur["lines"].append(m_r.group(2) if (m_r and cur["kind"] == "qa") else line)
+        if line.strip():
+            cur["end"] = offset
+
+    norm_tags = [normalize_text(t) for t in tags]
+    seen: Dict[str, int] = {}
+    out: List[Dict[str, Any]] = []
+    for u in units:
+        body = "\n".join(u["lines"]).strip()
+        if not body:
             continue
-
-        # linea generica
-        text_lines.append(line)
-        if cur_q is not None:
-            cur_a.append(line)
-
-    if cur_q is not None:
-        qas.append({"q": (cur_q or "").strip(), "a": "\n".join(cur_a).strip()})
-
-    full_text = "\n".join(text_lines).strip()
-    return {
-        "file": os.path.basename(path),
-        "path": path,
-        "name": os.path.splitext(os.path.basename(path))[0].lower(),
-        "tags": tags,
-        "norm_tags": [normalize_text(t) for t in tags],
-        "qas": qas,
-        "text": full_text,
-        "norm": normalize_text(full_text)
-    }
+        if u["kind"] == "text" and len(body) < MIN_CHARS_PER_CHUNK:
+            continue
+        norm = normalize_text(f"{u['q']}\n{body}")
+        out.append({
+            "id": _passage_id(name, u["kind"], u["q"] or body[:200], seen),
+            "kind": u["kind"],
+            "file": file,
+            "path": path,
+            "name": name,
+            "start": u["start"],
+            "end": u["end"],
+            "tags": tags,
+            "norm_tags": norm_tags,
+            "q": u["q"],
+            "a": body,
+            "norm": norm,
+            "norm_set": frozenset(norm.split()),
+            # il fuzzy confronta la query con la domanda (D:) o il titolo, se presenti
+            "fuzzy_norm": normalize_text(u["q"]) or norm,
+        })
+    return out
 
 def list_txt_files(doc_dir: str) -> List[str]:
     out = []
@@ -180,87 +269,451 @@ def list_txt_files(doc_dir: str) -> List[str]:
     out.sort()
     return out
 
-# ===== Indicizzazione =====
-def _build_bm25(items: List[Dict[str, Any]]) -> Tuple[Optional[BM25Okapi], List[List[str]]]:
-    if BM25Okapi is None or np is None:
-        return None, []
-    corpus_tokens: List[List[str]] = []
-    for it in items:
-        toks = []
-        if it.get("norm"):
-            toks.extend(it["norm"].split())
-        for qa in it.get("qas", []):
-            qn = normalize_text(qa.get("q", ""))
-            toks.extend(qn.split())
-            an = normalize_text(qa.get("a", ""))
-            # (opzionale) includiamo anche risposta per migliorare recall
-            toks.extend(an.split())
-        corpus_tokens.append([t for t in toks if t])
-    if not corpus_tokens:
-        return None, []
-    try:
-        bm25 = BM25Okapi(corpus_tokens)
-        return bm25, corpus_tokens
-    except Exception:
-        return None, []
+# ===== BM25F =====
+def item_fields(it: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Token normalizzati per campo BM25F di un passaggio."""
+    is_text = it.get("kind") == "text"
+    return {
+        "name": normalize_text(it.get("name", "").replace("_", " ")).split(),
+        "tags": " ".join(it.get("norm_tags", [])).split(),
+        "q": normalize_text(it.get("q", "")).split(),
+        "a": [] if is_text else normalize_text(it.get("a", "")).split(),
+        "text": normalize_text(it.get("a", "")).split() if is_text else [],
+    }
 
-def build_index(doc_dir: Optional[str] = None) -> int:
-    """Costruisce indice globale e carica Sinapsi."""
-    global INDEX, _BM25, _CORPUS_TOKENS, _SINAPSI
-    base = doc_dir or DOC_DIR
-    print(f"[SCRAPER] Indicizzazione da: {os.path.abspath(base)}", flush=True)
 
-    if not os.path.exists(base):
-        INDEX = []
-        _BM25 = None
-        _CORPUS_TOKENS = []
-        print(f"[SCRAPER][WARN] DOC_DIR non esiste: {base}", flush=True)
-        return 0
+class BM25FIndex:
+    """
+    BM25F (Robertson/Zaragoza): per ogni termine la frequenza viene combinata
+    sui campi con peso e normalizzazione di lunghezza propri,
+        tf~ = sum_f w_f * tf_f / (1 - b_f + b_f * len_f / avglen_f)
+    poi saturata una volta sola: idf * tf~ / (k1 + tf~).
+    La parte tf~ / (k1 + tf~) dipende solo dal documento ed è precalcolata
+    nelle posting list; l'idf (da df e numero di documenti) si applica a
+    query time, così aggiungere o togliere documenti tocca solo le posting
+    dei loro termini (update). Le lunghezze medie restano quelle della
+    costruzione: drift() dice quanto se ne sono allontanate, quindi dopo un
+    update i punteggi differiscono da una costruzione completa entro quello
+    scarto (e a parità di punteggio conta l'ordine degli slot).
+
+    Gli ID documento sono posizioni (slot) in INDEX; gli slot liberi
+    restano senza posting e prendono punteggio 0.
+    """
+
+    def __init__(
+        self,
+        docs_fields: List[Optional[Dict[str, List[str]]]],
+        fields: Dict[str, Tuple[float, float]],
+        k1: float = 1.2,
+    ) -> None:
+        self.fields = fields
+        self.k1 = k1
+        live = [d for d in docs_fields if d is not None]
+        self.built_avglen = {
+            f: sum(len(d.get(f, [])) for d in live) / len(live) if live else 0.0
+            for f in fields
+        }
+        self.avglen = {f: v or 1.0 for f, v in self.built_avglen.items()}
+        self.n_docs = 0
+        self.size = 0
+        self.len_sum = {f: 0 for f in fields}
+        # slot -> (termini, lunghezze per campo), per poter togliere il documento
+        self.docs: Dict[int, Tuple[Tuple[str, ...], Dict[str, int]]] = {}
+        # posting compatte: (slot, contributo saturato senza idf)
+        self.postings: Dict[str, Tuple[Any, Any]] = {}
+        self.update([], [(i, d) for i, d in enumerate(docs_fields) if d is not None], len(docs_fields))
+
+    def _saturated(self, d: Dict[str, List[str]]) -> Dict[str, float]:
+        tf_weighted: Dict[str, float] = {}
+        for f, (w, b) in self.fields.items():
+            toks = d.get(f, [])
+            if not toks or w <= 0:
+                continue
+            norm = 1.0 - b + b * len(toks) / self.avglen[f]
+            counts: Dict[str, int] = {}
+            for t in toks:
+                counts[t] = counts.get(t, 0) + 1
+            for t, c in counts.items():
+                tf_weighted[t] = tf_weighted.get(t, 0.0) + w * c / norm
+        return {t: v / (self.k1 + v) for t, v in tf_weighted.items()}
+
+    def copy(self) -> "BM25FIndex":
+        """Copia da aggiornare fuori linea: update sostituisce le posting, non le modifica."""
+        other = copy.copy(self)
+        other.postings = dict(self.postings)
+        other.docs = dict(self.docs)
+        other.len_sum = dict(self.len_sum)
+        return other
+
+    def update(
+        self,
+        removed: List[int],
+        added: List[Tuple[int, Dict[str, List[str]]]],
+        size: int,
+    ) -> None:
+        """Toglie gli slot `removed` e indicizza `added`; tocca solo le posting dei termini coinvolti."""
+        self.size = size
+        gone: Dict[str, Set[int]] = {}
+        for doc_id in removed:
+            entry = self.docs.pop(doc_id, None)
+            if entry is None:
+                continue
+            terms, lens = entry
+            self.n_docs -= 1
+            for f, n in lens.items():
+                self.len_sum[f] -= n
+            for t in terms:
+                gone.setdefault(t, set()).add(doc_id)
+
+        new: Dict[str, List[Tuple[int, float]]] = {}
+        for doc_id, d in added:
+            w = self._saturated(d)
+            self.docs[doc_id] = (tuple(w), {f: len(d.get(f, [])) for f in self.fields})
+            self.n_docs += 1
+            for f in self.fields:
+                self.len_sum[f] += len(d.get(f, []))
+            for t, v in w.items():
+                new.setdefault(t, []).append((doc_id, v))
+
+        for t in set(gone) | set(new):
+            drop = gone.get(t)
+            add = new.get(t, [])
+            if np is not None:
+                ids, vals = self.postings.get(t, (np.empty(0, np.int32), np.empty(0, np.float32)))
+                if drop:
+                    keep = ~np.isin(ids, np.fromiter(drop, dtype=np.int32, count=len(drop)))
+                    ids, vals = ids[keep], vals[keep]
+                if add:
+                    ids = np.concatenate([ids, np.asarray([i for i, _ in add], dtype=np.int32)])
+                    vals = np.concatenate([vals, np.asarray([v for _, v in add], dtype=np.float32)])
+            else:
+                ids, vals = self.postings.get(t, ([], []))
+                pairs = [(i, v) for i, v in zip(ids, vals) if not drop or i not in drop] + add
+                ids, vals = [i for i, _ in pairs], [v for _, v in pairs]
+            if len(ids):
+                self.postings[t] = (ids, vals)
+            else:
+                self.postings.pop(t, None)
+
+    def drift(self) -> float:
+        """Scarto relativo massimo tra lunghezze medie attuali e quelle usate nelle posting."""
+        if not self.n_docs:
+            return 0.0
+        return max(
+            abs(self.len_sum[f] / self.n_docs - self.built_avglen[f]) / max(self.built_avglen[f], 1.0)
+            for f, (w, _) in self.fields.items() if w > 0
+        )
+
+    def get_scores_batch(self, queries: List[List[str]]):
+        """
+        Punteggi di più query in un solo passaggio sulle posting list:
+        ogni termine viene letto una volta e sommato nelle righe delle
+        query che lo contengono. Matrice (n. query x n. slot).
+        """
+        rows_by_term: Dict[str, List[int]] = {}
+        for qi, toks in enumerate(queries):
+            for t in dict.fromkeys(toks):
+                if t in self.postings:
+                    rows_by_term.setdefault(t, []).append(qi)
+
+        n = self.n_docs
+        if np is not None:
+            scores = np.zeros((len(queries), self.size), dtype=np.float32)
+            for t, rows in rows_by_term.items():
+                ids, vals = self.postings[t]
+                df = len(ids)
+                contrib = vals * math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+                for qi in rows:
+                    scores[qi, ids] += contrib
+            return scores
+        scores = [[0.0] * self.size for _ in queries]
+        for t, rows in rows_by_term.items():
+            ids, vals = self.postings[t]
+            idf = math.log(1.0 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            for qi in rows:
+                row = scores[qi]
+                for i, v in zip(ids, vals):
+                    row[i] += idf * v
+        return scores
+
+    def get_scores(self, query_tokens: List[str]):
+        """Punteggio di tutti gli slot (array NumPy, o lista senza NumPy)."""
+        return self.get_scores_batch([query_tokens])[0]
+
+
+def _normalized_bm25_batch(bm25: Optional[BM25FIndex], size: int, queries: List[List[str]]) -> List[Any]:
+    """Per ogni query i punteggi BM25F divisi per il proprio massimo."""
+    if bm25 is None:
+        return [[0.0] * size for _ in queries]
+    out = []
+    for row in bm25.get_scores_batch(queries):
+        top = (float(row.max()) if np is not None else max(row)) if len(row) else 0.0
+        if top <= 0:
+            out.append(row)
+        else:
+            out.append(row / top if np is not None else [v / top for v in row])
+    return out
 
-    paths = list_txt_files(base)
-    print(f"[SCRAPER] Trovati {len(paths)} file .txt", flush=True)
 
-    items: List[Dict[str, Any]] = []
-    for p in paths:
-        try:
-            it = parse_txt_file(p)
-            # filtra i blocchi troppo corti, ma garantisci almeno 1 item per file
-            keep = (len((it.get("text") or "")) >= MIN_CHARS_PER_CHUNK) or it.get("qas")
-            if keep:
-                items.append(it)
-        except Exception as e:
-            print(f"[SCRAPER][WARN] Errore parsing {p}: {e}", flush=True)
+def _shortlist(score_rows: List[Any], n: int, limit: int) -> List[int]:
+    """Indici dei migliori `limit` tra `n` passaggi (massimo tra le varianti), in ordine di slot."""
+    if n <= limit:
+        return list(range(n))
+    if np is not None:
+        best = np.max(np.vstack(score_rows), axis=0)
+        top = np.argpartition(-best, limit - 1)[:limit]
+        return sorted(int(i) for i in top)
+    best = [max(col) for col in zip(*score_rows)]
+    return sorted(sorted(range(n), key=lambda i: -best[i])[:limit])
+
 
-    # BM25
-    _BM25, _CORPUS_TOKENS = _build_bm25(items)
+# ===== Indicizzazione (incrementale) =====
+def _file_sha1(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
 
-    # carica Sinapsi
-    _SINAPSI = {}
-    if SINAPSI_ENABLE:
+def _parse_file_job(path: str) -> Tuple[str, Optional[Dict[str, Any]], Any]:
+    """Lavoro di un processo del pool: (path, voce di manifest, passaggi con token) o errore."""
+    try:
+        st = os.stat(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        passages = parse_passages(path, data)
+        for it in passages:
+            it["fields"] = item_fields(it)
+        entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha1": hashlib.sha1(data).hexdigest()}
+        return path, entry, passages
+    except Exception as e:
+        return path, None, str(e)
+
+def _parse_files(paths: List[str]) -> List[Tuple[str, Optional[Dict[str, Any]], Any]]:
+    """Parsing dei file cambiati; in parallelo su un pool di processi se sono tanti."""
+    if len(paths) >= SCRAPER_PARALLEL_MIN and SCRAPER_WORKERS > 1:
         try:
-            if os.path.exists(SINAPSI_PATH):
-                with open(SINAPSI_PATH, "r", encoding="utf-8", errors="ignore") as f:
-                    _SINAPSI = json.load(f) or {}
-                print(f"[SCRAPER] Sinapsi ON (rules={len(_SINAPSI.get('rules', []))}, topics={len(_SINAPSI.get('topics', {}))}) file={SINAPSI_PATH}", flush=True)
-            else:
-                print(f"[SCRAPER] Sinapsi file non trovato: {os.path.abspath(SINAPSI_PATH)}", flush=True)
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=SCRAPER_WORKERS) as pool:
+                return list(pool.map(_parse_file_job, paths, chunksize=8))
         except Exception as e:
-            print(f"[SCRAPER][WARN] Errore lettura Sinapsi: {e}", flush=True)
+            print(f"[SCRAPER][WARN] pool di processi non disponibile, parsing sequenziale: {e}", flush=True)
+    return [_parse_file_job(p) for p in paths]
+
+def _index_source_hash(base_abs: str) -> str:
+    """Firma di ciò che determina il contenuto dell'indice salvato (non i file, che sono nel manifest)."""
+    return fingerprint([SCRAPER_INDEX_FORMAT, base_abs, repr(sorted(BM25F_FIELDS.items())), str(MIN_CHARS_PER_CHUNK)])
+
+def _publish(index: List[Optional[Dict[str, Any]]], bm25: Optional[BM25FIndex]) -> None:
+    """Rende visibile il nuovo snapshot con un solo assegnamento (_LIVE)."""
+    global _LIVE, INDEX, _BM25
+    _LIVE = (index, bm25, sum(1 for it in index if it is not None))
+    INDEX, _BM25 = index, bm25
+
+def _rebuild_bm25(index: List[Optional[Dict[str, Any]]]) -> Tuple[List[Dict[str, Any]], Optional[BM25FIndex]]:
+    """Compatta gli slot (ordine file/offset) e ricostruisce BM25F dai token già in memoria."""
+    live = sorted((it for it in index if it is not None), key=lambda it: (it["path"], it["start"]))
+    for entry in _MANIFEST.values():
+        entry["slots"] = []
+    for slot, it in enumerate(live):
+        rel = it.get("rel")
+        if rel in _MANIFEST:
+            _MANIFEST[rel]["slots"].append(slot)
+    return live, (BM25FIndex([it["fields"] for it in live], BM25F_FIELDS, BM25_K1) if live else None)
+
+def _load_persisted(base_abs: str) -> None:
+    """Riparte dall'indice salvato (passaggi + manifest) se compatibile, altrimenti da vuoto."""
+    global _MANIFEST, _INDEX_DIR
+    _MANIFEST, _INDEX_DIR = {}, base_abs
+    index: List[Optional[Dict[str, Any]]] = []
+    payload = None
+    if _INDEX_STORE.path:
+        if _SAVE_THREAD is not None:
+            _SAVE_THREAD.join()
+        payload = _INDEX_STORE.load("scraper", _index_source_hash(base_abs))
+    if payload:
+        index = payload.get("passages") or []
+        for it in index:
+            if it is not None:
+                it["norm_set"] = frozenset(it["norm"].split())
+        _MANIFEST = payload.get("manifest") or {}
+    _publish(index, BM25FIndex([it["fields"] if it else None for it in index], BM25F_FIELDS, BM25_K1) if index else None)
+
+def _write_persisted(source_hash: str, manifest: Dict[str, Any], slots: List[Optional[Dict[str, Any]]]) -> None:
+    with _SAVE_LOCK:
+        passages = [
+            None if it is None else {k: v for k, v in it.items() if k != "norm_set"}
+            for it in slots
+        ]
+        _INDEX_STORE.save("scraper", source_hash, {"manifest": manifest, "passages": passages})
+
+def _save_persisted() -> None:
+    """
+    Salva indice e manifest in un thread (non daemon: termina anche all'uscita),
+    così build_index non aspetta la serializzazione. I passaggi non vengono mai
+    modificati dopo l'inserimento, basta copiare la lista degli slot e il manifest.
+    """
+    global _SAVE_THREAD
+    if not _INDEX_STORE.path or _INDEX_DIR is None:
+        return
+    manifest = {rel: dict(e, slots=list(e["slots"])) for rel, e in _MANIFEST.items()}
+    _SAVE_THREAD = threading.Thread(
+        target=_write_persisted,
+        args=(_index_source_hash(_INDEX_DIR), manifest, list(_LIVE[0])),
+        name="scraper-index-save",
+    )
+    _SAVE_THREAD.start()
+
+def _sync_files(base_abs: str, paths: List[str]) -> Dict[str, int]:
+    """
+    Allinea gli slot ai file su disco:
+    - file con mtime/dimensione invariati: nessuna lettura
+    - mtime/dimensione cambiati ma stesso hash: si aggiorna solo il manifest
+    - file nuovi o modificati: ri-parsing; i passaggi con stesso ID e stessi
+      token restano nel loro slot, gli altri entrano/escono dalle posting
+    - file rimossi: i loro slot si liberano
+    Le modifiche vanno su una copia degli slot (e di BM25F), pubblicata alla fine.
+    """
+    stats = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0, "touched": 0}
+    index, bm25 = list(_LIVE[0]), _LIVE[1]
+    current = {p[len(base_abs) + 1:]: p for p in paths}
+
+    to_parse: List[str] = []
+    for rel, path in current.items():
+        entry = _MANIFEST.get(rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if entry and (entry["mtime_ns"], entry["size"]) == (st.st_mtime_ns, st.st_size):
+            stats["unchanged"] += 1
+            continue
+        if entry and _file_sha1(path) == entry["sha1"]:
+            entry["mtime_ns"], entry["size"] = st.st_mtime_ns, st.st_size
+            stats["touched"] += 1
+            continue
+        to_parse.append(path)
+
+    removed_slots: List[int] = []
+    for rel in [r for r in _MANIFEST if r not in current]:
+        removed_slots.extend(_MANIFEST.pop(rel)["slots"])
+        stats["removed"] += 1
+
+    pending: List[Tuple[str, Dict[str, Any]]] = []  # (rel, passaggio) in attesa di slot
+    for path, entry, result in _parse_files(to_parse):
+        rel = path[len(base_abs) + 1:]
+        if entry is None:
+            print(f"[SCRAPER][WARN] Errore parsing {path}: {result}", flush=True)
+            continue
+        old = _MANIFEST.get(rel)
+        stats["changed" if old else "added"] += 1
+        old_by_id = {index[sl]["id"]: sl for sl in (old["slots"] if old else []) if index[sl] is not None}
+        kept: List[int] = []
+        for it in result:
+            it["rel"] = rel
+            sl = old_by_id.get(it["id"])
+            if sl is not None and index[sl]["fields"] == it["fields"]:
+                del old_by_id[it["id"]]
+                index[sl] = it  # stessi token: cambiano solo testo/offset, posting invariate
+                kept.append(sl)
+            else:
+                pending.append((rel, it))
+        # passaggi spariti o con token cambiati: il vecchio slot si libera
+        removed_slots.extend(old_by_id.values())
+        entry["slots"] = kept
+        _MANIFEST[rel] = entry
+
+    for sl in removed_slots:
+        index[sl] = None
+    free = [i for i, it in enumerate(index) if it is None]
+    added: List[Tuple[int, Dict[str, List[str]]]] = []
+    for rel, it in pending:
+        if free:
+            sl = free.pop(0)
+            index[sl] = it
+        else:
+            sl = len(index)
+            index.append(it)
+        _MANIFEST[rel]["slots"].append(sl)
+        added.append((sl, it["fields"]))
+
+    if not (removed_slots or added):
+        if to_parse:
+            _publish(index, bm25)  # stessi token, nuovi testi/offset
+        return stats
+    holes = sum(1 for it in index if it is None)
+    if bm25 is None or len(index) - holes <= BM25_FULL_REBUILD_MAX or holes > 0.25 * len(index):
+        index, bm25 = _rebuild_bm25(index)
+    else:
+        bm25 = bm25.copy()
+        bm25.update(removed_slots, added, len(index))
+        if bm25.drift() > BM25_AVGLEN_DRIFT:
+            index, bm25 = _rebuild_bm25(index)
+    _publish(index, bm25)
+    return stats
+
+def build_index(doc_dir: Optional[str] = None) -> int:
+    """
+    Costruisce o aggiorna l'indice globale e carica Sinapsi.
+    Alla prima chiamata riparte dall'indice salvato (SCRAPER_INDEX_PATH);
+    poi ri-legge solo i file aggiunti, modificati o rimossi.
+    """
+    global _MANIFEST, _INDEX_DIR
+    base = doc_dir or DOC_DIR
+    base_abs = os.path.abspath(base)
+    print(f"[SCRAPER] Indicizzazione da: {base_abs}", flush=True)
 
-    INDEX = items
-    print(f"[SCRAPER] Compat: INDEX len={len(INDEX)}", flush=True)
-    return len(INDEX)
+    if not os.path.exists(base):
+        with _BUILD_LOCK:
+            _MANIFEST, _INDEX_DIR = {}, None
+            _publish([], None)
+        print(f"[SCRAPER][WARN] DOC_DIR non esiste: {base}", flush=True)
+        return 0
+
+    t0 = time.perf_counter()
+    with _BUILD_LOCK:
+        if _INDEX_DIR != base_abs:
+            _load_persisted(base_abs)
+        paths = list_txt_files(base_abs)
+        stats = _sync_files(base_abs, paths)
+        if stats["added"] or stats["changed"] or stats["removed"] or stats["touched"]:
+            _save_persisted()
+    print(
+        f"[SCRAPER] {len(paths)} file .txt in {(time.perf_counter() - t0) * 1000:.1f} ms: "
+        f"+{stats['added']} ~{stats['changed']} -{stats['removed']} ={stats['unchanged']}",
+        flush=True,
+    )
+
+    # carica Sinapsi (compilato)
+    _load_sinapsi()
+
+    n_live = _LIVE[2]
+    print(f"[SCRAPER] Compat: INDEX len={n_live} passaggi da {len(_MANIFEST)} file", flush=True)
+    return n_live
 
 def is_ready() -> bool:
-    return bool(INDEX)
+    return _LIVE[2] > 0
 
 # ===== Scoring =====
-def _keyword_overlap(q: str, doc_norm: str) -> float:
-    qset = set(q.split())
-    if not qset:
-        return 0.0
-    dset = set(doc_norm.split())
-    if not dset:
+def _score_shortlist(
+    index: List[Optional[Dict[str, Any]]], nq: str, bm_scores: Any, ids: List[int]
+) -> List[Tuple[float, Dict[str, Any]]]:
+    """Punteggio ibrido (BM25F + overlap + fuzzy + boost) dei soli passaggi in shortlist."""
+    qset = set(nq.split())
+    scored: List[Tuple[float, Dict[str, Any]]] = []
+    for idx in ids:
+        it = index[idx]
+        if it is None:
+            continue
+        kw = _keyword_overlap(qset, it.get("norm_set") or frozenset())
+        fz = (fuzz.token_set_ratio(nq, it.get("fuzzy_norm", "")) / 100.0) if it.get("fuzzy_norm") else 0.0
+        bs = _boost_name_tags(it, nq)
+        bm = float(bm_scores[idx])
+        scored.append((0.60*bm + 0.25*kw + 0.15*fz + bs, it))
+    # ordinamento stabile: a parità di punteggio vince l'ordine degli slot
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return scored
+
+def _keyword_overlap(qset: Set[str], dset: FrozenSet[str]) -> float:
+    """Quota dei token della query presenti nel documento (token già precalcolati)."""
+    if not qset or not dset:
         return 0.0
     inter = len(qset & dset)
     return inter / max(1.0, float(len(qset)))
@@ -276,146 +729,150 @@ def _boost_name_tags(item: Dict[str, Any], nq: str) -> float:
             break
     return min(boost, 0.25)
 
-def _pick_best_answer_text(query: str, item: Dict[str, Any]) -> Tuple[str, Optional[str]]:
-    """Ritorna (answer_text, matched_question) senza mai mostrare 'D:' all'utente."""
-    nq = normalize_text(query)
-    best_ans = ""
-    best_q = None
-    best_s = -1.0
-
-    # prova a matchare sulle D:
-    for qa in item.get("qas", []):
-        dq = (qa.get("q") or "").strip()
-        dr = (qa.get("a") or "").strip()
-        qn = normalize_text(dq)
-        s = (fuzz.token_set_ratio(nq, qn) / 100.0) if qn else 0.0
-        if s > best_s:
-            # ripulisci eventuali "R:" all'inizio
-            dr = re.sub(r"^\s*(R|RISPOSTA)\s*:\s*", "", dr, flags=re.IGNORECASE).strip()
-            best_ans = dr
-            best_q = dq
-            best_s = s
-
-    # fallback: usa l'incipit del testo
-    if not best_ans:
-        raw = (item.get("text") or "").strip()
-        raw = re.sub(r"^\s*(D|DOMANDA)\s*:\s*", "", raw, flags=re.IGNORECASE | re.MULTILINE)
-        raw = re.sub(r"^\s*(R|RISPOSTA)\s*:\s*", "", raw, flags=re.IGNORECASE | re.MULTILINE)
-        best_ans = raw.split("\n\n")[0].strip()
-        best_q = None
+def _passage_answer(item: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    """(testo della risposta, domanda abbinata) del passaggio, senza mai mostrare 'D:'."""
+    body = (item.get("a") or "").strip()
+    kind = item.get("kind")
+    if kind == "qa":
+        ans, matched_q = body, item.get("q") or None
+    elif kind == "section":
+        ans, matched_q = f"{item.get('q', '')}\n{body}".strip(), None
+    else:
+        # testo libero: il primo paragrafo
+        ans, matched_q = body.split("\n\n")[0].strip(), None
 
     # clamp elegante
-    if MAX_ANSWER_CHARS and len(best_ans) > MAX_ANSWER_CHARS:
-        cut = best_ans[:MAX_ANSWER_CHARS]
+    if MAX_ANSWER_CHARS and len(ans) > MAX_ANSWER_CHARS:
+        cut = ans[:MAX_ANSWER_CHARS]
         m = re.search(r"(?s)^(.+?[\.!\?])(\s|$)", cut)
-        best_ans = (m.group(1) if m else cut).rstrip() + " …"
+        ans = (m.group(1) if m else cut).rstrip() + " …"
 
-    return best_ans or "", best_q
+    return ans, matched_q
 
 # ===== Sinapsi =====
-def _sinapsi_enrich(answer: str, query: str) -> str:
-    if not SINAPSI_ENABLE or not _SINAPSI:
-        return answer
-    nq = set(normalize_text(query).split())
-    out_parts: List[str] = []
-
-    # topics
-    topics = _SINAPSI.get("topics", {}) or {}
-    for k, v in topics.items():
-        nk = normalize_text(k)
-        if nk in nq:
-            out_parts.append(str(v).strip())
-
-    # rules
-    rules = _SINAPSI.get("rules", []) or []
-    for r in rules:
-        if_any = [normalize_text(x) for x in (r.get("if_any") or [])]
-        if_all = [normalize_text(x) for x in (r.get("if_all") or [])]
-        ok_any = (not if_any) or any(t in nq for t in if_any)
-        ok_all = all(t in nq for t in if_all) if if_all else True
-        if ok_any and ok_all:
+class SinapsiEngine:
+    """
+    Sinapsi (topics/rules) compilato una volta al caricamento:
+    - topics: chiave normalizzata -> testi (si confronta con i token della query)
+    - rules: if_any/if_all già normalizzati in insiemi, più un indice inverso
+      termine -> regole; a query time si valutano solo le regole che hanno
+      almeno un termine in comune con la query (più quelle senza condizioni).
+    Il costo di enrich() dipende dai token della query, non dal numero di regole.
+    """
+
+    def __init__(self, raw: Dict[str, Any]) -> None:
+        self.topics: Dict[str, List[Tuple[int, str]]] = {}
+        for pos, (k, v) in enumerate((raw.get("topics", {}) or {}).items()):
+            self.topics.setdefault(normalize_text(k), []).append((pos, str(v).strip()))
+
+        self.rules: List[Tuple[FrozenSet[str], FrozenSet[str], str]] = []
+        self.by_term: Dict[str, List[int]] = {}
+        self.always: List[int] = []
+        for r in raw.get("rules", []) or []:
+            if_any = frozenset(normalize_text(x) for x in (r.get("if_any") or []))
+            if_all = frozenset(normalize_text(x) for x in (r.get("if_all") or []))
             add = str(r.get("add", "")).strip()
-            if add:
-                out_parts.append(add)
-
-    prefix = str(_SINAPSI.get("prefix", "")).strip()
-    suffix = str(_SINAPSI.get("suffix", "")).strip()
-
-    final = answer.strip()
-    if prefix:
-        final = f"{prefix}\n\n{final}".strip()
-    if out_parts:
-        final = f"{final}\n\n" + "\n".join([p for p in out_parts if p])
-    if suffix:
-        final = f"{final}\n\n{suffix}".strip()
+            if not add:
+                continue
+            rid = len(self.rules)
+            self.rules.append((if_any, if_all, add))
+            if not if_any and not if_all:
+                self.always.append(rid)
+            # una regola con if_all scatta solo se la query ha tutti quei termini:
+            # basta indicizzarla su uno di essi; altrimenti su ogni termine di if_any
+            for t in ([next(iter(if_all))] if if_all else if_any):
+                self.by_term.setdefault(t, []).append(rid)
+
+        self.prefix = str(raw.get("prefix", "")).strip()
+        self.suffix = str(raw.get("suffix", "")).strip()
+        self.n_topics = sum(len(v) for v in self.topics.values())
+
+    def enrich(self, answer: str, query: str) -> str:
+        nq = set(normalize_text(query).split())
+
+        topic_hits = sorted(hit for t in nq for hit in self.topics.get(t, ()))
+        candidates = set(self.always)
+        for t in nq:
+            candidates.update(self.by_term.get(t, ()))
+        rule_hits = []
+        for rid in sorted(candidates):
+            if_any, if_all, add = self.rules[rid]
+            if (not if_any or not if_any.isdisjoint(nq)) and if_all <= nq:
+                rule_hits.append(add)
+        out_parts = [v for _, v in topic_hits] + rule_hits
+
+        final = answer.strip()
+        if self.prefix:
+            final = f"{self.prefix}\n\n{final}".strip()
+        if out_parts:
+            final = f"{final}\n\n" + "\n".join([p for p in out_parts if p])
+        if self.suffix:
+            final = f"{final}\n\n{self.suffix}".strip()
+
+        return final.strip()
+
+def _load_sinapsi() -> None:
+    """(Ri)compila Sinapsi solo se il file è cambiato (mtime/dimensione)."""
+    global _SINAPSI, _SINAPSI_SIG
+    if not SINAPSI_ENABLE:
+        _SINAPSI, _SINAPSI_SIG = None, None
+        return
+    try:
+        if not os.path.exists(SINAPSI_PATH):
+            _SINAPSI, _SINAPSI_SIG = None, None
+            print(f"[SCRAPER] Sinapsi file non trovato: {os.path.abspath(SINAPSI_PATH)}", flush=True)
+            return
+        st = os.stat(SINAPSI_PATH)
+        sig = (st.st_mtime_ns, st.st_size)
+        if sig == _SINAPSI_SIG:
+            return
+        with open(SINAPSI_PATH, "r", encoding="utf-8", errors="ignore") as f:
+            _SINAPSI = SinapsiEngine(json.load(f) or {})
+        _SINAPSI_SIG = sig
+        print(f"[SCRAPER] Sinapsi ON (rules={len(_SINAPSI.rules)}, topics={_SINAPSI.n_topics}, termini indicizzati={len(_SINAPSI.by_term)}) file={SINAPSI_PATH}", flush=True)
+    except Exception as e:
+        _SINAPSI, _SINAPSI_SIG = None, None
+        print(f"[SCRAPER][WARN] Errore lettura Sinapsi: {e}", flush=True)
 
-    return final.strip()
+def _sinapsi_enrich(answer: str, query: str) -> str:
+    if not SINAPSI_ENABLE or _SINAPSI is None:
+        return answer
+    return _SINAPSI.enrich(answer, query)
 
 # ===== Ricerca =====
 def search_best_answer(query: str) -> Dict[str, Any]:
-    if not INDEX:
+    # una sola lettura dello snapshot: passaggi e BM25F restano coerenti anche
+    # se nel frattempo un altro thread reindicizza
+    index, bm25, n_live = _LIVE
+    if not n_live:
         return {"answer": "Indice non pronto.", "found": False, "from": None}
 
     nq_base = normalize_text(query)
     nq = expand_query_synonyms(nq_base)
 
-    # BM25 una volta sola
-    bm_scores = None
-    if _BM25 is not None and np is not None:
-        try:
-            q_tokens = nq.split()
-            bm_arr = _BM25.get_scores(q_tokens)
-            bm_max = float(np.max(bm_arr)) if getattr(bm_arr, "size", 0) > 0 else 1.0
-            bm_scores = (bm_arr / bm_max) if bm_max > 0 else bm_arr
-        except Exception:
-            bm_scores = None
-
-    # scoring ibrido
-    scored: List[Tuple[float, Dict[str, Any]]] = []
-    for idx, it in enumerate(INDEX):
-        kw = _keyword_overlap(nq, it.get("norm", ""))
-        fz = (fuzz.token_set_ratio(nq, it.get("norm", "")) / 100.0) if it.get("norm") else 0.0
-        bs = _boost_name_tags(it, nq)
-        bm = float(bm_scores[idx]) if bm_scores is not None else 0.0
-        score = 0.60*bm + 0.25*kw + 0.15*fz + bs
-        scored.append((score, it))
+    # BM25F sulle due varianti (espansa e base) in un solo passaggio,
+    # poi overlap/fuzzy solo sulla shortlist comune
+    bm_scores, bm_scores2 = _normalized_bm25_batch(bm25, len(index), [nq.split(), nq_base.split()])
+    shortlist = _shortlist([bm_scores, bm_scores2], len(index), max(1, FUZZY_SHORTLIST))
 
+    scored = _score_shortlist(index, nq, bm_scores, shortlist)
     if not scored:
         return {"answer": "Non ho trovato risposte nei documenti locali.", "found": False, "from": None}
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top = scored[:max(1, TOP_K)]
-    best_score, best_item = top[0]
+    best_score, best_item = scored[0]
     norm_score = max(0.0, min(1.0, float(best_score)))
 
-    answer_txt, matched_q = _pick_best_answer_text(query, best_item)
-    if not answer_txt:
-        return {"answer": "(nessuna risposta)", "found": False, "from": best_item.get("file")}
-
     # soglia
     if norm_score < SIMILARITY_THRESHOLD:
         # second chance con query base (senza espansione sinonimi)
-        bm_scores2 = None
-        if _BM25 is not None and np is not None:
-            try:
-                bm_arr2 = _BM25.get_scores(nq_base.split())
-                bm_max2 = float(np.max(bm_arr2)) if getattr(bm_arr2, "size", 0) > 0 else 1.0
-                bm_scores2 = (bm_arr2 / bm_max2) if bm_max2 > 0 else bm_arr2
-            except Exception:
-                bm_scores2 = None
-
-        rescored: List[Tuple[float, Dict[str, Any]]] = []
-        for idx, it in enumerate(INDEX):
-            kw = _keyword_overlap(nq_base, it.get("norm", ""))
-            fz = (fuzz.token_set_ratio(nq_base, it.get("norm", "")) / 100.0) if it.get("norm") else 0.0
-            bs = _boost_name_tags(it, nq_base)
-            bm = float(bm_scores2[idx]) if bm_scores2 is not None else 0.0
-            s = 0.60*bm + 0.25*kw + 0.15*fz + bs
-            rescored.append((s, it))
-        rescored.sort(key=lambda x: x[0], reverse=True)
+        rescored = _score_shortlist(index, nq_base, bm_scores2, shortlist)
         best_score, best_item = rescored[0]
         norm_score = max(0.0, min(1.0, float(best_score)))
-        answer_txt, matched_q = _pick_best_answer_text(query, best_item) or (answer_txt, matched_q)
+
+    # il passaggio vincente è già la risposta: nessuna seconda scansione del file
+    answer_txt, matched_q = _passage_answer(best_item)
+    if not answer_txt:
+        return {"answer": "(nessuna risposta)", "found": False, "from": best_item.get("file")}
 
     # Enrichment Sinapsi
     try:
@@ -428,7 +885,9 @@ def search_best_answer(query: str) -> Dict[str, Any]:
         "found": True,
         "score": round(norm_score, 3),
         "from": best_item.get("file"),
-        "tags": best_item.get("tags") or []
+        "tags": best_item.get("tags") or [],
+        "passage": best_item.get("id"),
+        "span": [best_item.get("start"), best_item.get("end")],
     }
     # For debugging UI (puoi decidere di nasconderlo in app.py)
     if matched_q:
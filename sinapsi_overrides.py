@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+sinapsi_overrides.py
+--------------------
+Regole Sinapsi "critiche" (static/static/data/critici/sinapsi_rules.json,
+sinapsi_brain.json): pattern regex con risposta curata e modalità
+- override:   la risposta curata sostituisce tutto il resto (niente LLM)
+- augment:    la risposta curata si aggiunge alla risposta normale
+- postscript: come augment, ma in coda a tutte le aggiunte
+
+Dispatcher compilato una volta:
+- ogni pattern viene compilato singolarmente (un pattern non valido viene
+  scartato con un avviso, le altre regole restano attive);
+- dall'albero del pattern si ricavano dei frammenti letterali di cui almeno
+  uno deve comparire nel testo se il pattern trova qualcosa ("p560 ...
+  (patentino|abilitazione|formazione)" → {patentino, abilitazione, formazione});
+- a query time un automa Aho–Corasick (keyword_automaton) trova tutti i
+  frammenti con un solo passaggio sul testo minuscolo e si esegue la regex
+  solo delle regole candidate. Le regole da cui non si
+  ricava nessun frammento sicuro vengono sempre provate.
+
+Dipendenze: solo libreria standard.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from keyword_automaton import KeywordAutomaton
+
+try:
+    import re._parser as _sre_parse  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import sre_parse as _sre_parse
+
+MODES = ("override", "augment", "postscript")
+
+_C = _sre_parse  # costanti degli opcode (LITERAL, BRANCH, ...)
+_FRAGMENT_MIN_LEN = 2
+
+
+def _fragments(parsed) -> Optional[FrozenSet[str]]:
+    """
+    Frammenti letterali (minuscoli) di cui almeno uno compare in ogni testo
+    che soddisfa la sequenza; None se non se ne ricava nessuno di sicuro.
+    In una sequenza si sceglie il candidato più selettivo (frammento minimo
+    più lungo); in un'alternativa servono i frammenti di tutti i rami.
+    """
+    candidates: List[FrozenSet[str]] = []
+    run: List[str] = []
+
+    def close_run() -> None:
+        if len(run) >= _FRAGMENT_MIN_LEN:
+            candidates.append(frozenset(["".join(run)]))
+        run.clear()
+
+    for op, av in parsed:
+        if op is _C.LITERAL:
+            run.append(chr(av).lower())
+            continue
+        if op is _C.AT:
+            # ancore (\b, ^, $) non consumano caratteri: il letterale continua
+            continue
+        close_run()
+        if op is _C.SUBPATTERN:
+            sub = _fragments(av[-1])
+            if sub:
+                candidates.append(sub)
+        elif op is _C.BRANCH:
+            branches = [_fragments(b) for b in av[1]]
+            if branches and all(branches):
+                candidates.append(frozenset().union(*branches))
+        elif op in (_C.MAX_REPEAT, _C.MIN_REPEAT, getattr(_C, "POSSESSIVE_REPEAT", None)):
+            lo, _hi, item = av
+            if lo >= 1:
+                sub = _fragments(item)
+                if sub:
+                    candidates.append(sub)
+    close_run()
+
+    if not candidates:
+        return None
+    return max(candidates, key=lambda s: (min(len(f) for f in s), -len(s)))
+
+
+class OverrideRule:
+    __slots__ = ("id", "mode", "lang", "answer", "source", "regex", "fragments")
+
+    def __init__(self, raw: Dict[str, Any], source: str) -> None:
+        self.id = str(raw.get("id") or "")
+        self.mode = str(raw.get("mode") or "augment").lower()
+        self.lang = str(raw.get("lang") or "").lower()
+        self.answer = str(raw.get("answer") or "").strip()
+        self.source = source
+        pattern = str(raw.get("pattern") or "")
+        self.regex = re.compile(pattern)
+        try:
+            self.fragments = _fragments(_sre_parse.parse(pattern))
+        except Exception:
+            self.fragments = None
+
+
+class OverrideDispatcher:
+    def __init__(self, rule_sets: List[Tuple[str, List[Dict[str, Any]]]]) -> None:
+        """rule_sets: [(nome_file, regole)]; a parità di id vale la prima definizione."""
+        self.rules: List[OverrideRule] = []
+        seen = set()
+        for source, rules in rule_sets:
+            for raw in rules or []:
+                rid = str(raw.get("id") or "")
+                if not raw.get("pattern") or not raw.get("answer") or rid in seen:
+                    continue
+                try:
+                    rule = OverrideRule(raw, source)
+                except re.error as e:
+                    print(f"[SINAPSI][WARN] pattern non valido in {source} ({rid}): {e}")
+                    continue
+                if rule.mode not in MODES:
+                    print(f"[SINAPSI][WARN] modalità sconosciuta in {source} ({rid}): {rule.mode}")
+                    continue
+                seen.add(rid)
+                self.rules.append(rule)
+
+        # frammento -> regole; regole senza frammenti sicuri: sempre candidate
+        self.by_fragment: Dict[str, List[int]] = {}
+        self.always: List[int] = []
+        for i, rule in enumerate(self.rules):
+            if rule.fragments:
+                for frag in rule.fragments:
+                    self.by_fragment.setdefault(frag, []).append(i)
+            else:
+                self.always.append(i)
+        # frammenti come sottostringhe (niente confini di parola): stesso esito di `frag in low`
+        self.automaton = KeywordAutomaton()
+        for frag in self.by_fragment:
+            self.automaton.add(frag, frag, boundaries=False)
+        self.automaton.build()
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def match(self, text: str, lang: str = "it") -> List[OverrideRule]:
+        """Regole che scattano sul testo, nell'ordine dei file."""
+        if not self.rules or not text:
+            return []
+        candidates = set(self.always)
+        for frag in self.automaton.labels(text):
+            candidates.update(self.by_fragment[frag])
+        hits = []
+        for i in sorted(candidates):
+            rule = self.rules[i]
+            if rule.lang and lang and rule.lang != lang:
+                continue
+            if rule.regex.search(text):
+                hits.append(rule)
+        return hits
+
+    def resolve(self, text: str, lang: str = "it") -> Tuple[Optional[OverrideRule], List[OverrideRule]]:
+        """(prima regola override, regole augment/postscript in ordine di applicazione)."""
+        hits = self.match(text, lang)
+        override = next((r for r in hits if r.mode == "override"), None)
+        extras = [r for r in hits if r.mode == "augment"] + [r for r in hits if r.mode == "postscript"]
+        return override, extras
+
+
+def read_rule_files(paths: List[str]) -> List[Tuple[str, List[Dict[str, Any]]]]:
+    """Legge i file di regole; un file mancante viene saltato, un JSON rotto solleva."""
+    out: List[Tuple[str, List[Dict[str, Any]]]] = []
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"[SINAPSI][WARN] file regole non trovato: {path}")
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        rules = data.get("rules", []) if isinstance(data, dict) else data
+        out.append((os.path.basename(path), rules if isinstance(rules, list) else []))
+    return out
+
+
+def apply_extras(answer: str, extras: List[OverrideRule]) -> str:
+    """Aggiunge in coda alla risposta i testi delle regole augment/postscript."""
+    parts = [answer.rstrip()] + [r.answer for r in extras if r.answer]
+    return "\n\n".join(p for p in parts if p)
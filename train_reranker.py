@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+train_reranker.py
+-----------------
+Addestra offline il reranker locale di applastversion (local_reranker.py)
+e salva il modello in static/data/models/reranker_lr.json.
+
+Esempi di addestramento (solo dalla KB):
+1) auto-supervisione: ogni question_it (e varianti ridotte, più il campo
+   "question" quando presente) deve riportare al proprio blocco;
+2) casi delle patch v12.2–v12.6: la stessa domanda preceduta da un termine di
+   negazione / geometria / verifica / limiti, così le feature negation_match,
+   geometry_conflict, diagnostic_conflict e limits_match si attivano anche in
+   training (quante volte: vedi l'output).
+
+Valutazione: le domande reali etichettate (EVAL_SETS: smoke_200, quick100)
+non entrano MAI nel training. Si confronta il routing completo
+(find_best_block) con il leader delle patch v12.x e con il modello: famiglia
+top-1 e must_include di expected_patterns.json. Le domande della KB tenute da
+parte danno solo un'indicazione ottimistica (le feature qit_* le rendono facili).
+
+Come in produzione, il modello vede solo i candidati rimasti dopo il gate di
+applastversion.rerank_shortlist (margine RERANK_MARGIN, finestra
+RERANK_WINDOW, al massimo RERANK_MAX_CANDIDATES): le domande con un leader
+netto non diventano esempi, né di training né di valutazione.
+
+Uso:
+    python train_reranker.py [--out PATH] [--epochs N]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import applastversion as A
+from bench_routing import (
+    TEST_SETS,
+    block_family,
+    load_expected_patterns,
+    load_test_questions,
+    must_include_ok,
+)
+from local_reranker import LocalReranker, train_logistic
+
+# domande reali etichettate: solo valutazione (sono anche i set di bench_routing)
+EVAL_SETS = ["smoke_200", "quick100"]
+HOLDOUT_EVERY = 5
+PATCH_CASE_WEIGHT = 0.5
+
+# termini della domanda che attivano le classi v12.2–v12.6 (feature *_match/*_conflict)
+PATCH_TERMS = {
+    "negation": A.NEG_PATTERNS,
+    "geometry": A.GEOMETRY_TERMS,
+    "diagnostic": A.DIAGNOSTIC_TERMS,
+    "limits": A.LIMIT_TERMS,
+}
+PATCH_FEATURES = ["negation_match", "geometry_conflict", "diagnostic_conflict", "limits_match"]
+
+
+def query_variants(block: Dict[str, Any], rnd: random.Random) -> List[str]:
+    q_it = block.get("question_it") or ""
+    out = [q_it]
+    if block.get("question") and block["question"] != q_it:
+        out.append(block["question"])
+    toks = A.tokenize(q_it)
+    if len(toks) >= 6:
+        for _ in range(2):
+            keep = sorted(rnd.sample(range(len(toks)), max(3, int(len(toks) * 0.6))))
+            out.append(" ".join(toks[i] for i in keep))
+    return out
+
+
+Example = Tuple[List[List[float]], List[int], float]
+
+
+def make_example(
+    question: str,
+    positive: Callable[[Dict[str, Any]], bool],
+    weight: float,
+    require_positive: bool = True,
+):
+    """
+    Esempio sui soli candidati che in produzione arrivano al reranker
+    (A.rerank_shortlist: patch v12.x + gate margine/finestra); None se il
+    gate decide da solo. Con require_positive=False restano anche i casi in
+    cui il blocco giusto è già stato scartato (valutazione: errore certo).
+    """
+    snap = A.S
+    _, _, master = A.lexical_candidates(question, snap=snap)
+    if len(master) < 2:
+        return None
+    scores = {b.get("id"): s for s, b in master}
+    q_norm = A.normalize(question)
+    cands = A.rerank_shortlist(q_norm, [b for s, b in master], scores, snap)
+    labels = [1 if positive(b) else 0 for b in cands]
+    if len(cands) < 2 or all(labels):
+        return None
+    if require_positive and not any(labels):
+        return None
+    return A.rerank_features(q_norm, cands, scores, snap), labels, weight
+
+
+def patch_variants(block: Dict[str, Any], rnd: random.Random) -> List[str]:
+    """question_it preceduta da un termine di ogni classe v12.2–v12.6."""
+    q_it = block.get("question_it") or ""
+    return [f"{rnd.choice(terms)} {q_it}" for terms in PATCH_TERMS.values()]
+
+
+def build_examples(seed: int = 12) -> Tuple[List[Example], List[Example], List[Example]]:
+    """
+    Ritorna (kb_train, kb_holdout, patch) come liste di esempi per-domanda.
+    kb_holdout comprende anche i casi gated senza il blocco giusto tra i candidati;
+    patch (casi v12.2–v12.6) usa solo i blocchi di training.
+    """
+    rnd = random.Random(seed)
+    kb_train: List[Example] = []
+    kb_holdout: List[Example] = []
+    patch: List[Example] = []
+    for i, block in enumerate(A.S.master_blocks):
+        bid = block.get("id")
+        holdout = i % HOLDOUT_EVERY == 0
+        positive = lambda b, bid=bid: b.get("id") == bid
+        for q in query_variants(block, rnd):
+            ex = make_example(q, positive, 1.0, require_positive=not holdout)
+            if ex is not None:
+                (kb_holdout if holdout else kb_train).append(ex)
+        if holdout:
+            continue
+        for q in patch_variants(block, rnd):
+            ex = make_example(q, positive, PATCH_CASE_WEIGHT)
+            if ex is not None:
+                patch.append(ex)
+    return kb_train, kb_holdout, patch
+
+
+def feature_activations(examples: List[Example]) -> Dict[str, int]:
+    """Righe (candidati) in cui ciascuna feature delle patch v12.x vale 1."""
+    cols = [A.RERANK_FEATURES.index(f) for f in PATCH_FEATURES]
+    return {
+        f: sum(1 for rows, _, _ in examples for r in rows if r[c])
+        for f, c in zip(PATCH_FEATURES, cols)
+    }
+
+
+def real_question_eval(model: LocalReranker) -> Dict[str, Dict[str, Any]]:
+    """
+    Routing completo (find_best_block, senza LLM) sulle domande reali di
+    EVAL_SETS: leader delle patch v12.x contro modello locale.
+    """
+    patterns = load_expected_patterns()
+    questions = [
+        it for name in EVAL_SETS for it in load_test_questions(TEST_SETS[name]) if it.get("family")
+    ]
+    saved = A.LOCAL_RERANKER, A.client
+    A.client = None
+    out: Dict[str, Dict[str, Any]] = {}
+    picks: Dict[str, List[Any]] = {}
+    try:
+        for label, reranker in (("heuristics", None), ("model", model)):
+            A.LOCAL_RERANKER = reranker
+            correct = mi_ok = mi_n = 0
+            picks[label] = []
+            for it in questions:
+                block, _ = A.find_best_block(it["question"])
+                picks[label].append(block.get("id") if block else None)
+                fam = (it.get("family") or "").upper()
+                correct += block_family(block) == fam
+                if block is not None:
+                    ok = must_include_ok(patterns.get(fam, []), block.get("id"), block.get("answer_it") or "")
+                    if ok is not None:
+                        mi_n += 1
+                        mi_ok += ok
+            out[label] = {
+                "top1": round(correct / len(questions), 4) if questions else 0.0,
+                "must_include": round(mi_ok / mi_n, 4) if mi_n else None,
+            }
+    finally:
+        A.LOCAL_RERANKER, A.client = saved
+    out["questions"] = len(questions)
+    out["changed_picks"] = sum(a != b for a, b in zip(picks["heuristics"], picks["model"]))
+    return out
+
+
+def beats_heuristics(ev: Dict[str, Dict[str, Any]]) -> bool:
+    h, m = ev["heuristics"], ev["model"]
+    if m["top1"] < h["top1"]:
+        return False
+    if h["must_include"] is not None and (m["must_include"] or 0.0) < h["must_include"]:
+        return False
+    return m["top1"] > h["top1"] or (m["must_include"] or 0.0) > (h["must_include"] or 0.0)
+
+
+def flatten(examples: List[Example]):
+    X: List[List[float]] = []
+    y: List[int] = []
+    w: List[float] = []
+    for rows, labels, weight in examples:
+        X.extend(rows)
+        y.extend(labels)
+        w.extend([weight] * len(rows))
+    return X, y, w
+
+
+def top1_accuracy(examples: List[Example], model: LocalReranker = None) -> float:
+    if not examples:
+        return 0.0
+    ok = 0
+    for rows, labels, _ in examples:
+        if model is None:
+            best = 0  # primo candidato dopo le patch v12.x
+        else:
+            probs = model.predict(rows)
+            best = max(range(len(rows)), key=lambda i: probs[i])
+        ok += labels[best]
+    return ok / len(examples)
+
+
+def fit(examples: List[Example], epochs: int, meta: Dict[str, Any]) -> LocalReranker:
+    X, y, w = flatten(examples)
+    weights, bias, mean, std = train_logistic(X, y, w, epochs=epochs)
+    return LocalReranker(A.RERANK_FEATURES, weights, bias, mean, std, meta)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Addestra il reranker locale GOLD")
+    ap.add_argument("--out", default=A.RERANKER_MODEL_PATH)
+    ap.add_argument("--epochs", type=int, default=200)
+    args = ap.parse_args()
+
+    t0 = time.time()
+    kb_train, kb_holdout, patch = build_examples()
+    # per il training servono casi con il blocco giusto tra i candidati
+    kb_holdout_fit = [ex for ex in kb_holdout if any(ex[1])]
+    print(
+        f"[TRAIN] esempi (solo casi oltre il gate): kb_train={len(kb_train)} "
+        f"kb_holdout={len(kb_holdout)} (raggiungibili {len(kb_holdout_fit)}) patch={len(patch)}"
+    )
+    activations = feature_activations(kb_train + kb_holdout_fit + patch)
+    print(f"[TRAIN] attivazioni feature v12.x: {activations}")
+    for f, n in activations.items():
+        if not n:
+            # la patch v12.x corrispondente toglie già quei candidati (o la KB non ha il blocco)
+            print(f"[TRAIN][WARN] {f} non si attiva mai sui candidati oltre le patch v12.x: peso 0")
+
+    # domande della KB mai viste in training: indicazione ottimistica
+    model = fit(kb_train + patch, args.epochs, {})
+    base_acc = top1_accuracy(kb_holdout)
+    model_acc = top1_accuracy(kb_holdout, model)
+    print(f"[TRAIN] holdout KB top-1 (casi gated, ottimistico): euristiche={base_acc:.3f} modello={model_acc:.3f}")
+
+    # modello finale su tutta la KB, valutato sulle domande reali (mai in training)
+    final = fit(kb_train + kb_holdout_fit + patch, args.epochs, {})
+    real = real_question_eval(final)
+    verdict = beats_heuristics(real)
+    print(
+        f"[TRAIN] domande reali ({'+'.join(EVAL_SETS)}, n={real['questions']}, "
+        f"scelte cambiate={real['changed_picks']}): "
+        f"euristiche top1={real['heuristics']['top1']} must={real['heuristics']['must_include']} | "
+        f"modello top1={real['model']['top1']} must={real['model']['must_include']}"
+    )
+    if not verdict:
+        print("[TRAIN][WARN] il modello non batte il leader v12.x: lasciare RERANK_MODE=llm (default)")
+
+    final.meta = {
+        "trained_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "kb_blocks": len(A.S.master_blocks),
+        "examples": len(kb_train) + len(kb_holdout_fit) + len(patch),
+        "gate": {
+            "margin": A.RERANK_MARGIN,
+            "window": A.RERANK_WINDOW,
+            "max_candidates": A.RERANK_MAX_CANDIDATES,
+        },
+        "feature_activations": activations,
+        "holdout_gated_cases": len(kb_holdout),
+        "holdout_top1_heuristics": round(base_acc, 4),
+        "holdout_top1_model": round(model_acc, 4),
+        "real_questions": real,
+        "beats_heuristics": verdict,
+    }
+    final.save(args.out)
+    print(f"[TRAIN] modello salvato in {args.out} ({time.time() - t0:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()